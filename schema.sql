@@ -9,7 +9,7 @@ use EveYoung;
 grant select, insert, update, delete on EveYoung.* to 'root'@'localhost' identified by '123456';
 
 create table users (
-    `id` varchar(50) not null,
+    `id` bigint not null,
     `email` varchar(50) not null,
     `passwd` varchar(50) not null,
     `admin` bool not null,
@@ -22,8 +22,8 @@ create table users (
 ) engine=innodb default charset=utf8;
 
 create table blogs (
-    `id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+    `id` bigint not null,
+    `user_id` bigint not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `name` varchar(50) not null,
@@ -35,13 +35,24 @@ create table blogs (
 ) engine=innodb default charset=utf8;
 
 create table comments (
-    `id` varchar(50) not null,
-    `blog_id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+    `id` bigint not null,
+    `blog_id` bigint not null,
+    `user_id` bigint not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
+
+-- python3 -m www.migrate --ids 把旧的varchar(50)主键换成bigint时记录的对应关系
+-- 旧用户的密码是用旧id加盐的, 登录时要用到
+create table legacy_ids (
+    `table_name` varchar(50) not null,
+    `old_id` varchar(50) not null,
+    `new_id` bigint not null,
+    key `idx_new_id` (`table_name`, `new_id`),
+    primary key (`table_name`, `old_id`)
+) engine=innodb default charset=utf8;
@@ -0,0 +1,48 @@
+-- schema_sqlite.sql
+-- SQLite后端(configs.db的backend设为'sqlite')使用的表结构, 和schema.sql对应
+-- 全部用if not exists, create_pool的schema参数指向这个文件时每次启动都会执行一遍
+-- SQLite的索引名在整个数据库内不能重复, 所以索引名带上表名
+
+create table if not exists users (
+    `id` bigint not null primary key,
+    `email` varchar(50) not null,
+    `passwd` varchar(50) not null,
+    `admin` bool not null,
+    `name` varchar(50) not null,
+    `image` varchar(500) not null,
+    `created_at` real not null
+);
+create unique index if not exists `idx_users_email` on users (`email`);
+create index if not exists `idx_users_created_at` on users (`created_at`);
+
+create table if not exists blogs (
+    `id` bigint not null primary key,
+    `user_id` bigint not null,
+    `user_name` varchar(50) not null,
+    `user_image` varchar(500) not null,
+    `name` varchar(50) not null,
+    `summary` varchar(200) not null,
+    `content` mediumtext not null,
+    `created_at` real not null
+);
+create index if not exists `idx_blogs_created_at` on blogs (`created_at`);
+
+create table if not exists comments (
+    `id` bigint not null primary key,
+    `blog_id` bigint not null,
+    `user_id` bigint not null,
+    `user_name` varchar(50) not null,
+    `user_image` varchar(500) not null,
+    `content` mediumtext not null,
+    `created_at` real not null
+);
+create index if not exists `idx_comments_created_at` on comments (`created_at`);
+create index if not exists `idx_comments_blog_id_created_at` on comments (`blog_id`, `created_at`);
+
+create table if not exists legacy_ids (
+    `table_name` varchar(50) not null,
+    `old_id` varchar(50) not null,
+    `new_id` bigint not null,
+    primary key (`table_name`, `old_id`)
+);
+create index if not exists `idx_legacy_ids_new_id` on legacy_ids (`table_name`, `new_id`);
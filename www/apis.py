@@ -9,7 +9,7 @@ __author__ = 'EveYoung'
 Json API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
 
@@ -33,6 +33,81 @@ class Page(object):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
     __repr__ = __str__
 
+#基于游标(keyset)的分页, 不用offset, 翻到多深的页面代价都和第一页一样
+#游标是不透明的字符串, 里面是翻页方向和边界行的(排序列的值, 主键)
+#用法:
+#   p = CursorPage(cursor)
+#   items = yield from Blog.findAll(orderBy='created_at desc', limit=p.limit, **p.seek)
+#   items = p.paginate(items, lambda b: (b.created_at, b.id))
+class CursorPage(object):
+
+    def __init__(self, cursor=None, page_size=10):
+        self.page_size = page_size
+        self.cursor = cursor or None
+        self.next_cursor = None
+        self.prev_cursor = None
+        self.has_next = False
+        self.has_previous = False
+        if self.cursor:
+            self.direction, self.key = decode_cursor(self.cursor)
+        else:
+            self.direction, self.key = None, None
+        #多查一行, 用来判断这个方向上还有没有下一页
+        self.limit = page_size + 1
+
+    #传给Model.findAll的after/before参数, 第一页是after=None
+    @property
+    def seek(self):
+        if self.direction is None:
+            return {'after': None}
+        return {self.direction: self.key}
+
+    #截掉多查的那一行, 计算上一页/下一页的游标
+    def paginate(self, items, key):
+        items = list(items)
+        more = len(items) > self.page_size
+        if self.direction == 'before':
+            if more:
+                items = items[1:]
+            self.has_previous = more
+            self.has_next = True
+        else:
+            items = items[:self.page_size]
+            self.has_next = more
+            self.has_previous = self.direction == 'after'
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('after', key(items[-1]))
+            if self.has_previous:
+                self.prev_cursor = encode_cursor('before', key(items[0]))
+        return items
+
+    #返回给客户端的只有不透明的游标和每页的数量, limit/direction/key是内部用的
+    def to_json(self, **kw):
+        return dict(page_size=self.page_size, next_cursor=self.next_cursor, prev_cursor=self.prev_cursor)
+
+    def __str__(self):
+        return 'cursor: %s, page_size: %s, has_next: %s, has_previous: %s' % (self.cursor, self.page_size, self.has_next, self.has_previous)
+    __repr__ = __str__
+
+def encode_cursor(direction, key):
+    s = json.dumps([direction] + list(key), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        L = json.loads(s)
+        if not isinstance(L, list) or len(L) != 3 or L[0] not in ('after', 'before'):
+            raise ValueError(s)
+        #游标来自客户端, 边界值会直接作为sql参数, 只接受标量
+        for v in L[1:]:
+            if isinstance(v, bool) or not isinstance(v, (str, int, float)):
+                raise ValueError(s)
+        return L[0], tuple(L[1:])
+    except ValueError as e:
+        raise APIValueError('cursor', 'Invalid cursor.')
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(option)
@@ -27,6 +27,9 @@ import json
 #time模块提供各种操作时间的函数
 import time
 
+#signal模块用来处理SIGTERM等信号
+import signal
+
 #datetime是处理日期和时间的标准库
 from datetime import datetime
 
@@ -38,7 +41,8 @@ from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
 from www.config import configs
-from www import orm
+from www import orm, migrate, search, writebehind
+from www.models import Comment
 from www.coroweb import add_routes, add_static
 from www.handlers import cookie2user, COOKIE_NAME
 
@@ -79,9 +83,48 @@ def logger_factory(app, handler):
     def logger(request):
         logging.info('Request: %s %s' %(request.method, request.path))
         #await asyncio.sleep(0.3)
-        return (yield from handler(request))
+        #记下当前请求由哪个handler处理, 慢查询日志里会用到
+        fn = getattr(request.match_info.handler, '_func', None)
+        source = '%s %s' % (request.method, request.path)
+        if fn is not None:
+            source = '%s (%s)' % (fn.__name__, source)
+        token = orm.set_query_source(source)
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.reset_query_source(token)
     return logger
 
+#给每个请求一个期限, 请求里所有的数据库语句都要在期限内完成, 超时的请求返回503
+@asyncio.coroutine
+def deadline_factory(app, handler):
+    timeout = configs.get('request_timeout', None)
+    @asyncio.coroutine
+    def deadline(request):
+        if timeout is None:
+            return (yield from handler(request))
+        token = orm.set_deadline(timeout)
+        try:
+            return (yield from handler(request))
+        except orm.QueryTimeout as e:
+            logging.warning('request timed out: %s %s: %s' % (request.method, request.path, e))
+            return web.Response(status=503, text='Service Unavailable')
+        finally:
+            orm.reset_deadline(token)
+    return deadline
+
+#为每个请求打开orm的identity map, 同一个请求里重复的Model.find(主键)只查一次数据库
+@asyncio.coroutine
+def identity_map_factory(app, handler):
+    @asyncio.coroutine
+    def identity_map(request):
+        token = orm.begin_identity_map()
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.end_identity_map(token)
+    return identity_map
+
 @asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
@@ -90,15 +133,27 @@ def auth_factory(app, handler):
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
-            user = yield from cookie2user(cookie_str)
+            #登录检查走auth这条道, 匿名请求再多也不会排在它后面
+            with orm.lane('auth'):
+                user = yield from cookie2user(cookie_str)
             if user:
                 logging.info('set current user: %s' % user.email)
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (yield from handler(request))
+        #管理员的请求(编辑保存文章等)走admin, 登录注册走auth, 其余的走public
+        if request.__user__ is not None and request.__user__.admin:
+            lane = 'admin'
+        elif (request.method, request.path) in _AUTH_PATHS:
+            lane = 'auth'
+        else:
+            lane = 'public'
+        with orm.lane(lane):
+            return (yield from handler(request))
     return auth
 
+_AUTH_PATHS = (('POST', '/api/authenticate'), ('POST', '/api/users'))
+
 #只有当请求方法为post时这个函数才起作用
 @asyncio.coroutine
 def data_factory(app, handler):
@@ -143,7 +198,7 @@ def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')            # 若不存在对应模板, 则将字典调整为json格式返回, 并设置响应类型为json
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.to_json() if hasattr(o, 'to_json') else o.__dict__).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -190,9 +245,17 @@ def datetime_filter(t):
 def init(loop):
     #创建数据库连接池：
     yield from orm.create_pool(loop=loop, **configs.db)
+    #检查models中声明的索引是否都存在, 缺少时启动失败
+    if configs.db.get('verify_indexes', False):
+        yield from migrate.verify_indexes()
+    if configs.get('search') is not None:
+        yield from search.init(**configs.search)
+    #评论的写后队列, 按blog_id查询等待中的评论
+    if configs.get('comment_queue') is not None:
+        yield from writebehind.start(Comment, key='blog_id', **configs.comment_queue)
     #创建app对象， 同时传入上文定义的拦截器middlewares
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, deadline_factory, identity_map_factory, auth_factory, response_factory
     ])
     #初始化jinja2模板, 并传入时间过滤器
     init_jinja2(app, filters=dict(datetime=datetime_filter))
@@ -216,4 +279,14 @@ loop = asyncio.get_event_loop()
 #之后是执行curoutine
 loop.run_until_complete(init(loop))
 #无限循环运行 直到stop（）
-loop.run_forever()
+#收到SIGTERM或者Ctrl+C时停止, 退出前把写后队列中的数据写完
+try:
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+except NotImplementedError:     #Windows的事件循环不支持
+    pass
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    loop.run_until_complete(writebehind.close_all())
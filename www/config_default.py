@@ -11,11 +11,52 @@ __author__ = 'EveYoung'
 configs = {
     'debug':True,
     'db': {
+        'backend': 'mysql',     #数据库后端: 'mysql', 或者'sqlite'(db是数据库文件, schema设为'schema_sqlite.sql'自动建表)
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': '123456',
-        'db': 'EveYoung'
+        'db': 'EveYoung',
+        'replicas': [],      #只读副本, 例如[{'host': '10.0.0.2'}], 其余参数沿用主库
+        'replica_policy': 'round_robin',
+        'replica_lag': 2,       #写过一张表之后多少秒内, 这张表的读操作走主库
+        'query_cache': None,     #查询缓存, 例如{'maxsize': 1024, 'ttl': 60}, None表示不缓存
+        'batch_find': None,      #合并并发的主键查询, 例如{'window': 0, 'max_size': 100}, None表示不合并
+        'counter_reconcile': 300,       #行数计数器和数据库核对的间隔(秒)
+        'warmup': 5,        #启动时预先建立的连接数
+        'ping_interval': 60,        #空闲连接保活ping的间隔(秒)
+        'pool_recycle': 3600,       #空闲超过这么多秒的连接关掉重连
+        'slow_query': {     #慢查询日志, 超过threshold秒的语句写入file(按大小滚动), None表示不记录
+            'threshold': 0.5,
+            'file': 'slow_query.log'
+        },
+        'lanes': {      #连接池分道: reserved是保留给这条道的连接数, weight是排队时的权重; None表示不分道
+            'auth': {'reserved': 2, 'weight': 4},
+            'admin': {'reserved': 2, 'weight': 4},
+            'public': {'reserved': 0, 'weight': 1}
+        },
+        'default_lane': 'public',
+        #连接数自动调节, 例如{'min_size': 8, 'interval': 5}: 在[min_size, maxsize]之间按等待和延迟增减; None表示固定maxsize个
+        #min_size至少是各道保留的连接数之和再加上min_shared(默认2)个不保留的连接
+        'autotune': None,
+        'query_timeout': 5,     #每条语句默认的超时时间(秒), 超时后取消并KILL QUERY, None表示不限制
+        'verify_indexes': False     #启动时检查models中声明的索引, 缺少则启动失败(用python3 -m www.migrate --apply创建)
+    },
+    'request_timeout': 10,      #一个请求中所有数据库语句的总期限(秒), None表示不限制
+    'metrics_token': None,      #/metrics的采集程序用的token(请求头 Authorization: Bearer <token>), None表示只有管理员能访问
+    'ids': {        #主键生成器, 'snowflake'(bigint)或'legacy'(旧的varchar(50)), 多台服务器时每台设置不同的worker_id
+        'generator': 'snowflake',
+        'worker_id': 0
+    },
+    'search': {     #博客全文搜索, 索引保存在file中, 修改后save_delay秒写入文件, None表示不启用
+        'file': 'search.idx',
+        'save_delay': 5
+    },
+    'comment_queue': {      #评论的写后队列, 攒够max_batch条或每隔interval秒批量写入, 内存中超过max_pending条时写到spill_file; None表示直接写入
+        'max_batch': 200,
+        'interval': 0.5,
+        'max_pending': 10000,
+        'spill_file': 'comments.spill'
     },
     'session': {
         'secret': 'EveYoung'
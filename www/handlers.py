@@ -5,18 +5,23 @@ __author__ = 'EveYoung'
 
 'url handlers'
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, json, logging, hashlib, hmac, base64, asyncio
 
 #mardown2 模块是一个支持markdown文本输入的模块, 是Trent Mick写的开源模块, 我们将其拷贝在本文件夹中, 在这里调用
 from www import markdown2
+from www import metrics
+from www import orm
+from www import search
+from www import writebehind
 
 from aiohttp import web
 
 from www.coroweb import get, post
 
 from www.models import User, Comment, Blog, next_id
+from www.ids import parse_id, legacy_id
 
-from www.apis import Page, APIError, APIValueError,APIPermissionError
+from www.apis import Page, CursorPage, APIError, APIValueError,APIPermissionError, APIResourceNotFoundError
 from www.config import configs
 
 COOKIE_NAME = 'evesession'      #cookie名, 用于设置cookie
@@ -31,6 +36,13 @@ def check_admin(request):
     if request.__user__ is None or not  request.__user__.admin:
         raise APIPermissionError()
 
+#url中的id转换成主键, 格式不对的id对应的资源不可能存在
+def _parse_id(id, name):
+    try:
+        return parse_id(id)
+    except ValueError:
+        raise APIResourceNotFoundError(name)
+
 #day11中定义
 #作用是获取页码
 def get_page_index(page_str):
@@ -62,7 +74,7 @@ def user2cookie(user, max_age):
     #利用用户id, 加密后的密码, 失效时间, 加上cookie秘钥, 组合成待加密的原始字符串
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
     #生成加密的字符串, 并于用户id, 失效时间共同组成cookie
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [str(user.id), expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
 #这个函数在day11中被定义
@@ -88,13 +100,14 @@ def cookie2user(cookie_str):
         return None
     try:
         # 解密是加密的逆向过程, 因此, 先通过"-"拆分cookie, 得到用户id, 失效时间, 以及加密字符串
-        L = cookie_str.split('-')       #返回一个str的list
+        #从右边拆, id本身含有'-'(例如负数)时也能拆对
+        L = cookie_str.rsplit('-', 2)       #返回一个str的list
         if len(L) != 3:     #cookie应该是有三部分组成的, 如果得到的不是三部分, 则显然出错了
             return None
         uid, expires, sha1 = L
         if int(expires) < time.time():      #如果过了失效时间, 则cookie失效了
             return None
-        user = yield from User.find(uid)        #在数据库中查找用户信息
+        user = yield from User.find(parse_id(uid))        #在数据库中查找用户信息
         if user is None:        #如果不存在用户名, 则也出错了
             return None
         #再用sha1处理得到的信息, 与cookie里的sha1对象做对比
@@ -103,10 +116,11 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
-        user.passwd = '******'
         #验证cookie就是为了验证当前用户是否在登录状态, 从而使用户不必再进行登录
         #因此 返回用户信息即可
-        return user
+        #identity map中的对象是同一个请求共享的, 不能改; 返回只读的副本(见orm.Record), 密码打上掩码
+        record = User.__record__
+        return record._from_values(record.__columns__, [('******' if c == 'passwd' else user.get(c)) for c in record.__columns__])
     except Exception as e:
         logging.exception(e)
         return None
@@ -130,8 +144,16 @@ def index(request):
 
 @get('/blog/{id}')
 def get_blog(id):
+    id = _parse_id(id, 'blog')
     blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc', compact=True)
+    #还在写后队列中的评论也要显示, 正在写入的评论可能两边都有
+    q = writebehind.queue(Comment)
+    if q is not None:
+        saved = set(c.id for c in comments)
+        pending = [c for c in q.pending(id) if c.id not in saved]
+        if pending:
+            comments = sorted(pending + comments, key=lambda c: c.created_at, reverse=True)
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.mardown(blog.content)
@@ -250,11 +272,16 @@ def authenticate(*, email, passwd):     #通过邮箱与密码验证登录\
     #以下步骤合成为一步就是: sha1 = hashlib.sha1((user.id+":"+passwd).encode("utf-8"))
     #对照用户注册时对原始密码的操作(见api_register_user), 操作完全一样
     sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
+    sha1.update(str(user.id).encode('utf-8'))
     sha1.update(b':')
     sha1.update(passwd.encode('utf-8'))
     if user.passwd != sha1.hexdigest():
-        raise APIValueError('passwd', 'Invalid password.')
+        #主键迁移之前注册的用户, 密码是用旧id加盐的, 验证通过后改用新id加盐
+        old_id = yield from legacy_id('users', user.id)
+        if old_id is None or user.passwd != hashlib.sha1(('%s:%s' % (old_id, passwd)).encode('utf-8')).hexdigest():
+            raise APIValueError('passwd', 'Invalid password.')
+        user.passwd = sha1.hexdigest()
+        yield from user.update()
     #authenticate ok, set cookie:
     #登录密码验证成功, 设置cookie:
     #与注册用户部分代码完全一样
@@ -278,6 +305,28 @@ def signout(request):
     return r
 
 
+#监控指标, prometheus文本格式
+#里面有所有sql语句和连接池的状态, 只有管理员, 或者带着configs.metrics_token的采集程序(请求头 Authorization: Bearer <token>)可以访问
+@get('/metrics')
+def get_metrics(request):
+    token = configs.get('metrics_token', None)
+    auth = request.headers.get('Authorization', '')
+    if not (token and auth.startswith('Bearer ') and hmac.compare_digest(auth[7:].encode('utf-8'), token.encode('utf-8'))):
+        check_admin(request)
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+#慢查询日志, /manage/下的页面只有管理员能访问(见app.py的auth_factory)
+@get('/manage/slow-queries')
+def manage_slow_queries():
+    log = orm.slow_query_log()
+    return {
+        '__template__': 'manage_slow_queries.html',
+        'threshold': log.threshold if log is not None else None,
+        'entries': list(log.entries) if log is not None else []
+    }
+
+
 @get('/manage/blogs/create')
 def manage_create_blog():
     return {
@@ -289,13 +338,20 @@ def manage_create_blog():
 #取某篇博客
 @get('/api/blogs/{id}')
 def api_get_blog(*, id):
+    id = _parse_id(id, 'blog')
     blog = yield from Blog.find(id)
     return blog
 
+#带cursor参数(包括空的?cursor=)时使用游标分页, 否则按页码分页
 @get('/api/blogs')
-def api_blogs(*, page='1'):
+def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor)
+        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=p.limit, **p.seek)
+        blogs = p.paginate(blogs, lambda b: (b.created_at, b.id))
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
+    num = yield from Blog.findNumber('count(id)', counter=True)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
@@ -303,6 +359,31 @@ def api_blogs(*, page='1'):
     return dict(page=p, blogs=blogs)
 
 
+#搜索博客, 按相关度排序, snippet是正文中包含查询词的一段(已转义, 查询词用<em>标出)
+@get('/api/search')
+def api_search(*, q='', limit='10'):
+    q = q.strip()
+    if not q:
+        raise APIValueError('q', 'query cannot be empty.')
+    try:
+        hits = search.search(q, min(get_page_index(limit), 50))
+    except RuntimeError as e:
+        raise APIError('search:disabled', 'q', str(e))
+    if not hits:
+        return dict(blogs=[])
+    blogs = yield from Blog.findAll('`id` in (%s)' % ', '.join(['?'] * len(hits)), [doc_id for doc_id, score in hits], fields=['user_id', 'user_name', 'user_image', 'name', 'summary', 'content', 'created_at'])
+    blogs = dict((b.id, b) for b in blogs)
+    results = []
+    for doc_id, score in hits:
+        blog = blogs.get(doc_id)
+        if blog is None:
+            continue
+        content = blog.pop('content')
+        blog.score = score
+        blog.snippet = search.snippet(content, q)
+        results.append(blog)
+    return dict(blogs=results)
+
 #创建新博客
 @post('/api/blogs')
 def api_create_blog(request, *, name, summary, content):
@@ -315,17 +396,38 @@ def api_create_blog(request, *, name, summary, content):
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     yield from blog.save()
+    search.index_blog(blog)
     return blog
 
+#发表评论: 启用了写后队列时评论放进队列马上返回, 由队列批量写入数据库
+@post('/api/blogs/{id}/comments')
+def api_create_comment(id, request, *, content):
+    user = request.__user__
+    if user is None:
+        raise APIPermissionError('Please signin first.')
+    if not content or not content.strip():
+        raise APIValueError('content', 'content cannot be empty.')
+    blog = yield from Blog.find(_parse_id(id, 'blog'))
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
+    q = writebehind.queue(Comment)
+    if q is not None:
+        q.add(comment)
+    else:
+        yield from comment.save()
+    return comment
+
 #修改某篇博客
 @post('/api/blogs/{id}')
 def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
-    blog = yield from  Blog.find(id)
+    blog = yield from  Blog.find(_parse_id(id, 'blog'))
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
     yield from blog.update()
+    search.index_blog(blog)
     return blog
 
 
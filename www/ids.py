@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Primary key generators.
+
+The generator is chosen by configs.ids before www.models is imported:
+    'snowflake'  53-bit time ordered integers, stored as BIGINT (default)
+    'legacy'     the old 50-char strings: 15-digit milliseconds + uuid4 hex + '000'
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, time, uuid
+
+from www import orm
+from www.config import configs
+
+#snowflake id的起始时间: 2010-01-01 00:00:00 UTC, 单位毫秒
+#迁移时新id沿用旧id中的时间(见www.migrate), 起始时间必须早于最早的旧id, 否则会得到负数的id; 41位毫秒可以用到2079年
+EPOCH = 1262304000000
+
+#原来的主键: 毫秒时间 + 随机的uuid, 固定50个字符
+class LegacyIdGenerator(object):
+
+    ddl = 'varchar(50)'
+
+    def next_id(self):
+        return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+    def parse(self, s):
+        return s
+
+#snowflake风格的整数主键: | 毫秒时间 | 机器号 | 同一毫秒内的序号 |
+#默认总共53位(41+4+8), 是JavaScript能精确表示的最大整数, 前端拿到的id不会丢失精度
+#41位毫秒可以用69年, 每台机器每毫秒最多256个id, 用完了就借用下一毫秒, 保证单调递增
+class SnowflakeIdGenerator(object):
+
+    ddl = 'bigint'
+
+    def __init__(self, worker_id=0, worker_bits=4, sequence_bits=8, epoch=EPOCH):
+        if not 0 <= worker_id < (1 << worker_bits):
+            raise ValueError('worker_id must be in [0, %s): %s' % (1 << worker_bits, worker_id))
+        self.worker_id = worker_id
+        self.worker_bits = worker_bits
+        self.sequence_bits = sequence_bits
+        self.epoch = epoch
+        self._last = -1     #上一个id用的毫秒
+        self._sequence = 0
+
+    def next_id(self):
+        now = int(time.time() * 1000)
+        #时钟回拨时沿用上一个毫秒, 不会生成更小的id
+        if now <= self._last:
+            now = self._last
+            self._sequence = (self._sequence + 1) & ((1 << self.sequence_bits) - 1)
+            if self._sequence == 0:
+                now = now + 1
+        else:
+            self._sequence = 0
+        self._last = now
+        return self.make(now, self._sequence)
+
+    #用毫秒时间, 序号和机器号拼出id
+    def make(self, millis, sequence, worker_id=None):
+        if millis < self.epoch:
+            raise ValueError('Time %s is before the id epoch %s.' % (millis, self.epoch))
+        if worker_id is None:
+            worker_id = self.worker_id
+        return ((millis - self.epoch) << (self.worker_bits + self.sequence_bits)) | (worker_id << self.sequence_bits) | sequence
+
+    #id中的时间, 单位秒
+    def timestamp(self, id):
+        return ((id >> (self.worker_bits + self.sequence_bits)) + self.epoch) / 1000.0
+
+    #url和cookie中的id是字符串, 转回整数; 格式不对时抛出ValueError
+    def parse(self, s):
+        return int(s)
+
+GENERATORS = {
+    'legacy': LegacyIdGenerator,
+    'snowflake': SnowflakeIdGenerator
+}
+
+#根据配置创建生成器, 例如{'generator': 'snowflake', 'worker_id': 1}
+def create_generator(conf):
+    kw = dict(conf)
+    kind = kw.pop('generator', 'snowflake')
+    if kind not in GENERATORS:
+        raise ValueError('Unknown id generator: %s' % kind)
+    return GENERATORS[kind](**kw)
+
+generator = create_generator(configs.get('ids', {}))
+
+#替换生成器, 必须在导入www.models之前调用, IdField的列类型在定义Model时就确定了
+def set_generator(g):
+    global generator
+    generator = g
+
+#生成一个新的主键
+def next_id():
+    return generator.next_id()
+
+def parse_id(s):
+    return generator.parse(s)
+
+#主键以及引用其他表主键的列, 列类型跟随生成器
+#ref是引用的表名, 迁移主键时用来同步更新引用
+class IdField(orm.Field):
+
+    def __init__(self, name=None, primary_key=False, ref=None):
+        super().__init__(name, generator.ddl, primary_key, next_id if primary_key else None)
+        self.ref = ref
+
+#迁移主键之前的旧id, 没有迁移过的行返回None(legacy_ids表见www.migrate)
+@asyncio.coroutine
+def legacy_id(table, new_id):
+    rs = yield from orm.select('select `old_id` from `legacy_ids` where `table_name`=? and `new_id`=?', [table, new_id], 1)
+    if len(rs) == 0:
+        return None
+    return rs[0]['old_id']
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Simple metrics in prometheus text format.
+'''
+
+__author__ = 'EveYoung'
+
+import time
+
+#直方图默认的桶(单位是秒), 从1毫秒到10秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#所有注册过的指标, render()按注册顺序输出
+_registry = []
+
+#prometheus要求标签值中的\, "和换行都要转义
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return repr(v) if isinstance(v, float) else str(v)
+
+#指标的基类, 一个指标有名字, 说明和一组标签名, 每组标签值对应一个值
+class Metric(object):
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        _registry.append(self)
+
+    def _check(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' % (self.name, self.labelnames, labelvalues))
+        return tuple(labelvalues)
+
+    def samples(self):
+        for labelvalues, v in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labelnames, labelvalues), v
+
+    def render(self):
+        L = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, v in self.samples():
+            L.append('%s%s %s' % (name, labels, _format_value(v)))
+        return '\n'.join(L)
+
+#只增不减的计数器
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._check(labelvalues)
+        self._values[key] = self._values.get(key, 0) + amount
+
+#可以任意设置的值; 也可以用set_function()在输出时才计算
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self._function = None
+
+    def set(self, value, *labelvalues):
+        self._values[self._check(labelvalues)] = value
+
+    #fn返回[(标签值tuple, 值), ...]
+    def set_function(self, fn):
+        self._function = fn
+
+    def samples(self):
+        if self._function is not None:
+            self._values = dict((self._check(labelvalues), v) for labelvalues, v in self._function())
+        return super(Gauge, self).samples()
+
+#直方图: 记录每个值落在哪个桶, 以及总和与次数
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, *labelvalues):
+        key = self._check(labelvalues)
+        h = self._values.get(key)
+        if h is None:
+            #每个桶的计数(非累计), 总和, 次数
+            h = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                h[0][i] += 1
+                break
+        h[1] += value
+        h[2] += 1
+
+    #开始计时, 返回的函数调用时记录经过的时间
+    def timer(self, *labelvalues):
+        start = time.time()
+        return lambda: self.observe(time.time() - start, *labelvalues)
+
+    def samples(self):
+        for labelvalues, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                yield self.name + '_bucket', _format_labels(self.labelnames, labelvalues, [('le', _format_value(float(bound)))]), cumulative
+            yield self.name + '_sum', _format_labels(self.labelnames, labelvalues), total
+            yield self.name + '_count', _format_labels(self.labelnames, labelvalues), count
+
+#所有指标的prometheus文本格式
+def render():
+    return '\n'.join(m.render() for m in _registry) + '\n'
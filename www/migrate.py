@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Compare the indexes declared on models with the live schema.
+
+Usage:
+    python3 -m www.migrate                print the DDL for missing indexes
+    python3 -m www.migrate --apply        also execute it
+    python3 -m www.migrate --ids          print the plan for moving varchar(50) ids to snowflake ids
+    python3 -m www.migrate --ids --apply  also execute it (stop writes and back up first)
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, logging, sys
+
+from www import orm, models, ids
+from www.config import configs
+
+#www.models中定义的所有Model
+def all_models():
+    return [m for m in vars(models).values() if isinstance(m, type) and issubclass(m, orm.Model) and m is not orm.Model]
+
+#数据库中一张表实际的索引: 索引名 ==> (是否unique, 列名tuple)
+@asyncio.coroutine
+def live_indexes(table):
+    rs = yield from orm.select('select index_name as name, non_unique as non_unique, column_name as col from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', [table])
+    indexes = dict()
+    for r in rs:
+        unique, columns = indexes.get(r['name'], (not r['non_unique'], ()))
+        indexes[r['name']] = (unique, columns + (r['col'],))
+    return indexes
+
+#添加索引的DDL, 使用InnoDB的online DDL, 建索引期间不锁表
+def index_ddl(model, index):
+    return 'alter table `%s` add %sindex `%s` (%s), algorithm=inplace, lock=none' % (model.__table__, 'unique ' if index.unique else '', index.name, ', '.join('`%s`' % c for c in index.columns))
+
+#实际的索引能不能满足声明: 列完全一样, 声明了unique的话实际的也必须是unique
+def _satisfied(index, live):
+    for unique, columns in live.values():
+        if columns == index.columns and (unique or not index.unique):
+            return True
+    return False
+
+#所有缺少的索引, 返回[(model, index, ddl), ...]
+@asyncio.coroutine
+def diff(model_list=None):
+    missing = []
+    for model in (model_list or all_models()):
+        live = yield from live_indexes(model.__table__)
+        for index in model.__indexes__:
+            if not _satisfied(index, live):
+                missing.append((model, index, index_ddl(model, index)))
+    return missing
+
+#启动时检查, 有缺少的索引就报错, 不让服务器启动
+@asyncio.coroutine
+def verify_indexes(model_list=None):
+    missing = yield from diff(model_list)
+    if missing:
+        raise RuntimeError('Missing indexes, run "python3 -m www.migrate --apply":\n%s' % '\n'.join('%s;' % ddl for model, index, ddl in missing))
+    logging.info('all declared indexes exist.')
+
+#打印缺少的索引的DDL, apply为True时执行
+@asyncio.coroutine
+def migrate(apply=False):
+    missing = yield from diff()
+    if not missing:
+        print('-- all declared indexes exist.')
+    for model, index, ddl in missing:
+        print('%s;' % ddl)
+        if apply:
+            yield from orm.execute(ddl, [])
+            logging.info('created %s on %s' % (index, model.__table__))
+    return missing
+
+#==============================主键迁移==============================
+#旧的主键是50个字符的字符串(15位毫秒时间+uuid), 换成snowflake生成的bigint:
+#  1. 按旧id的顺序(以毫秒时间开头, 也就是创建顺序)给每一行分配新id, 新id中的时间就是旧id中的时间, 记在legacy_ids中
+#  2. 用legacy_ids把主键以及引用它的列(IdField的ref)改成新id
+#  3. 把这些列改成bigint, 主键和索引都保留
+#旧用户的密码是用旧id加盐的, handlers.authenticate通过legacy_ids验证, 然后用新id重新加盐
+LEGACY_IDS_DDL = 'create table if not exists `legacy_ids` (`table_name` varchar(50) not null, `old_id` varchar(50) not null, `new_id` bigint not null, key `idx_new_id` (`table_name`, `new_id`), primary key (`table_name`, `old_id`)) engine=innodb default charset=utf8'
+
+#Model中的IdField: [(列名, 引用的表名), ...], 主键引用的是自己的表
+def id_columns(model):
+    columns = []
+    for k, f in model.__mappings__.items():
+        if isinstance(f, ids.IdField):
+            columns.append((k, model.__table__ if f.primary_key else f.ref))
+    return columns
+
+#给一张表中还是旧id的行分配新id, 返回[(表名, 旧id, 新id), ...]
+@asyncio.coroutine
+def assign_ids(model, generator):
+    pk = model.__primary_key__
+    rs = yield from orm.select('select `%s` as old_id from `%s` where char_length(`%s`)=50 order by `%s`' % (pk, model.__table__, pk, pk), [])
+    return [(model.__table__, old_id, new_id) for old_id, new_id in new_ids([r['old_id'] for r in rs], generator)]
+
+#按顺序给旧id(已经排好序)分配新id, 返回[(旧id, 新id), ...]
+def new_ids(old_ids, generator):
+    #新id中的时间就是旧id中的时间, 比起始时间早的话会得到负数的id, 在写入任何数据之前就停下来
+    if old_ids and int(old_ids[0][:15]) < generator.epoch:
+        raise RuntimeError('Legacy id %s is older than the id epoch %s, set an earlier epoch in configs.ids.' % (old_ids[0], generator.epoch))
+    rows = []
+    last, sequence = -1, 0
+    for old_id in old_ids:
+        millis = int(old_id[:15])
+        #同一毫秒内的行按顺序编号, 编号用完了借用下一毫秒
+        if millis <= last:
+            millis = last
+            sequence = sequence + 1
+            if sequence >> generator.sequence_bits:
+                millis, sequence = millis + 1, 0
+        else:
+            sequence = 0
+        last = millis
+        rows.append((old_id, generator.make(millis, sequence)))
+    return rows
+
+#把旧id替换为新id的语句, 以及把列改成bigint的DDL
+def id_migration_sql(model):
+    columns = id_columns(model)
+    updates = ["update `%s` t join `legacy_ids` m on m.table_name='%s' and m.old_id=t.`%s` set t.`%s`=m.new_id" % (model.__table__, ref, c, c) for c, ref in columns]
+    ddl = 'alter table `%s` %s' % (model.__table__, ', '.join('modify `%s` bigint not null' % c for c, ref in columns))
+    return updates, ddl
+
+@asyncio.coroutine
+def migrate_ids(apply=False):
+    generator = ids.generator
+    if not isinstance(generator, ids.SnowflakeIdGenerator):
+        raise RuntimeError('Set configs.ids generator to "snowflake" before migrating ids.')
+    model_list = [m for m in all_models() if id_columns(m)]
+    print('%s;' % LEGACY_IDS_DDL)
+    if apply:
+        yield from orm.execute(LEGACY_IDS_DDL, [])
+    #先给所有表分配新id, 再统一替换, 引用其他表的列才能在legacy_ids中找到对应关系
+    #所有表的新id都算好了再写入, 有一张表的旧id早于起始时间的话什么也不写
+    assigned = []
+    for model in model_list:
+        if apply:
+            assigned.append((model, (yield from assign_ids(model, generator))))
+        else:
+            print('-- assign new ids for %s' % model.__table__)
+    for model, rows in assigned:
+        yield from orm.execute_many('insert ignore into `legacy_ids` (`table_name`, `old_id`, `new_id`) values (?, ?, ?)', rows)
+        logging.info('assigned %s new ids for %s' % (len(rows), model.__table__))
+    for model in model_list:
+        updates, ddl = id_migration_sql(model)
+        for sql in updates + [ddl]:
+            print('%s;' % sql)
+            if apply:
+                yield from orm.execute(sql, [])
+
+@asyncio.coroutine
+def main(loop, apply, migrate_id=False):
+    #一次性的命令, 不需要预热连接和后台任务; 建索引/改列类型可能很慢, 不设超时
+    conf = dict(configs.db, warmup=0, ping_interval=None, counter_reconcile=None, query_timeout=None)
+    #SQLite的表和索引由schema_sqlite.sql创建
+    if conf.get('backend', 'mysql') != 'mysql':
+        raise RuntimeError('www.migrate only supports the mysql backend.')
+    yield from orm.create_pool(loop=loop, **conf)
+    if migrate_id:
+        yield from migrate_ids(apply)
+    else:
+        yield from migrate(apply)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, '--apply' in sys.argv[1:], '--ids' in sys.argv[1:]))
+    loop.close()
@@ -3,100 +3,1323 @@
 
 __author__ = 'EveYoung'
 
-import  asyncio,logging
-# aiomysql是Mysql的python异步驱动程序, 操作数据库要用到
-import aiomysql
+import  asyncio,logging,time,contextvars,re,hashlib
+import logging.handlers
+from collections import deque
+from collections import OrderedDict
+# aiomysql是Mysql的python异步驱动程序, 操作数据库要用到; 只用SQLite后端时可以不装
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+from www import metrics, sqlite
 
 #这个函数的作用是输出信息, 让你知道这个时间点程序在做什么
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
+#==================================语句编译缓存区============================================================
+# 同一种形状的sql(同一个Model, 同样的where/orderBy/limit)在每次请求中都会重复拼接, 重复把?替换成%s
+# 这里把每个不同的sql编译成一个Statement对象并缓存起来, 之后的调用直接复用, 不再做字符串处理
+
+# 编译后的语句对象: sql是原始的?占位符形式(用于日志), operation是驱动需要的%s占位符形式
+# findNumber中能用计数器回答的where: 只有一个 列=? 的条件
+_RE_COUNT_WHERE = re.compile(r'^\s*`?(\w+)`?\s*=\s*\?\s*$')
+
+# tables是语句涉及的表名, 查询缓存用它给结果打标签, 写操作用它找到需要失效的缓存
+# from/join/into/update后面到下一个子句为止是表的列表, 可能是逗号分隔的多张表(from a, b), 每张表可以带别名
+_RE_TABLE_LIST = re.compile(r'\b(?:from|join|into|update)\s+(.*?)(?=\b(?:where|join|on|using|set|group|order|limit|having|union|values|value|select|left|right|inner|outer|cross|natural|straight_join|for|lock|window)\b|[();=]|$)', re.IGNORECASE | re.DOTALL)
+_RE_TABLE_NAME = re.compile(r'^(?:`?\w+`?\.)?`?(\w+)`?(?:\s+(?:as\s+)?`?\w+`?)?$', re.IGNORECASE)
+
+# 返回(表名的frozenset, 是否完整): 有认不出来的表时不完整, 这样的语句不缓存, 写操作让整个缓存失效
+def _parse_tables(sql):
+    tables = set()
+    complete = True
+    for m in _RE_TABLE_LIST.finditer(sql):
+        #from后面直接是子查询, 子查询里面的表另外匹配
+        if not m.group(1).strip():
+            continue
+        for part in m.group(1).split(','):
+            name = _RE_TABLE_NAME.match(part.strip())
+            if name is None:
+                complete = False
+            else:
+                tables.add(name.group(1).lower())
+    return frozenset(tables), complete
+
+class Statement(object):
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.operation = sql.replace('?', '%s')
+        self.tables, self.complete = _parse_tables(sql)
+        self.columns = None     #结果的列名(按位置), 由拼接语句的Model填写, 用于把tuple行直接转成对象
+
+    def __str__(self):
+        return self.sql
+
+    __repr__ = __str__
+
+# 原始sql字符串 ==> Statement的缓存, 超过上限时整体清空, 避免动态拼接的sql让缓存无限增长
+_STATEMENT_CACHE_SIZE = 1024
+_statements = dict()
+
+# 把sql编译为Statement, 已经是Statement的直接返回
+def compile_sql(sql):
+    if isinstance(sql, Statement):
+        return sql
+    stmt = _statements.get(sql)
+    if stmt is None:
+        if len(_statements) >= _STATEMENT_CACHE_SIZE:
+            _statements.clear()
+        stmt = _statements[sql] = Statement(sql)
+    return stmt
+
+#==================================查询结果缓存区============================================================
+# 博客是读多写少的, 大部分查询的结果可以直接从内存返回
+# key是编译后的sql + 参数, 结果按表打标签; 对某张表执行写操作(execute)时, 这张表的所有缓存立即失效
+# 缓存只在当前进程内有效, 多个进程/机器之间靠ttl兜底
+
+class QueryCache(object):
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()     #key ==> (过期时间, 表名, 结果), 按最近使用排序, 实现LRU
+        self._keys = dict()     #表名 ==> 这张表相关的key集合
+        self._versions = dict()     #表名 ==> 版本号, 每次失效加一
+        self._generation = 0    #整个缓存的版本号, 每次clear加一
+
+    #查询开始前记下相关表的版本号, 查询期间表被写过的话结果就不再放进缓存
+    def versions(self, tables):
+        return (self._generation,) + tuple(self._versions.get(t, 0) for t in sorted(tables))
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, key, tables, versions, rs):
+        if versions != self.versions(tables):
+            return
+        if key in self._entries:
+            self._discard(key)
+        self._entries[key] = (time.time() + self.ttl, tables, rs)
+        for t in tables:
+            self._keys.setdefault(t, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            self._discard(next(iter(self._entries)))
+
+    def invalidate(self, tables):
+        for t in tables:
+            self._versions[t] = self._versions.get(t, 0) + 1
+            for key in self._keys.pop(t, ()):
+                self._discard(key)
+
+    def clear(self):
+        self._generation = self._generation + 1
+        for t in list(self._keys):
+            self.invalidate([t])
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for t in entry[1]:
+                keys = self._keys.get(t)
+                if keys is not None:
+                    keys.discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+#全局的查询缓存, 默认关闭, 在create_pool中通过query_cache=dict(maxsize=..., ttl=...)打开
+__cache = None
+
+def query_cache():
+    return __cache
+
+#主库的连接池(类里面不能直接写__pool, 会被改名成_类名__pool)
+def _primary_pool():
+    return __pool
+
 # 创建全局连接池
 # 这个函数将来会在app.py的init函数中引用
 # 我们需要创建一个全局的连接池，每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用。
 #
 # 连接池由全局变量__pool存储，缺省情况下将编码设置为utf8，自动提交事务：
 
+__pool = None
+
 @asyncio.coroutine
 def create_pool(loop, **kw):
     logging.info('create database connection pool...')
     #声明变量__pool是一个全局变量, 如果不加声明, __pool就会被默认为是一个私有变量. 不能被其他函数引用
-    global __pool
+    global __pool, __replicas, __replica_policy, __replica_retry, __replica_lag, __cache, __batch_find, __slow_log, __query_timeout, _backend
+    #数据库后端, 见数据库后端区
+    backend = kw.pop('backend', 'mysql')
+    if backend not in BACKENDS:
+        raise ValueError('Unknown database backend: %s' % backend)
+    _backend = BACKENDS[backend]()
+    #每条语句默认的超时时间(秒), None表示不限制
+    __query_timeout = kw.pop('query_timeout', None)
+    #慢查询日志的配置, 例如dict(threshold=0.5, file='slow_query.log'), 不配置则不记录
+    slow = kw.pop('slow_query', None)
+    __slow_log = SlowQueryLog(**slow) if slow is not None else None
+    #Model.find批量合并的配置, 例如dict(window=0, max_size=100), 不配置则不合并
+    __batch_find = kw.pop('batch_find', None)
+    _loaders.clear()
+    #行数计数器和数据库核对的间隔(秒), None表示不核对
+    reconcile = kw.pop('counter_reconcile', 300)
+    _counters.clear()
+    if reconcile:
+        asyncio.ensure_future(_reconcile_forever(reconcile))
+    #查询缓存的配置, 例如dict(maxsize=1024, ttl=60), 不配置则不缓存
+    cache = kw.pop('query_cache', None)
+    __cache = QueryCache(**cache) if cache is not None else None
+    #只读副本的配置, 是一个dict的list, 没写的参数(user, password, db等)沿用主库的配置
+    replicas = kw.pop('replicas', None) or []
+    #副本的选择策略: round_robin(轮询) 或 least_busy(选正在使用的连接最少的那个)
+    __replica_policy = kw.pop('replica_policy', 'round_robin')
+    if __replica_policy not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica policy: %s' % __replica_policy)
+    #副本出错后, 隔多少秒再重新尝试使用它
+    __replica_retry = kw.pop('replica_retry', 30)
+    #写过一张表之后多少秒内, 这张表的读操作走主库(副本可能还没同步, 查到的旧数据还会被放进查询缓存)
+    __replica_lag = kw.pop('replica_lag', 2)
+    _written.clear()
     #调用一个协程来创建全局连接池, create_pool的返回值是一个pool实例对象
-    __pool = yield from aiomysql.create_pool(
-        #下面就是创建数据库链接需要用到的一些参数, 从**kw(关键字参数)中取出来
-        #kw.get的作用应该是, 当没有传入参数时, 默认参数就是get函数的第二项
-        host=kw.get('host', 'localhost'),   #数据库服务器位置, 默认设在本地
-        port=kw.get('port', 3306),  #MySQL的端口, 默认为3306
-        user=kw['user'],    #登录用户名, 通过关键参数词传进来
-        password=kw['password'],    #登录密码, 通过关键词参数传进来
-        db=kw['db'],    #当前数据库名
-        charset=kw.get('charset', 'utf8'),  #设置 编码格式, 默认为utf-8
-        autocommit=kw.get('autocommit', True),  #自动提交模式, 设置默认开启
-        maxsize=kw.get('maxsize', 10),  #最大连接数, 默认设为10
-        minsize=kw.get('minsize', 1),   #最小连接数, 默认设为1, 这样可以保证任何时候都会有一个数据库连接
-        loop=loop   #传递消息循环对象, 用于异步执行
-    )
+    #启动时预先建立的连接数, 让部署后的第一波请求不用在请求路径上建连接
+    warmup = kw.pop('warmup', 0)
+    #后台对空闲连接发ping的间隔(秒), 及时发现并丢掉断开的连接, None表示不ping
+    ping_interval = kw.pop('ping_interval', None)
+    #连接池分道, 例如{'auth': {'reserved': 2, 'weight': 4}, 'public': {'weight': 1}}, None表示不分道
+    lanes = kw.pop('lanes', None)
+    default_lane = kw.pop('default_lane', 'public')
+    #连接数自动调节, 例如{'min_size': 2, 'interval': 5}, None表示固定使用maxsize个连接
+    autotune = kw.pop('autotune', None)
+    __pool = yield from _backend.create_pool(loop, **kw)
+    __replicas = []
+    for r in replicas:
+        conf = dict(kw)
+        conf.update(r)
+        logging.info('create replica connection pool: %s:%s' % (conf.get('host', 'localhost'), conf.get('port', 3306)))
+        __replicas.append(_Replica((yield from _backend.create_pool(loop, **conf))))
+    pools = [__pool] + [r.pool for r in __replicas]
+    _lanes.clear()
+    #自动调节通过许可数限制连接数, 没有分道时所有请求在同一条道上
+    if lanes or autotune is not None:
+        for pool in pools:
+            _lanes[pool] = _Lanes(pool, lanes or {default_lane: {}}, default_lane)
+    if autotune is not None:
+        for l in _lanes.values():
+            asyncio.ensure_future(_autotune_forever(_PoolTuner(l, **autotune)))
+    if warmup:
+        for pool in pools:
+            yield from _warm_up(pool, warmup)
+    if ping_interval:
+        asyncio.ensure_future(_keep_alive(pools, ping_interval))
+
+#==================================数据库后端区============================================================
+# 默认用aiomysql连MySQL; create_pool(backend='sqlite', db='blog.db')换成www.sqlite, 单机的小站点省掉到MySQL的网络开销, 测试和压测也可以用
+# 后端提供:
+#   create_pool(loop, **kw)     创建连接池, 连接池/连接/游标的方法和aiomysql一样, 语句的占位符是%s
+#   Cursor, DictCursor, SSCursor, SSDictCursor      游标类型
+#   Error, OperationalError     驱动的异常
+#   is_disconnect(e)    连接层面的错误, 换一个连接重试是安全的
+#   abort(conn)     语句超时后关掉连接, 并停止数据库中还在执行的语句
+#   explain     查看执行计划的语句前缀
+
+_backend = None
+
+class MySQLBackend(object):
+
+    explain = 'EXPLAIN '
+
+    def __init__(self):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is not installed.')
+        self.Cursor, self.DictCursor = aiomysql.Cursor, aiomysql.DictCursor
+        self.SSCursor, self.SSDictCursor = aiomysql.SSCursor, aiomysql.SSDictCursor
+        self.Error, self.OperationalError = aiomysql.Error, aiomysql.OperationalError
+        #(host, port) ==> 连接参数, 执行KILL QUERY时用
+        self.kill_conf = dict()
+
+    def create_pool(self, loop, **kw):
+        #记下连接参数, 超时后另开连接执行KILL QUERY
+        self.kill_conf[(kw.get('host', 'localhost'), kw.get('port', 3306))] = dict(user=kw['user'], password=kw['password'], db=kw['db'], charset=kw.get('charset', 'utf8'), loop=loop)
+        return aiomysql.create_pool(
+            #下面就是创建数据库链接需要用到的一些参数, 从**kw(关键字参数)中取出来
+            #kw.get的作用应该是, 当没有传入参数时, 默认参数就是get函数的第二项
+            host=kw.get('host', 'localhost'),   #数据库服务器位置, 默认设在本地
+            port=kw.get('port', 3306),  #MySQL的端口, 默认为3306
+            user=kw['user'],    #登录用户名, 通过关键参数词传进来
+            password=kw['password'],    #登录密码, 通过关键词参数传进来
+            db=kw['db'],    #当前数据库名
+            charset=kw.get('charset', 'utf8'),  #设置 编码格式, 默认为utf-8
+            autocommit=kw.get('autocommit', True),  #自动提交模式, 设置默认开启
+            maxsize=kw.get('maxsize', 10),  #最大连接数, 默认设为10
+            minsize=kw.get('minsize', 1),   #最小连接数, 默认设为1, 这样可以保证任何时候都会有一个数据库连接
+            pool_recycle=kw.get('pool_recycle', -1),     #连接空闲超过这么多秒就关掉重连, 默认-1不回收
+            loop=loop   #传递消息循环对象, 用于异步执行
+        )
+
+    def is_disconnect(self, e):
+        return isinstance(e, aiomysql.OperationalError) and bool(e.args) and e.args[0] in _DISCONNECT_ERRORS
+
+    #连接的状态不确定所以直接关掉(连接池会丢弃关闭的连接), 服务器上还在执行的语句在后台另开一个连接用KILL QUERY杀掉
+    def abort(self, conn):
+        thread_id = conn.thread_id()
+        conn.close()
+        asyncio.ensure_future(self._kill_query(conn.host, conn.port, thread_id))
+
+    @asyncio.coroutine
+    def _kill_query(self, host, port, thread_id):
+        try:
+            conn = yield from aiomysql.connect(host=host, port=port, **self.kill_conf[(host, port)])
+            try:
+                cur = yield from conn.cursor()
+                yield from cur.execute('KILL QUERY %d' % thread_id)
+                yield from cur.close()
+            finally:
+                conn.close()
+            logging.warning('killed query on %s:%s, thread id: %s' % (host, port, thread_id))
+        except Exception as e:
+            logging.warning('failed to kill query on %s:%s, thread id: %s: %s' % (host, port, thread_id, e))
+
+#SQLite: db是数据库文件, schema是建表的sql文件(见schema_sqlite.sql), timeout是等待写锁的秒数
+#主机, 用户名, 密码等MySQL的参数忽略掉, 这样切换后端只需要改backend和db
+class SQLiteBackend(object):
+
+    explain = 'EXPLAIN QUERY PLAN '
+    Cursor, DictCursor = sqlite.Cursor, sqlite.DictCursor
+    SSCursor, SSDictCursor = sqlite.SSCursor, sqlite.SSDictCursor
+    Error, OperationalError = sqlite.Error, sqlite.OperationalError
+
+    def create_pool(self, loop, **kw):
+        return sqlite.create_pool(kw['db'], minsize=kw.get('minsize', 1), maxsize=kw.get('maxsize', 10), timeout=kw.get('timeout', 5), schema=kw.get('schema', None), loop=loop)
+
+    #本地文件, 没有断线这回事
+    def is_disconnect(self, e):
+        return False
+
+    #interrupt()打断连接的线程中正在执行的语句, 然后关掉连接
+    def abort(self, conn):
+        conn.interrupt()
+        conn.close()
+
+BACKENDS = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend
+}
+
+#==================================连接健康区============================================================
+# 预热: 同时取出n个连接再还回去, 连接池里就有n个建好的空闲连接
+@asyncio.coroutine
+def _warm_up(pool, n):
+    n = min(n, pool.maxsize)
+    conns = []
+    try:
+        for i in range(n):
+            conns.append((yield from pool.acquire()))
+    finally:
+        for conn in conns:
+            yield from pool.release(conn)
+    logging.info('pool %s warmed up: %s connections' % (_pool_name(pool), pool.size))
+
+# 保活: 每隔interval秒把空闲连接逐个取出来ping一次, ping不通的关掉, 连接池会丢掉关闭的连接
+@asyncio.coroutine
+def _keep_alive(pools, interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        for pool in pools:
+            try:
+                for i in range(pool.freesize):
+                    conn = yield from pool.acquire()
+                    try:
+                        yield from conn.ping(False)
+                    except Exception as e:
+                        logging.warning('close dead connection in pool %s: %s' % (_pool_name(pool), e))
+                        conn.close()
+                    finally:
+                        yield from pool.release(conn)
+            except Exception as e:
+                logging.exception(e)
+
+# 连接层面的错误(连接断开, 连不上), 重新取一个连接再执行是安全的
+# 2003: Can't connect, 2006: MySQL server has gone away, 2013: Lost connection, 2055: Lost connection (system error)
+_DISCONNECT_ERRORS = (2003, 2006, 2013, 2055)
+
+def _is_disconnect(e):
+    return _backend.is_disconnect(e)
+
+#==================================读写分离区============================================================
+# select走只读副本, execute走主库; 副本连不上时标记为不可用, 这段时间内的读请求回到主库
+
+__replicas = []
+__replica_policy = 'round_robin'
+__replica_retry = 30
+__replica_lag = 2
+__replica_next = 0
+#表名 ==> 最后一次写的时间
+_written = dict()
+
+class _Replica(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.down_until = 0     #在这个时间点之前不使用这个副本
+
+    def available(self):
+        return self.down_until <= time.time()
+
+    #正在使用的连接数
+    def busy(self):
+        return self.pool.size - self.pool.freesize
+
+#为一次读操作选择连接池, 没有可用的副本时返回主库的连接池
+def _read_pool():
+    global __replica_next
+    replicas = [r for r in __replicas if r.available()]
+    if not replicas:
+        return __pool
+    if __replica_policy == 'least_busy':
+        return min(replicas, key=lambda r: r.busy()).pool
+    __replica_next = (__replica_next + 1) % len(replicas)
+    return replicas[__replica_next].pool
+
+#记下写过的表, replica_lag秒内这些表的读操作走主库
+def _mark_written(tables):
+    now = time.time()
+    for t in tables:
+        _written[t] = now
+
+#语句涉及的表最近有没有写过
+def _recently_written(tables):
+    since = time.time() - __replica_lag
+    return any(_written.get(t, 0) > since for t in tables)
+
+#副本出错, 在replica_retry秒内不再使用它
+def _mark_down(pool, e):
+    for r in __replicas:
+        if r.pool is pool:
+            logging.warning('replica down, fall back to primary for %ss: %s' % (__replica_retry, e))
+            r.down_until = time.time() + __replica_retry
+
+#==================================监控指标区============================================================
+# 连接池等待时间, 连接使用情况, 每种语句的耗时/返回行数/错误数, 由handlers中的/metrics以prometheus格式输出
+
+_POOL_WAIT = metrics.Histogram('db_pool_acquire_seconds', 'Time spent waiting for a pool connection.', ('pool',))
+_POOL_CONNECTIONS = metrics.Gauge('db_pool_connections', 'Pool connections by state.', ('pool', 'state'))
+_QUERY_SECONDS = metrics.Histogram('db_query_seconds', 'Query latency by statement.', ('statement',))
+_QUERY_ROWS = metrics.Counter('db_query_rows_total', 'Rows returned or affected by statement.', ('statement',))
+_QUERY_ERRORS = metrics.Counter('db_query_errors_total', 'Failed queries by statement and error.', ('statement', 'error'))
+
+#连接池的名字, 用作指标的标签
+def _pool_name(pool):
+    if pool is __pool:
+        return 'primary'
+    for i, r in enumerate(__replicas):
+        if r.pool is pool:
+            return 'replica%s' % i
+    return 'unknown'
+
+def _pool_connections():
+    pools = ([__pool] if __pool is not None else []) + [r.pool for r in __replicas]
+    for pool in pools:
+        name = _pool_name(pool)
+        yield (name, 'in_use'), pool.size - pool.freesize
+        yield (name, 'free'), pool.freesize
+        yield (name, 'max'), pool.maxsize
+
+_POOL_CONNECTIONS.set_function(_pool_connections)
+
+#从连接池获取连接, 同时记录等待的时间, 用法和原来一样: with (yield from _acquire(pool)) as conn
+#在transaction()里面时, 直接使用事务占用的那个连接; 启用了分道时先在当前的道上排队
+#排队和等连接的时间都不超过语句的期限(timeout的含义见超时区)
+@asyncio.coroutine
+def _acquire(pool, measure=True, timeout=None):
+    tx = _transaction.get()
+    if tx is not None:
+        return _Pinned(tx.conn)
+    lanes = _lanes.get(pool)
+    lane = None
+    if lanes is not None:
+        lane = yield from lanes.acquire(_lane.get(), timeout)
+    start = time.time()
+    try:
+        cm = yield from _wait_pool(pool, _timeout_for(timeout))
+    except BaseException:
+        if lanes is not None:
+            lanes.release(lane)
+        raise
+    _POOL_WAIT.observe(time.time() - start, _pool_name(pool))
+    if lanes is not None:
+        return _LaneContext(cm, lanes, lane, measure)
+    return cm
+
+@asyncio.coroutine
+def _pool_connection(pool):
+    return (yield from pool)
+
+#最多等timeout秒从连接池拿到连接; 超时的同时刚好拿到了连接, 还回去
+#有空闲连接时不用等, 直接拿, 不为每条语句另建task
+@asyncio.coroutine
+def _wait_pool(pool, timeout):
+    if timeout is None or pool.freesize:
+        return (yield from pool)
+    fut = asyncio.ensure_future(_pool_connection(pool))
+    try:
+        return (yield from asyncio.wait_for(asyncio.shield(fut), timeout))
+    except BaseException as e:
+        fut.cancel()
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception() is not None or f.result().__exit__(None, None, None))
+        if isinstance(e, asyncio.TimeoutError):
+            raise QueryTimeout('timed out waiting for a connection')
+        raise
+
+#记录一次语句执行的耗时和行数, 出错时记录错误类型, 超过阈值的记入慢查询日志
+def _observe(stmt, start, args, rows=0, error=None, slow=True):
+    elapsed = time.time() - start
+    _QUERY_SECONDS.observe(elapsed, stmt.sql)
+    if error is not None:
+        _QUERY_ERRORS.inc(stmt.sql, error.__class__.__name__)
+    elif rows > 0:
+        _QUERY_ROWS.inc(stmt.sql, amount=rows)
+    if slow and __slow_log is not None and elapsed >= __slow_log.threshold:
+        __slow_log.record(stmt, args, elapsed, rows, error)
+
+#==================================连接池分道区============================================================
+# 公开页面的读, auth_factory里cookie2user的查询, 管理员的写都在同一个连接池里先到先得
+# 匿名请求很多的时候, 登录检查和编辑保存文章也要排在后面
+# 分道之后每个请求属于一条道(lane), 取连接前先在自己的道上拿许可, 许可总数等于连接池的maxsize:
+#   reserved: 给这条道保留的许可数, 其他道不能占用, 保证这条道总能拿到连接
+#   weight: 有多条道在排队时按权重公平地分配(加权公平排队), 权重4的道拿到的许可是权重1的道的4倍
+# 当前的道保存在contextvar中, 由app.py的中间件设置, 也可以用 with orm.lane('admin'): 临时切换
+
+_lanes = dict()     #连接池 ==> _Lanes
+_lane = contextvars.ContextVar('lane', default=None)
+
+_LANE_WAIT = metrics.Histogram('db_lane_wait_seconds', 'Time spent queued in a pool lane.', ('pool', 'lane'))
+_LANE_STATE = metrics.Gauge('db_lane_requests', 'Pool lane requests by state.', ('pool', 'lane', 'state'))
+
+def set_lane(name):
+    return _lane.set(name)
+
+def reset_lane(token):
+    _lane.reset(token)
+
+class lane(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._token = None
+
+    def __enter__(self):
+        self._token = set_lane(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        reset_lane(self._token)
+
+class _Lanes(object):
+
+    #lanes: {名字: dict(reserved=保留数, weight=权重)}, 没有分道的请求走default这条道
+    def __init__(self, pool, lanes, default):
+        self.pool = pool
+        self.size = pool.maxsize
+        self.lanes = dict((name, (conf.get('reserved', 0), conf.get('weight', 1))) for name, conf in lanes.items())
+        if default not in self.lanes:
+            raise ValueError('Default lane %s is not configured.' % default)
+        if sum(reserved for reserved, weight in self.lanes.values()) >= self.size:
+            raise ValueError('Reserved connections must be fewer than pool size %s.' % self.size)
+        for name, (reserved, weight) in self.lanes.items():
+            if reserved < 0 or weight <= 0:
+                raise ValueError('Invalid lane %s: reserved=%s, weight=%s' % (name, reserved, weight))
+        self.default = default
+        self.limit = self.size      #同时可以使用的连接数, 自动调节(见_PoolTuner)时在[min_size, size]之间变化
+        self.used = 0
+        self.in_use = dict((name, 0) for name in self.lanes)
+        self.waiters = dict((name, deque()) for name in self.lanes)
+        #加权公平排队的虚拟时间: 每条道每拿到一个许可, 它的虚拟时间加上1/weight, 排队的道中虚拟时间最小的先拿
+        self.vtime = dict((name, 0.0) for name in self.lanes)
+        self.clock = 0.0
+        self._reset_window()
+
+    #自动调节用的统计: 还回的连接数, 占用连接的总时间, 出错数, 需要排队的次数, 占用许可的最大数
+    def _reset_window(self):
+        self.window = dict(count=0, hold=0.0, errors=0, queued=0, peak=self._occupied())
+
+    #占用的许可: 正在使用的, 加上各条道还没用到的保留数(这部分别的道也拿不到)
+    def _occupied(self):
+        held = sum(max(0, reserved - self.in_use[name]) for name, (reserved, weight) in self.lanes.items())
+        return self.used + held
+
+    def take_window(self):
+        window = self.window
+        self._reset_window()
+        return window
+
+    #调整同时可以使用的连接数, 调大时马上分给排队的请求
+    def set_limit(self, limit):
+        self.limit = limit
+        self._dispatch()
+
+    #不认识的道名当作默认的道
+    def lane(self, name):
+        return name if name in self.lanes else self.default
+
+    #这条道现在能不能拿到许可: 空闲的许可中要扣掉其他道还没用到的保留数
+    def _available(self, name):
+        held = 0
+        for other, (reserved, weight) in self.lanes.items():
+            if other != name and self.in_use[other] < reserved:
+                held = held + reserved - self.in_use[other]
+        return self.limit - self.used - held > 0
+
+    def _grant(self, name):
+        self.used = self.used + 1
+        self.in_use[name] = self.in_use[name] + 1
+        occupied = self._occupied()
+        if occupied > self.window['peak']:
+            self.window['peak'] = occupied
+        start = max(self.vtime[name], self.clock)
+        self.vtime[name] = start + 1.0 / self.lanes[name][1]
+        self.clock = start
+
+    #有许可空出来时, 按顺序分给排队的请求: 先给还没用满保留数的道, 再按虚拟时间
+    def _dispatch(self):
+        while True:
+            candidates = []
+            for name, waiters in self.waiters.items():
+                while waiters and waiters[0].done():    #已经取消(超时)的请求
+                    waiters.popleft()
+                if waiters and self._available(name):
+                    reserved, weight = self.lanes[name]
+                    candidates.append((self.in_use[name] >= reserved, max(self.vtime[name], self.clock), name))
+            if not candidates:
+                return
+            name = min(candidates)[2]
+            self._grant(name)
+            self.waiters[name].popleft().set_result(None)
+
+    #在name这条道上拿一个许可, 返回实际使用的道名; 最多等到语句的期限
+    @asyncio.coroutine
+    def acquire(self, name, timeout=None):
+        name = self.lane(name)
+        start = time.time()
+        if not any(self.waiters.values()) and self._available(name):
+            self._grant(name)
+        else:
+            self.window['queued'] = self.window['queued'] + 1
+            fut = asyncio.get_event_loop().create_future()
+            self.waiters[name].append(fut)
+            self._dispatch()
+            try:
+                yield from asyncio.wait_for(asyncio.shield(fut), _timeout_for(timeout))
+            except asyncio.TimeoutError:
+                fut.cancel()
+                #超时的同时刚好拿到了许可, 还回去
+                if not fut.cancelled():
+                    self.release(name)
+                raise QueryTimeout('timed out waiting for a connection in lane %s' % name)
+            except BaseException:
+                fut.cancel()
+                if not fut.cancelled():
+                    self.release(name)
+                raise
+        _LANE_WAIT.observe(time.time() - start, _pool_name(self.pool), name)
+        return name
+
+    #elapsed是占用连接的时间, error表示期间发生了数据库错误, 用于自动调节
+    def release(self, name, elapsed=None, error=False):
+        self.used = self.used - 1
+        self.in_use[name] = self.in_use[name] - 1
+        if elapsed is not None:
+            self.window['count'] = self.window['count'] + 1
+            self.window['hold'] = self.window['hold'] + elapsed
+        if error:
+            self.window['errors'] = self.window['errors'] + 1
+        self._dispatch()
+
+    def samples(self):
+        pool = _pool_name(self.pool)
+        for name in sorted(self.lanes):
+            yield (pool, name, 'queued'), sum(1 for fut in self.waiters[name] if not fut.done())
+            yield (pool, name, 'in_use'), self.in_use[name]
+
+#连接用完后连同许可一起还回去
+class _LaneContext(object):
+
+    #measure为False时占用时间不计入自动调节的延迟(事务里包含了应用自己的处理时间)
+    def __init__(self, cm, lanes, lane, measure=True):
+        self.cm = cm
+        self.lanes = lanes
+        self.lane = lane
+        self.measure = measure
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.cm.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self.cm.__exit__(exc_type, exc, tb)
+        finally:
+            error = exc_type is not None and issubclass(exc_type, (_backend.Error, asyncio.TimeoutError))
+            self.lanes.release(self.lane, time.time() - self.start if self.measure else None, error)
+
+#iter_select用pool.acquire()取连接, 许可单独用async with拿; pool为None或没有分道时什么也不做
+class _LanePermit(object):
+
+    def __init__(self, pool):
+        self.lanes = _lanes.get(pool) if pool is not None else None
+        self.lane = None
+
+    async def __aenter__(self):
+        if self.lanes is not None:
+            self.lane = await self.lanes.acquire(_lane.get())
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.lanes is not None:
+            self.lanes.release(self.lane)
+
+def _lane_samples():
+    for lanes in _lanes.values():
+        yield from lanes.samples()
+
+_LANE_STATE.set_function(_lane_samples)
+
+#==================================连接数自动调节区============================================================
+# maxsize是拍脑袋定的, 为了扛住高峰每个进程都配得很大, 整个集群占用了大量MySQL连接
+# 自动调节调整同时可以使用的连接数(_Lanes.limit), 范围是[min_size, 连接池的maxsize]:
+#   每隔interval秒看一次这段时间的统计
+#   占用连接的平均时间超过基线的tolerance倍, 或者出错比例超过max_error_rate: 数据库已经忙不过来, limit乘以backoff
+#   有请求因为拿不到许可而排队: limit乘以growth(至少加1), 突发的流量不用等好几个interval才能拿到连接
+#   没有排队, 并且占用的许可(包括空着的保留数)明显比limit少: limit减1, 多出来的空闲连接关掉
+# min_size至少是各道保留的连接数之和加上min_shared, 缩到最小时默认的道也还有min_shared个连接可用
+# 事务占用连接的时间包含应用自己的处理, 不计入延迟
+# 基线是占用时间的低水位: 比它小时直接取新值, 比它大时慢慢往上靠, 数据库整体变慢后基线也会跟上
+
+_POOL_LIMIT = metrics.Gauge('db_pool_limit', 'Connections the autotuner currently allows.', ('pool',))
+
+class _PoolTuner(object):
+
+    def __init__(self, lanes, min_size=2, interval=5, tolerance=2.0, backoff=0.75, growth=2.0, max_error_rate=0.05, min_shared=2):
+        reserved = sum(r for r, w in lanes.lanes.values())
+        if not 0 < min_size <= lanes.size or min_shared < 1:
+            raise ValueError('Invalid autotune min_size/min_shared: %s/%s' % (min_size, min_shared))
+        if not 0 < backoff < 1 or tolerance <= 1 or growth <= 1:
+            raise ValueError('Invalid autotune backoff/tolerance/growth: %s/%s/%s' % (backoff, tolerance, growth))
+        self.lanes = lanes
+        self.min_size = min(lanes.size, max(min_size, reserved + min_shared))
+        if self.min_size != min_size:
+            logging.warning('pool %s autotune min_size raised to %s: %s connections are reserved' % (_pool_name(lanes.pool), self.min_size, reserved))
+        self.max_size = lanes.size
+        self.interval = interval
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.growth = growth
+        self.max_error_rate = max_error_rate
+        self.baseline = None
+
+    #根据上一段时间的统计算出新的limit
+    def tick(self):
+        w = self.lanes.take_window()
+        limit = self.lanes.limit
+        new = limit
+        latency = w['hold'] / w['count'] if w['count'] else None
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline = self.baseline + 0.05 * (latency - self.baseline)
+        if w['count'] and (w['errors'] > w['count'] * self.max_error_rate or latency > self.baseline * self.tolerance):
+            new = max(self.min_size, int(limit * self.backoff))
+        elif w['queued']:
+            new = min(self.max_size, max(limit + 1, int(limit * self.growth)))
+        elif w['peak'] < limit - 1:
+            new = max(self.min_size, limit - 1)
+        if new != limit:
+            logging.info('pool %s limit %s -> %s (latency: %s, baseline: %s, errors: %s/%s, queued: %s, peak: %s)' % (_pool_name(self.lanes.pool), limit, new, latency, self.baseline, w['errors'], w['count'], w['queued'], w['peak']))
+            self.lanes.set_limit(new)
+        return new
+
+    #关掉limit以外的空闲连接; 取出来的都是空闲连接, 关掉后还回去, 连接池会丢弃关闭的连接
+    @asyncio.coroutine
+    def trim(self):
+        pool = self.lanes.pool
+        surplus = min(pool.size - self.lanes.limit, pool.freesize)
+        conns = []
+        try:
+            for i in range(surplus):
+                conns.append((yield from pool.acquire()))
+        finally:
+            for conn in conns:
+                conn.close()
+                pool.release(conn)
+        if conns:
+            logging.info('pool %s closed %s idle connections' % (_pool_name(pool), len(conns)))
+
+@asyncio.coroutine
+def _autotune_forever(tuner):
+    while True:
+        yield from asyncio.sleep(tuner.interval)
+        try:
+            tuner.tick()
+            yield from tuner.trim()
+        except Exception as e:
+            logging.exception(e)
+
+def _pool_limits():
+    for pool, lanes in _lanes.items():
+        yield (_pool_name(pool),), lanes.limit
+
+_POOL_LIMIT.set_function(_pool_limits)
+
+#==================================超时区============================================================
+# 一条很慢的语句会一直占着连接, 连接池被占满后所有请求都要排队
+# 每条语句都有期限: select/execute的timeout参数, 没传时用create_pool的query_timeout, 并且不超过请求的剩余时间
+# 请求的期限由app.py的中间件用set_deadline()设置, handler里也可以用 with orm.deadline(2): 收紧一段代码的期限
+# 超时后: 等待中的协程被取消, 由后端的abort()关掉连接并停止数据库中还在执行的语句
+# (MySQL另开一个连接KILL QUERY, SQLite用interrupt()), 最后抛出QueryTimeout
+
+class QueryTimeout(asyncio.TimeoutError):
+    pass
+
+__query_timeout = None
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+#设置当前请求(task)的期限, 已经有更早的期限时保留更早的; 返回的token交给reset_deadline()
+def set_deadline(seconds):
+    deadline = time.time() + seconds
+    current = _deadline.get()
+    if current is not None and current < deadline:
+        deadline = current
+    return _deadline.set(deadline)
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+class deadline(object):
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._token = None
+
+    def __enter__(self):
+        self._token = set_deadline(self.seconds)
+        return self
+
+    def __exit__(self, *exc):
+        reset_deadline(self._token)
+
+#这条语句最多可以执行多少秒, None表示不限制; 请求已经超时的话直接抛出QueryTimeout
+def _timeout_for(timeout):
+    if timeout is None:
+        timeout = __query_timeout
+    deadline = _deadline.get()
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise QueryTimeout('request deadline exceeded')
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+#在期限内执行coro(在conn上执行语句的协程), 超时的话关掉连接, 杀掉服务器上的语句
+#不用wait_for(它为每条语句另建一个task), 在当前task中直接执行, 到期时由定时器取消当前task
+@asyncio.coroutine
+def _with_timeout(conn, coro, timeout, stmt):
+    if timeout is None:
+        return (yield from coro)
+    task = asyncio.current_task()
+    expired = []
+    def expire():
+        expired.append(True)
+        task.cancel()
+    handle = asyncio.get_event_loop().call_later(timeout, expire)
+    try:
+        return (yield from coro)
+    except asyncio.CancelledError:
+        if not expired:
+            raise
+        #取消是自己发起的, 已经换成了QueryTimeout, 不算task被取消(Python 3.11以后有uncancel)
+        if hasattr(task, 'uncancel'):
+            task.uncancel()
+        _backend.abort(conn)
+        raise QueryTimeout('query timed out after %.3fs: %s' % (timeout, stmt.sql))
+    finally:
+        handle.cancel()
+
+#==================================慢查询日志区============================================================
+# 执行时间超过threshold秒的语句, 记下sql, 参数指纹(不记录参数本身, 避免把密码之类写进日志), 以及发起查询的handler
+# 每种慢语句第一次出现时在后台执行一次EXPLAIN, 结果一起记下来, 方便发现缺少索引的查询
+# 日志写到按大小滚动的文件里, 最近的记录保存在内存中, 供/manage/slow-queries页面查看
+
+__slow_log = None
+
+#当前请求的handler, 由app.py中的中间件设置
+_query_source = contextvars.ContextVar('query_source', default=None)
+
+def set_query_source(source):
+    return _query_source.set(source)
+
+def reset_query_source(token):
+    _query_source.reset(token)
+
+_EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'replace')
+
+class SlowQueryLog(object):
+
+    def __init__(self, threshold=0.5, file=None, max_bytes=10 * 1024 * 1024, backup_count=5, keep=200):
+        self.threshold = threshold
+        self.entries = deque(maxlen=keep)     #最近的慢查询, 新的在前
+        self.explains = dict()    #sql ==> EXPLAIN的结果, 每种sql只EXPLAIN一次
+        self.logger = logging.getLogger('www.slow_query')
+        #logger是全局的, 再次create_pool时换掉上一次的文件, 而不是再加一个(每条慢查询会写两遍, 旧文件也一直开着)
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.logger.propagate = True
+        if file:
+            handler = logging.handlers.RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.propagate = False
+
+    def record(self, stmt, args, elapsed, rows, error):
+        #EXPLAIN本身不记录
+        if stmt.sql.startswith('EXPLAIN '):
+            return
+        entry = dict(
+            time=time.time(),
+            sql=stmt.sql,
+            fingerprint=hashlib.sha1(repr(tuple(args or ())).encode('utf-8')).hexdigest()[:12],
+            elapsed=round(elapsed, 6),
+            rows=rows,
+            error=None if error is None else '%s: %s' % (error.__class__.__name__, error),
+            source=_query_source.get(),
+            explain=self.explains.get(stmt.sql))
+        self.entries.appendleft(entry)
+        self.logger.warning('slow query %.3fs [%s] args:%s rows:%s %s' % (elapsed, entry['source'], entry['fingerprint'], rows, stmt.sql))
+        if stmt.sql not in self.explains and stmt.sql.lstrip().lower().startswith(_EXPLAINABLE) and args is not None:
+            self.explains[stmt.sql] = None
+            #EXPLAIN是新的task, 不能继承当前的事务
+            asyncio.get_event_loop().call_soon(asyncio.ensure_future, self._explain(stmt, entry, list(args)), context=contextvars.Context())
+
+    @asyncio.coroutine
+    def _explain(self, stmt, entry, args):
+        try:
+            #execute_many只记录了第一组参数
+            if args and isinstance(args[0], (list, tuple)):
+                args = args[0]
+            rs = yield from _route_select(compile_sql(_backend.explain + stmt.sql), args, None)
+        except Exception as e:
+            rs = [dict(error='%s: %s' % (e.__class__.__name__, e))]
+        self.explains[stmt.sql] = rs
+        entry['explain'] = rs
+        self.logger.warning('explain %s: %s' % (stmt.sql, rs))
+
+def slow_query_log():
+    return __slow_log
 
 #=====================================以下是sql函数处理区===========================================================================
 #select 和 execute方法是实现其他Model类中sql语句都经常要用的方法
 #将执行sql的代码封装进select函数, 调用的时候只要传入sql, 和sql所需要的一些参数就好
 #size 用于指定最大的查询数量, 不指定将返回所有查询结果
 # 要执行SELECT语句，我们用select函数执行，需要传入SQL语句和SQL参数
+#cache为True时(Model.find/findAll/findNumber会传), 打开了查询缓存就先查缓存
+#缓存中的结果是共享的, 调用者不能修改返回的行
 @asyncio.coroutine
-def select(sql, args, size=None):
-    log(sql, args)
-    #声明全局变量, 这样才能引用create_pool函数创建的__pool变量
-    global __pool
+def select(sql, args, size=None, cache=False, raw=False, timeout=None):
+    #sql可以是字符串, 也可以是已经编译好的Statement
+    #raw=True时每行是tuple而不是dict, 省掉驱动为每行构造dict的开销, 列的顺序就是select的顺序
+    #timeout: 这条语句最多执行多少秒, 见超时区
+    stmt = compile_sql(sql)
+    #事务里的读操作要看到自己未提交的写, 不走缓存和副本
+    if _transaction.get() is not None:
+        log(stmt.sql, args)
+        return (yield from _select(__pool, stmt, args, size, raw, timeout))
+    #认不全涉及的表的语句不缓存, 否则写其中一张表时缓存不会失效
+    if cache and __cache is not None and stmt.tables and stmt.complete:
+        try:
+            key = _cache_key(stmt, args, size, raw)
+            rs = __cache.get(key)
+        except TypeError:   #参数不能hash, 不缓存
+            key, rs = None, None
+        if rs is not None:
+            logging.debug('query cache hit: %s' % stmt.sql)
+            return rs
+        if key is not None:
+            versions = __cache.versions(stmt.tables)
+            rs = yield from _route_select(stmt, args, size, raw, timeout)
+            __cache.put(key, stmt.tables, versions, rs)
+            return rs
+    return (yield from _route_select(stmt, args, size, raw, timeout))
+
+#查询缓存的key, Model.find合并查询时也用它, 合并和不合并的查询共用缓存
+def _cache_key(stmt, args, size, raw=False):
+    return (stmt.sql, tuple(args or ()), size, raw)
+
+@asyncio.coroutine
+def _route_select(stmt, args, size, raw=False, timeout=None):
+    log(stmt.sql, args)
+    #读操作优先交给只读副本, 副本的连接出错就换主库再查一次; 刚写过的表读主库
+    pool = __pool if _recently_written(stmt.tables) else _read_pool()
+    if pool is not __pool:
+        try:
+            return (yield from _select(pool, stmt, args, size, raw, timeout))
+        except _backend.OperationalError as e:
+            #只有连接层面的错误才说明副本有问题, 锁等待超时, 死锁之类的直接抛出
+            if not _is_disconnect(e):
+                raise
+            _mark_down(pool, e)
+    try:
+        return (yield from _select(__pool, stmt, args, size, raw, timeout))
+    except _backend.OperationalError as e:
+        #select是幂等的, 连接断开时换一个连接重试一次
+        if not _is_disconnect(e):
+            raise
+        logging.warning('connection lost, retry select once: %s' % e)
+    return (yield from _select(__pool, stmt, args, size, raw, timeout))
 
+@asyncio.coroutine
+def _select(pool, stmt, args, size, raw=False, timeout=None):
+    #请求已经超时的话不用再去拿连接
+    _timeout_for(timeout)
     #从连接池中获得一个数据库连接
     #用with语句可以封装清理(关闭conn)和处理异常工作
-    with (yield from __pool) as conn:
+    with (yield from _acquire(pool, timeout=timeout)) as conn:
 
         #等待连接对象返回DictCursor可以通过dict的方式获取数据库对象, 需要通过游标对象执行sql
-        cur = yield from conn.cursor(aiomysql.DictCursor)
+        cur = yield from conn.cursor(_backend.Cursor if raw else _backend.DictCursor)
 
-        #设置执行语句, 其中sql的占位符是?, 而python为%s, 这里要做一下替换
-        #args是sql语句的参数
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
+        start = time.time()
+        try:
+            @asyncio.coroutine
+            def run():
+                #设置执行语句, 其中sql的占位符是?, 而python为%s, 替换已经在编译Statement时做好了
+                #args是sql语句的参数
+                yield from cur.execute(stmt.operation, args or ())
 
-        #如果指定了查询数量, 则查询指定数量的结果, 如果不指定则查询所有结果
-        if size:
-            rs = yield from cur.fetchmany(size)     #从数据库获取指定的行数
-        else:
-            rs = yield from cur.fetchall()  #返回所有结果集
+                #如果指定了查询数量, 则查询指定数量的结果, 如果不指定则查询所有结果
+                if size:
+                    return (yield from cur.fetchmany(size))     #从数据库获取指定的行数
+                return (yield from cur.fetchall())  #返回所有结果集
+            #等连接用掉了一部分时间, 重新计算剩余的期限
+            rs = yield from _with_timeout(conn, run(), _timeout_for(timeout), stmt)
+        except Exception as e:
+            _observe(stmt, start, args, error=e)
+            raise
+        _observe(stmt, start, args, len(rs))
         yield from cur.close()
         logging.info('rows returned: %s' % len(rs))     #打印返回的行数
         return rs   #返回结果集
 
 
+# 流式读取大结果集
+# 用服务端游标(SSDictCursor, 不把结果一次性缓冲到客户端), 每次fetchmany(batch)行, 逐行yield出去
+# 不管表有多大, 内存里最多只有一批数据
+# 这是一个async generator, 需要用async for来遍历, 所以只能写成async def
+async def iter_select(sql, args, batch=1000, raw=False):
+    stmt = compile_sql(sql)
+    log(stmt.sql, args)
+    #耗时包括调用者处理每一行的时间, 不设超时, 只检查请求是否已经超时
+    _timeout_for(None)
+    tx = _transaction.get()
+    pool = _read_pool() if tx is None and not _recently_written(stmt.tables) else __pool
+    start = time.time()
+    async with _LanePermit(pool if tx is None else None), (_Pinned(tx.conn) if tx is not None else pool.acquire()) as conn:
+        _POOL_WAIT.observe(time.time() - start, _pool_name(pool))
+        cur = await conn.cursor(_backend.SSCursor if raw else _backend.SSDictCursor)
+        start = time.time()
+        count = 0
+        try:
+            await cur.execute(stmt.operation, args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                count = count + len(rs)
+                for r in rs:
+                    yield r
+            logging.info('rows streamed: %s' % count)
+        except Exception as e:
+            _observe(stmt, start, args, error=e, slow=False)
+            raise
+        else:
+            #耗时包括了调用者处理每一行的时间, 所以不算慢查询
+            _observe(stmt, start, args, count, slow=False)
+        finally:
+            #服务端游标没读完就关闭时, close()会把剩下的行读掉, 连接才能还给连接池
+            await cur.close()
+
+
 # Insert, Update, Delete
 #
 # 要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数，因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数：
 #定义execute()函数执行insert update delete语句
 
 @asyncio.coroutine
-def execute(sql, args, autocommit=True):
+def execute(sql, args, autocommit=True, timeout=None):
     # execute()函数只返回结果数, 不返回结果集, 适用于insert, update这些语句
-    log(sql)
-    with (yield from __pool) as conn:
+    stmt = compile_sql(sql)
+    log(stmt.sql)
+    _timeout_for(timeout)
+    #在transaction()里面时, 由事务负责提交和回滚
+    if _transaction.get() is not None:
+        autocommit = True
+    with (yield from _acquire(__pool, timeout=timeout)) as conn:
+        start = time.time()
+        timeout = _timeout_for(timeout)
         if not autocommit:
             yield from conn.begin()
         try:
             cur = yield from conn.cursor()
 
-            yield from cur.execute(sql.replace('?', '%s'), args)
+            yield from _with_timeout(conn, cur.execute(stmt.operation, args), timeout, stmt)
             affected = cur.rowcount     #返回受影响的行数
             yield from cur.close()
             if not autocommit:
                 yield from conn.commit()
+            _observe(stmt, start, args, affected)
         except BaseException as e:
-            if not autocommit:
+            _observe(stmt, start, args, error=e)
+            #超时关掉的连接不用回滚, 服务器会回滚未提交的事务
+            if not autocommit and not conn.closed:
                 yield from conn.rollback()
             raise
+        finally:
+            #不管成功与否, 写过的表的缓存都作废
+            _invalidate(stmt)
         return affected
 #execute()函数和select()函数所不同的是，cursor对象不返回结果集，而是通过rowcount返回结果数。
 
+# 批量执行同一条insert/update语句
+# 所有参数在同一个连接, 同一个事务中按chunk_size分块用executemany执行(insert会被驱动改写成多行values)
+# 返回每一块受影响的行数组成的list, 任何一块出错整个事务回滚
+@asyncio.coroutine
+def execute_many(sql, args_list, chunk_size=500, timeout=None):
+    stmt = compile_sql(sql)
+    if chunk_size < 1:
+        raise ValueError('Invalid chunk size: %s' % chunk_size)
+    _timeout_for(timeout)
+    args_list = list(args_list)
+    log(stmt.sql)
+    logging.info('rows to write: %s, chunk size: %s' % (len(args_list), chunk_size))
+    affected = []
+    if not args_list:
+        return affected
+    #在transaction()里面时, 由事务负责提交和回滚
+    own = _transaction.get() is None
+    with (yield from _acquire(__pool, timeout=timeout)) as conn:
+        start = time.time()
+        timeout = _timeout_for(timeout)
+        if own:
+            yield from conn.begin()
+        try:
+            cur = yield from conn.cursor()
+
+            #timeout是所有块加起来的时间
+            @asyncio.coroutine
+            def run():
+                for i in range(0, len(args_list), chunk_size):
+                    yield from cur.executemany(stmt.operation, args_list[i:i + chunk_size])
+                    affected.append(cur.rowcount)
+            yield from _with_timeout(conn, run(), timeout, stmt)
+            yield from cur.close()
+            if own:
+                yield from conn.commit()
+            _observe(stmt, start, args_list[:1], sum(affected))
+        except BaseException as e:
+            _observe(stmt, start, args_list[:1], error=e)
+            if own and not conn.closed:
+                yield from conn.rollback()
+            raise
+        finally:
+            _invalidate(stmt)
+    return affected
+
+#写操作之后, 让涉及的表的查询缓存失效
+def _invalidate(stmt):
+    tx = _transaction.get()
+    if tx is not None:
+        tx.tables.update(stmt.tables)
+        if not stmt.complete:
+            tx.unknown_tables = True
+    _mark_written(stmt.tables)
+    if __cache is not None:
+        #不知道写了哪些表, 只能全部作废
+        if not stmt.complete:
+            __cache.clear()
+        elif stmt.tables:
+            __cache.invalidate(stmt.tables)
+
+#==================================事务区============================================================
+# execute每条语句单独提交, 多步的写操作既不是原子的, 每步还要多付一次取连接和一次提交
+# transaction()占用一个连接, 块里面所有的select/execute(包括Model的save/update/remove/find)都走这个连接
+# 块正常结束时提交, 出异常时回滚; 嵌套使用时内层是一个savepoint, 只回滚内层
+#
+#   async with orm.transaction():
+#       yield from/await blog.save()
+#
+# 生成器风格的协程不能用async with, 可以直接调用:
+#   tx = orm.transaction()
+#   yield from tx.begin()
+#   try:
+#       ...
+#       yield from tx.commit()
+#   except BaseException:
+#       yield from tx.rollback()
+#       raise
+#
+# 事务保存在contextvar里, 只对当前task有效; 不要在事务里用gather并发地执行sql
+
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+#事务里使用的连接, 不归还连接池, 由Transaction负责
+class _Pinned(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, *exc):
+        pass
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        pass
+
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self.parent = None
+        self.savepoint = None
+        self.tables = set()     #事务中写过的表
+        self.unknown_tables = False     #有没有认不全表的写操作, 有的话提交后整个查询缓存作废
+        self._cm = None
+        self._token = None
+
+    @asyncio.coroutine
+    def begin(self):
+        self.parent = _transaction.get()
+        if self.parent is None:
+            self._cm = yield from _acquire(_primary_pool(), measure=False)
+            self.conn = self._cm.__enter__()
+            try:
+                yield from self.conn.begin()
+            except BaseException as e:
+                #begin失败(例如连接已经断开)时__aexit__不会被调用, 在这里把连接和许可还回去
+                cm, self._cm = self._cm, None
+                cm.__exit__(type(e), e, e.__traceback__)
+                raise
+            log('BEGIN')
+        else:
+            #嵌套的事务用savepoint实现
+            self.conn = self.parent.conn
+            self.savepoint = 'sp%s' % id(self)
+            yield from self._execute('SAVEPOINT %s' % self.savepoint)
+        self._token = _transaction.set(self)
+        return self
+
+    @asyncio.coroutine
+    def commit(self):
+        try:
+            if self.savepoint:
+                yield from self._execute('RELEASE SAVEPOINT %s' % self.savepoint)
+            else:
+                yield from self.conn.commit()
+                log('COMMIT')
+        except BaseException:
+            yield from self._abort()
+            raise
+        self._end(True)
+
+    @asyncio.coroutine
+    def rollback(self):
+        #语句超时时连接已经被关掉, 服务器会回滚整个事务
+        if self.conn.closed:
+            log('ROLLBACK (connection closed)')
+            self._end(False)
+            return
+        try:
+            if self.savepoint:
+                yield from self._execute('ROLLBACK TO SAVEPOINT %s' % self.savepoint)
+            else:
+                yield from self.conn.rollback()
+                log('ROLLBACK')
+        except BaseException:
+            yield from self._abort()
+            raise
+        self._end(False)
+
+    @asyncio.coroutine
+    def _execute(self, sql):
+        log(sql)
+        cur = yield from self.conn.cursor()
+        yield from cur.execute(sql)
+        yield from cur.close()
+
+    #提交/回滚失败时, 外层事务已经不可用了, 至少把连接还回去
+    @asyncio.coroutine
+    def _abort(self):
+        if self.savepoint is None:
+            try:
+                yield from self.conn.rollback()
+            except Exception as e:
+                logging.exception(e)
+        self._end(False)
+
+    def _end(self, committed):
+        if self._token is not None:
+            _transaction.reset(self._token)
+            self._token = None
+        if self.parent is not None:
+            self.parent.tables.update(self.tables)
+            self.parent.unknown_tables = self.parent.unknown_tables or self.unknown_tables
+            if not committed:
+                _reset_counters(self.tables)
+            return
+        #提交后其他连接才能看到新数据, 这时再让缓存失效一次, 防止提交前有人把旧数据放进缓存
+        _mark_written(self.tables)
+        cache = query_cache()
+        if cache is not None and self.unknown_tables:
+            cache.clear()
+        elif cache is not None and self.tables:
+            cache.invalidate(self.tables)
+        if not committed:
+            _reset_counters(self.tables)
+        if self._cm is not None:
+            self._cm.__exit__(None, None, None)
+            self._cm = None
+
+    async def __aenter__(self):
+        return (await self.begin())
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+        return False
+
+def transaction():
+    return Transaction()
+
 #这个函数在元类中被引用, 作用是创建一定数量的占位符
 def create_args_string(num):
     L = []
@@ -111,11 +1334,13 @@ def create_args_string(num):
 #父定义域: 可以被其他定义域继承
 class Field(object):
     #定义域的初始化:包括属性(列)名, 属性(列)的类型, 主键, 默认值
-    def __init__(self, name, column_type, primary_key, default):
+    #deferred为True的列不会出现在findAll默认的查询里, 需要时用load_deferred()再加载
+    def __init__(self, name, column_type, primary_key, default, deferred=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default  #如果存在默认值, 在getOrDefault()中会被用到
+        self.deferred = deferred
 #定制输出信息为类名, 列的类型, 列名
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -145,8 +1370,341 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, deferred=False):
+        super().__init__(name, 'text', False, default, deferred)
+
+#索引的声明, 在Model中写 __indexes__ = [Index('blog_id', 'created_at'), Index('email', unique=True)]
+#migrate.py根据这些声明和数据库中实际的索引做对比, 生成缺少的索引的DDL
+class Index(object):
+
+    def __init__(self, *columns, unique=False, name=None):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name or '%s_%s' % ('uniq' if unique else 'idx', '_'.join(columns))
+
+    def __str__(self):
+        return '<%s%s: %s(%s)>' % ('Unique' if self.unique else '', self.__class__.__name__, self.name, ', '.join(self.columns))
+
+    __repr__ = __str__
+
+#==================================请求级别的identity map============================================================
+# 同一个请求里常常多次用主键查同一行(比如auth_factory里的cookie2user, handler里又查一次)
+# 打开identity map之后, Model.find会先看这个请求里是否已经加载过这个对象, 有就直接返回, 不再查数据库
+# 它保存在contextvar里, 由app.py中的中间件在每个请求开始时打开, 结束时关闭, 不同请求之间互不影响
+
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+#为当前上下文打开一个新的identity map, 返回的token交给end_identity_map()还原
+def begin_identity_map():
+    return _identity_map.set(dict())
+
+def end_identity_map(token):
+    _identity_map.reset(token)
+
+#==================================Model.find批量合并区============================================================
+# 并发的请求在同一轮事件循环里各自调用Blog.find(id), 每个都要占一个连接, 各查一次
+# 打开合并之后, 这些主键查询先排队, 到这一轮结束(或等window秒)时合并成一条where id in (...)一次查出来, 再分给每个调用者
+# 默认关闭, 在create_pool中通过batch_find=dict(window=0, max_size=100)打开
+
+__batch_find = None
+
+class _FindLoader(object):
+
+    def __init__(self, model, window=0, max_size=100):
+        self.model = model
+        self.window = window
+        self.max_size = max_size
+        self._pending = OrderedDict()     #道 ==> (主键 ==> 等待结果的future列表)
+        self._scheduled = False
+
+    #返回这个主键对应的行(dict), 不存在返回None
+    #合并查询不属于任何一个请求, 每个调用者只按自己的期限等待结果; 不同道的主键分开查询, 保持道的优先级
+    @asyncio.coroutine
+    def load(self, pk):
+        timeout = _timeout_for(None)
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(_lane.get(), OrderedDict()).setdefault(pk, []).append(fut)
+        if not self._scheduled:
+            self._scheduled = True
+            if self.window:
+                loop.call_later(self.window, self._dispatch, context=contextvars.Context())
+            else:
+                loop.call_soon(self._dispatch, context=contextvars.Context())
+        try:
+            return (yield from asyncio.wait_for(fut, timeout))
+        except asyncio.TimeoutError:
+            raise QueryTimeout('timed out waiting for batched find of %s' % self.model.__name__)
+
+    def _dispatch(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, OrderedDict()
+        for lane, futures in pending.items():
+            pks = list(futures.keys())
+            for i in range(0, len(pks), self.max_size):
+                chunk = pks[i:i + self.max_size]
+                #在干净的context中执行, 只带上道
+                ctx = contextvars.Context()
+                ctx.run(_lane.set, lane)
+                ctx.run(asyncio.ensure_future, self._fetch(chunk, [futures[pk] for pk in chunk]))
+
+    @asyncio.coroutine
+    def _fetch(self, pks, futures):
+        model = self.model
+        stmt = model._statement(('find_in', len(pks)), lambda: '%s where `%s` in (%s)' % (model.__select__, model.__primary_key__, create_args_string(len(pks))))
+        try:
+            rs = yield from select(stmt, pks)
+        except Exception as e:
+            for futs in futures:
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        logging.info('batched find: %s keys, %s rows' % (len(pks), len(rs)))
+        #数据库比较主键时会转换类型(例如url中的'123'和整数123), 这里按字符串对应
+        rows = dict((str(r[model.__primary_key__]), r) for r in rs)
+        for pk, futs in zip(pks, futures):
+            row = rows.get(str(pk))
+            if row is None:
+                #对应不上的(例如MySQL的字符串比较不区分大小写)按单独查询的方式再查一次, 结果和不合并时一致
+                try:
+                    rs = yield from select(model.__find__, [pk], 1)
+                except Exception as e:
+                    for fut in futs:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    continue
+                row = rs[0] if rs else None
+            for fut in futs:
+                if not fut.done():
+                    fut.set_result(row)
+
+def batch_find_enabled():
+    return __batch_find is not None
+
+#每个Model一个loader
+_loaders = dict()
+
+def _find_loader(cls):
+    loader = _loaders.get(cls)
+    if loader is None:
+        loader = _loaders[cls] = _FindLoader(cls, **__batch_find)
+    return loader
+
+#==================================行数计数器区============================================================
+# api_blogs每次都要select count(id)来分页, InnoDB上这是一次完整的索引扫描, 表越大越慢
+# 计数器在内存里保存每张表的总行数, 以及__counts__中声明的列每个值的行数(例如每篇博客的评论数)
+# 第一次用到时从数据库查询, 之后由Model.save/remove增减, 再由后台任务定期和数据库核对
+# 其他进程的写入以及直接用execute的写入, 要等到下一次核对才会反映出来
+# findNumber('count(id)', counter=True)时从这里取值
+
+class _Counter(object):
+
+    def __init__(self, model):
+        self.model = model
+        self.total = None   #总行数, None表示还没加载
+        self.groups = dict((c, dict()) for c in model.__counts__)     #列名 ==> {值: 行数}
+        self.writes = 0     #写操作的序号, 加载期间发生过写操作的话, 加载的结果不保存
+
+    #(column, value)对应的计数, column为None表示总行数
+    @asyncio.coroutine
+    def get(self, column=None, value=None):
+        n = self.total if column is None else self.groups[column].get(value)
+        if n is not None:
+            return n
+        writes = self.writes
+        n = yield from self._count(column, value)
+        if writes == self.writes:
+            self._set(column, value, n)
+        return n
+
+    @asyncio.coroutine
+    def _count(self, column, value):
+        model = self.model
+        if column is None:
+            stmt = model._statement(('count',), lambda: 'select count(*) _num_ from `%s`' % model.__table__)
+            rs = yield from select(stmt, None, 1)
+        else:
+            stmt = model._statement(('count', column), lambda: 'select count(*) _num_ from `%s` where `%s`=?' % (model.__table__, column))
+            rs = yield from select(stmt, [value], 1)
+        return rs[0]['_num_']
+
+    def _set(self, column, value, n):
+        if column is None:
+            self.total = n
+        else:
+            self.groups[column][value] = n
+
+    #一个对象被插入(delta=1)或删除(delta=-1)后调用, 只调整已经加载过的计数
+    def change(self, obj, delta):
+        self.writes = self.writes + 1
+        if self.total is not None:
+            self.total = self.total + delta
+        for column, counts in self.groups.items():
+            if column in obj._unloaded:
+                #不知道这个对象属于哪一组, 整列重新加载
+                counts.clear()
+                continue
+            value = obj.getValue(column)
+            if value in counts:
+                counts[value] = counts[value] + delta
+
+    #丢弃所有计数, 下次用到时重新加载
+    def reset(self):
+        self.writes = self.writes + 1
+        self.total = None
+        for counts in self.groups.values():
+            counts.clear()
+
+    #把已经加载的计数和数据库核对一遍
+    @asyncio.coroutine
+    def reconcile(self):
+        keys = [(None, None)] if self.total is not None else []
+        for column, counts in self.groups.items():
+            keys.extend((column, value) for value in list(counts.keys()))
+        for column, value in keys:
+            writes = self.writes
+            n = yield from self._count(column, value)
+            if writes == self.writes:
+                self._set(column, value, n)
+
+#每个Model一个计数器
+_counters = dict()
+
+#事务回滚后, 被写过的表的计数不再可信, 全部重新加载
+def _reset_counters(tables):
+    for model, counter in _counters.items():
+        if model.__table__.lower() in tables:
+            counter.reset()
+
+def _counter(cls):
+    counter = _counters.get(cls)
+    if counter is None:
+        counter = _counters[cls] = _Counter(cls)
+    return counter
+
+#核对所有计数器
+@asyncio.coroutine
+def reconcile_counters():
+    for counter in list(_counters.values()):
+        try:
+            yield from counter.reconcile()
+        except Exception as e:
+            logging.exception(e)
+
+#后台每隔interval秒核对一次
+@asyncio.coroutine
+def _reconcile_forever(interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        yield from reconcile_counters()
+
+#============================================紧凑记录=======================================================
+#大量只读的行(例如一篇博客的上万条评论)不需要完整的Model: 每个Model有一个对应的__record__类,
+#用__slots__保存各列的值, 没有每行一个dict的开销, 属性访问也不再经过__getattr__和KeyError
+#没有加载的列对应的slot是空的, 访问时抛出AttributeError
+class Record(object):
+
+    #_extra是handler临时附加的属性(如html_content), 列以外的属性存在这个dict里, 用到时才分配; 没有设置时是None(见__getattr__)
+    __slots__ = ('_extra',)
+    __model__ = None
+    __columns__ = ()
+
+    #用tuple行构造记录
+    @classmethod
+    def _from_values(cls, columns, values):
+        rec = cls.__new__(cls)
+        for k, v in zip(columns, values):
+            object.__setattr__(rec, k, v)
+        return rec
+
+    def __getattr__(self, key):
+        if key == '_extra':
+            return None
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        if key in self.__columns__:
+            raise AttributeError(r"'%s' attribute '%s' is not loaded" % (self.__class__.__name__, key))
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    def __setattr__(self, key, value):
+        if key in self.__columns__:
+            object.__setattr__(self, key, value)
+            return
+        extra = self._extra
+        if extra is None:
+            extra = dict()
+            object.__setattr__(self, '_extra', extra)
+        extra[key] = value
+
+    #和Model一样可以用rec['id']访问, 只能访问列和附加的属性, 不包括方法
+    def __getitem__(self, key):
+        if key in self.__columns__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    #已加载的列, 加上附加的属性
+    def keys(self):
+        L = [k for k in self.__columns__ if hasattr(self, k)]
+        if self._extra is not None:
+            L.extend(self._extra)
+        return L
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def to_json(self, **kw):
+        return dict(self.items())
+
+    #转成完整的Model对象, 需要修改并写回数据库时使用
+    def model(self):
+        row = dict((k, getattr(self, k)) for k in self.__columns__ if hasattr(self, k))
+        return self.__model__._from_row(row, frozenset(self.__model__.__fields__).difference(row))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_json())
+
+#为Model生成对应的记录类
+def _record_class(model):
+    columns = (model.__primary_key__,) + tuple(model.__fields__)
+    return type(model.__name__ + 'Record', (Record,), dict(__slots__=columns, __model__=model, __columns__=columns))
+
+#Model._loaded中没有加载的列
+_NOT_LOADED = object()
+
+#Model实例属性的默认值
+_MODEL_SLOTS = dict(_unloaded=frozenset(), _loaded=None, _loaded_columns=None)
 
 #============================================Model基类区=======================================================
 #注意到Model只是一个基类，如何将具体的子类如User的映射信息读取出来呢？答案就是通过metaclass：ModelMetaclass：
@@ -187,12 +1745,33 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey  #主键属性名
         attrs['__fields__'] = fields  #除主键外的属性名
+        attrs['__eager_fields__'] = [f for f in fields if not mappings[f].deferred]  #findAll默认查询的列
+        #需要按值维护行数的列, 例如Comment的blog_id
+        counts = list(attrs.get('__counts__', []))
+        for c in counts:
+            if c not in fields:
+                raise RuntimeError('Invalid counted field: %s' % c)
+        attrs['__counts__'] = counts
+        #声明的索引, 列名必须是这个Model的字段
+        indexes = list(attrs.get('__indexes__', []))
+        for index in indexes:
+            for c in index.columns:
+                if c not in mappings:
+                    raise RuntimeError('Invalid index column for %s: %s' % (name, c))
+        attrs['__indexes__'] = indexes
         #构造默认的SELECT， INSERT， UPDATE， DELETE语句：
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        #主键查询也是固定形状, 直接预编译
+        attrs['__find__'] = compile_sql('%s where `%s`=?' % (attrs['__select__'], primaryKey))
+        #每个Model自己的语句缓存, key是查询形状, value是编译好的Statement
+        attrs['__statements__'] = dict()
+        attrs.setdefault('__slots__', ())
+        model = type.__new__(cls, name, bases, attrs)
+        model.__record__ = _record_class(model)
+        return model
 
 
 #=================================================Model基类区========================================
@@ -203,6 +1782,13 @@ class ModelMetaclass(type):
 #
 # 首先要定义的是所有ORM映射的基类Model：
 class Model(dict, metaclass=ModelMetaclass):
+    #列的值都在dict里, 实例上只有这几个属性(用object.__setattr__设置), 子类也不要__dict__, 每个对象省下几百字节
+    #_unloaded: 没有从数据库加载的列(投影查询没选的列, 以及deferred列)
+    #_loaded: 从数据库加载(或者保存)时各列的值(tuple), 列名是_loaded_columns; findAll直接用查询结果的行和Statement.columns, 不复制
+    #   update()和它比较, 只写改变了的列; None表示不是从数据库来的对象
+    #没有设置时取_MODEL_SLOTS中的默认值(见__getattr__)
+    __slots__ = ('_unloaded', '_loaded', '_loaded_columns')
+
     #这里直接调用了Model的父类dict的初始化方法, 把传入的关键字参数存入自身的dict中
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -212,6 +1798,10 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in _MODEL_SLOTS:
+                return _MODEL_SLOTS[key]
+            if key in self._unloaded:
+                raise AttributeError(r"'Model' attribute '%s' is not loaded, call load_deferred() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     #设置dict的值, 通过d.k=v的方式
@@ -239,6 +1829,67 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return  value
 
+    #用数据库查出的一行构造对象, 同时记下加载时的值
+    @classmethod
+    def _from_row(cls, row, unloaded=frozenset()):
+        obj = cls(**row)
+        obj._mark_loaded()
+        if unloaded:
+            object.__setattr__(obj, '_unloaded', unloaded)
+        return obj
+
+    #用tuple行构造对象, columns是各个位置对应的列名
+    @classmethod
+    def _from_values(cls, columns, values, unloaded=frozenset()):
+        obj = cls.__new__(cls)
+        dict.update(obj, zip(columns, values))
+        object.__setattr__(obj, '_loaded', values)
+        object.__setattr__(obj, '_loaded_columns', columns)
+        if unloaded:
+            object.__setattr__(obj, '_unloaded', unloaded)
+        return obj
+
+    #把当前的值记为和数据库一致
+    def _mark_loaded(self):
+        columns = self.__record__.__columns__
+        object.__setattr__(self, '_loaded', tuple(dict.get(self, c, _NOT_LOADED) for c in columns))
+        object.__setattr__(self, '_loaded_columns', columns)
+
+    #加载时的值, 列名 ==> 值
+    def _loaded_values(self):
+        return dict(zip(self._loaded_columns, self._loaded))
+
+    #加载之后改变了的列(按__fields__的顺序); 没有加载的列只有被赋值了才算改变
+    def changed_fields(self):
+        if self._loaded is None:
+            return list(self.__fields__)
+        loaded = self._loaded_values()
+        changed = []
+        for f in self.__fields__:
+            if f in self._unloaded:
+                if f in self:
+                    changed.append(f)
+            else:
+                old = loaded.get(f, _NOT_LOADED)
+                if old is _NOT_LOADED or dict.get(self, f, _NOT_LOADED) != old:
+                    changed.append(f)
+        return changed
+
+    #按查询形状取出编译好的Statement, 第一次遇到这个形状时才拼接sql
+    #columns是结果中各个位置的列名, 传了的话记在Statement上, 查询时就可以用tuple行
+    @classmethod
+    def _statement(cls, key, build, columns=None):
+        stmt = cls.__statements__.get(key)
+        if stmt is None:
+            stmt = cls.__statements__[key] = compile_sql(build())
+            if columns is not None:
+                stmt.columns = columns
+        return stmt
+
+    #select出来的列的顺序: 主键在前, 然后是查询的列
+    @classmethod
+    def _columns(cls, fields):
+        return (cls.__primary_key__,) + tuple(f for f in fields if f != cls.__primary_key__)
 
 #==========================往Model里添加方法, 就可以让所有子类调用类方法==================================================
     @classmethod    #这个装饰器是类方法的意思, 即可以不创建实例直接调用类方法
@@ -246,45 +1897,167 @@ class Model(dict, metaclass=ModelMetaclass):
     #findAll() - 根据where条件查找
     def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
-        sql = [cls.__select__]
-        #如果有where参数的话就在sql语句中添加字符串where和where参数
-        if where:
-            sql.append('where')
-            sql.append(where)
+        #fields: 只查询这些列(主键总会查询), 不传则查询除deferred列以外的所有列
+        fields = kw.get('fields', None)
+        fields = tuple(cls.__eager_fields__ if fields is None else fields)
+        unloaded = frozenset(cls.__fields__).difference(fields)
+        seekWhere = None
         if args is None:    #这个参数是在执行sql语句前嵌入到sql语句中的, 如果为None则定义一个空的list
             args = []
+        else:
+            args = list(args)   #后面还要追加参数, 复制一份, 不改动调用者的list
         #如果有orderby参数就在sql语句中添加字符串OrderBy和参数OrderBy, 但是OrderBy是在关键字参数中定义的
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)  #extent()函数用于在列表末尾一次性追加另一个序列中的多个值(用新列表扩展原来的列表)
+        #keyset分页: after/before是(排序列的值, 主键)的tuple, 只查这个位置之后/之前的行, 不需要offset
+        #传了after=None表示keyset分页的第一页: 不加条件, 但排序和后面的页一致(带上主键)
+        seek, key = None, None
+        if 'before' in kw:
+            seek, key = 'before', kw['before']
+        elif 'after' in kw:
+            seek, key = 'after', kw['after']
+        if seek:
+            seekWhere, seekOrderBy = cls._seek_clause(orderBy, seek)
+            if key is None:
+                seekWhere = None
             else:
-                raise  ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+                args.extend([key[0], key[0], key[1]])
+        limit = kw.get('limit', None)
+        #limit只影响占位符的个数, 具体的值放进args里
+        if limit is None:
+            limitShape = 0
+        elif isinstance(limit, int):
+            limitShape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            limitShape = 2
+            args.extend(limit)  #extent()函数用于在列表末尾一次性追加另一个序列中的多个值(用新列表扩展原来的列表)
+        else:
+            raise  ValueError('Invalid limit value: %s' % str(limit))
+
+        def build():
+            sql = [cls._select_sql(fields) if unloaded else cls.__select__]
+            #如果有where参数的话就在sql语句中添加字符串where和where参数
+            if where and seekWhere:
+                sql.append('where')
+                sql.append('(%s) and %s' % (where, seekWhere))
+            elif where or seekWhere:
+                sql.append('where')
+                sql.append(where or seekWhere)
+            if seek:
+                sql.append('order by')
+                sql.append(seekOrderBy)
+            elif orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            if limitShape:
+                sql.append('limit')
+                sql.append(', '.join(['?'] * limitShape))
+            return ' '.join(sql)
+
+        columns = cls._columns(fields if unloaded else cls.__fields__)
+        stmt = cls._statement(('findAll', fields, where, orderBy, seek, seekWhere is not None, limitShape), build, columns)
+        #按tuple取行, 用预先算好的列名直接构造对象
+        rs = yield from select(stmt, args, cache=kw.get('cache', True), raw=True, timeout=kw.get('timeout', None))
+        #before是倒着查的, 翻转回orderBy要求的顺序
+        if seek == 'before' and key is not None:
+            rs = reversed(rs)
+        columns = stmt.columns
+        #compact=True时返回只读的紧凑记录
+        if kw.get('compact', False):
+            make = cls.__record__._from_values
+            return [make(columns, r) for r in rs]
+        make = cls._from_values
+        return [make(columns, r, unloaded) for r in rs]
+
+    #只查询主键和fields这几列的select语句
+    @classmethod
+    def _select_sql(cls, fields):
+        for f in fields:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+        columns = ['`%s`' % f for f in fields if f != cls.__primary_key__]
+        return 'select %s from `%s`' % (', '.join(['`%s`' % cls.__primary_key__] + columns), cls.__table__)
+
+    #根据orderBy(只支持一列, 如'created_at desc')生成keyset分页的条件和排序
+    #主键作为第二排序列, 保证排序列的值相同时顺序也是确定的
+    @classmethod
+    def _seek_clause(cls, orderBy, seek):
+        parts = (orderBy or '').split()
+        if len(parts) not in (1, 2) or (len(parts) == 2 and parts[1].lower() not in ('asc', 'desc')):
+            raise ValueError('Keyset pagination needs orderBy on one column: %s' % orderBy)
+        column = parts[0].strip('`')
+        desc = len(parts) == 2 and parts[1].lower() == 'desc'
+        #before就是把方向反过来查
+        if seek == 'before':
+            desc = not desc
+        op, direction = ('<', 'desc') if desc else ('>', 'asc')
+        where = '(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (column, op, column, cls.__primary_key__, op)
+        orderBy = '`%s` %s, `%s` %s' % (column, direction, cls.__primary_key__, direction)
+        return where, orderBy
+
+    #iter_all() - 和findAll一样的参数, 但返回async generator, 用服务端游标分批读取, 适合导出/重建索引这种全表扫描:
+    #   async for blog in Blog.iter_all(batch=1000):
+    #       ...
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch=1000, **kw):
+        def build():
+            sql = [cls.__select__]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            orderBy = kw.get('orderBy', None)
+            if orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            return ' '.join(sql)
+
+        stmt = cls._statement(('iter_all', where, kw.get('orderBy', None)), build, cls._columns(cls.__fields__))
+        make = cls.__record__._from_values if kw.get('compact', False) else cls._from_values
+        columns = stmt.columns
+        #调用者没读完就关闭时, 这里要立即关闭iter_select, 否则要等垃圾回收才会把连接还给连接池
+        rows = iter_select(stmt, args, batch, raw=True)
+        try:
+            async for r in rows:
+                yield make(columns, r)
+        finally:
+            await rows.aclose()
 
     #findNumber() - 根据where条件查找, 但返回值是整数, 适用于select count(*)类型的sql
     @classmethod
     @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
+    def findNumber(cls, selectField, where=None, args=None, counter=False):
         'find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+        #counter=True时, count(*)/count(主键)的总数, 以及__counts__中的列 col=? 的计数从计数器取
+        if counter:
+            column = cls._counter_column(selectField, where)
+            if column is not False:
+                n = yield from _counter(cls).get(column, args[0] if column else None)
+                return n
+        def build():
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            return ' '.join(sql)
+
+        stmt = cls._statement(('findNumber', selectField, where), build)
+        rs = yield from select(stmt, args, 1, cache=True)
         if len(rs) == 0:
             return None
-        return rs[0]['__num__']
+        return rs[0]['_num_']
+
+    #判断findNumber能不能用计数器回答: 返回None表示总行数, 返回列名表示按这一列计数, 返回False表示不能
+    @classmethod
+    def _counter_column(cls, selectField, where):
+        field = selectField.replace(' ', '').replace('`', '').lower()
+        if field not in ('count(*)', 'count(%s)' % cls.__primary_key__.lower()):
+            return False
+        if not where:
+            return None
+        m = _RE_COUNT_WHERE.match(where)
+        if m and m.group(1) in cls.__counts__:
+            return m.group(1)
+        return False
 
 
     @classmethod
@@ -292,10 +2065,66 @@ class Model(dict, metaclass=ModelMetaclass):
     def find(cls, pk):
         'find object by primary key.'
         #select函数之前定义过, 这里传入了三个参数分别是之前定义的sql, args, size
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        imap = _identity_map.get()
+        if imap is not None and (cls, pk) in imap:
+            return imap[(cls, pk)]
+        if batch_find_enabled() and _transaction.get() is None:
+            row = yield from cls._load(pk)
+            if row is None:
+                return None
+            obj = cls._from_row(row)
+        else:
+            rs = yield from select(cls.__find__, [pk], 1, cache=True)
+            if len(rs) == 0:
+                return None
+            obj = cls._from_row(rs[0])
+        if imap is not None:
+            imap[(cls, pk)] = obj
+        return obj
+
+    #通过批量合并的loader按主键取一行, 先查查询缓存, 和select(cls.__find__, [pk], 1, cache=True)的效果一样
+    @classmethod
+    @asyncio.coroutine
+    def _load(cls, pk):
+        cache = query_cache()
+        key = _cache_key(cls.__find__, [pk], 1)
+        if cache is not None:
+            rs = cache.get(key)
+            if rs is not None:
+                return rs[0] if rs else None
+            versions = cache.versions(cls.__find__.tables)
+        row = yield from _find_loader(cls).load(pk)
+        if cache is not None:
+            cache.put(key, cls.__find__.tables, versions, [row] if row is not None else [])
+        return row
+
+    #加载投影查询/deferred没有查询的列, 不传names则加载全部没有加载的列
+    @asyncio.coroutine
+    def load_deferred(self, *names):
+        names = tuple(names or sorted(self._unloaded))
+        if not names:
+            return self
+        stmt = self._statement(('load_deferred', names), lambda: '%s where `%s`=?' % (self._select_sql(names), self.__primary_key__))
+        rs = yield from select(stmt, [self.getValue(self.__primary_key__)], 1)
         if len(rs) == 0:
-            return None
-        return cls(**rs[0])
+            raise ValueError('%s not found: %s' % (self.__class__.__name__, self.getValue(self.__primary_key__)))
+        #Model.update是写数据库的方法, 这里要用dict本身的update
+        #已经被赋了新值的列保留新值, 不被数据库里的旧值覆盖
+        row = dict((k, v) for k, v in rs[0].items() if k not in self or k not in self._unloaded)
+        dict.update(self, row)
+        if self._loaded is not None:
+            loaded = self._loaded_values()
+            loaded.update(rs[0])
+            object.__setattr__(self, '_loaded', tuple(loaded.values()))
+            object.__setattr__(self, '_loaded_columns', tuple(loaded))
+        object.__setattr__(self, '_unloaded', self._unloaded.difference(names))
+        return self
+
+    #写操作之后, 把这个对象从当前请求的identity map中去掉, 下次find重新从数据库加载
+    def _forget(self):
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.pop((self.__class__, self.getValue(self.__primary_key__)), None)
 
 #=========================往Model类添加实例方法, 就可以让所有子类调用实例方法========================================
 #save,update,remove这三个方法需要管理员权限才能操作, 所以不定义为类方法, 需要创建实例之后才能调用
@@ -305,25 +2134,89 @@ class Model(dict, metaclass=ModelMetaclass):
         args = list(map(self.getValueOrDefault, self.__fields__))      #将除主键外的属性名称列表中添加到args这个
         args.append(self.getValueOrDefault(self.__primary_key__))   #再把主键添加到这个列表的最后
         rows = yield from execute(self.__insert__, args)
+        self._forget()
         if rows != 1:   #插入记录受影响的行数应该是1, 如果不是1, 那就错了
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        else:
+            _counter(self.__class__).change(self, 1)
+            self._mark_loaded()
 
 
+    #从数据库加载的对象只写改变了的列, 没有改变就不访问数据库; 自己构造的对象写所有的列
     @asyncio.coroutine
     def update(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
+        if self._loaded is None:
+            fields = self.__fields__
+            stmt = self.__update__
+        else:
+            fields = tuple(self.changed_fields())
+            if not fields:
+                logging.info('nothing to update: %s' % self.getValue(self.__primary_key__))
+                return
+            stmt = self._statement(('update', fields), lambda: 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join('`%s`=?' % f for f in fields), self.__primary_key__))
+        args = list(map(self.getValueOrDefault, fields))
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        rows = yield from execute(stmt, args)
+        self._forget()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        else:
+            #写进去的列就算加载过了
+            if self._unloaded:
+                object.__setattr__(self, '_unloaded', self._unloaded.difference(fields))
+            self._mark_loaded()
 
 
+    #批量插入: Blog.save_many(blogs), 返回每一块插入的行数
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, objs, chunk_size=500):
+        objs = list(objs)
+        args_list = []
+        for obj in objs:
+            args = list(map(obj.getValueOrDefault, cls.__fields__))
+            args.append(obj.getValueOrDefault(cls.__primary_key__))
+            args_list.append(args)
+        affected = yield from execute_many(cls.__insert__, args_list, chunk_size)
+        for obj in objs:
+            obj._forget()
+        if sum(affected) != len(args_list):
+            logging.warn('failed to insert records: expected %s, affected rows: %s' % (len(args_list), sum(affected)))
+            _counter(cls).reset()
+        else:
+            counter = _counter(cls)
+            for obj in objs:
+                counter.change(obj, 1)
+                obj._mark_loaded()
+        return affected
+
+    #批量更新: Comment.update_many(comments), 参数顺序和update()一样
+    @classmethod
+    @asyncio.coroutine
+    def update_many(cls, objs, chunk_size=500):
+        objs = list(objs)
+        args_list = []
+        for obj in objs:
+            if obj._unloaded:
+                raise ValueError('Cannot update %s with unloaded fields: %s' % (cls.__name__, ', '.join(sorted(obj._unloaded))))
+            args = list(map(obj.getValueOrDefault, cls.__fields__))
+            args.append(obj.getValueOrDefault(cls.__primary_key__))
+            args_list.append(args)
+        affected = yield from execute_many(cls.__update__, args_list, chunk_size)
+        for obj in objs:
+            obj._forget()
+            obj._mark_loaded()
+        return affected
+
     @asyncio.coroutine
     def remove(self):
         args = [self.getValueOrDefault(self.__primary_key__)]
         rows = yield from execute(self.__delete__, args)
+        self._forget()
         if rows != 1:
             logging.warn('failed to remove by prinary key: affected rows: %s' % rows)
+        else:
+            _counter(self.__class__).change(self, -1)
 
     def to_json(self, **kw):
         return self.copy()
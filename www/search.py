@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-process full-text search over blogs: an inverted index ranked by BM25.
+
+The index is kept in a file. Postings are read from it through mmap, so a
+restart loads the index instead of rebuilding it. Blogs added or changed after
+the file was written are indexed in memory and merged into a new file shortly after.
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, heapq, html, json, logging, math, mmap, os, re, struct
+
+from www.models import Blog
+
+#ascii的单词和数字, 以及连续的汉字
+_RE_TOKEN = re.compile(r'[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff]+')
+
+#各列的权重, 标题中出现的词比正文中的更重要
+FIELDS = (('name', 3.0), ('summary', 2.0), ('content', 1.0))
+
+#中文没有空格分词, 用单字和相邻两个字(bigram)作为词: 建索引时两种都收录,
+#查询时连续的汉字只用bigram(这样"数据库"只匹配"数据"+"据库", 不会匹配到分开出现的单字), 只有一个字时才用单字
+def tokenize(text, query=False):
+    for m in _RE_TOKEN.finditer(text.lower()):
+        w = m.group()
+        if w[0] < '\u3400' or len(w) == 1:
+            yield w
+            continue
+        if not query:
+            for c in w:
+                yield c
+        for i in range(len(w) - 1):
+            yield w[i:i + 2]
+
+#文件格式: 文件头(magic, meta的长度) + meta(json: 文档和词典) + 倒排表(每项是文档序号和词频)
+_MAGIC = b'EYS1'
+_HEADER = struct.Struct('<4sQ')
+_POSTING = struct.Struct('<If')
+
+class SearchIndex(object):
+
+    def __init__(self, file=None, k1=1.2, b=0.75):
+        self.file = file
+        self.k1 = k1
+        self.b = b
+        self.lengths = dict()   #所有文档的长度(按权重计的词数), 文档id ==> 长度
+        self.total = 0.0    #长度之和, 用于计算平均长度
+        self.dirty = False  #有没有写入文件的修改
+        self._postings = dict()     #内存中的倒排表, 词 ==> {文档id: 词频}
+        self._terms = dict()    #内存中的文档包含的词, 删除文档时用
+        #文件中的索引(mmap)
+        self._file = None
+        self._mmap = None
+        self._base = 0      #倒排表在文件中的起始位置
+        self._dictionary = dict()    #词 ==> (倒排表中的起始项, 项数)
+        self._docs = []     #文件中的文档序号 ==> 文档id
+        self._stale = set()     #文件中已经被修改或删除的文档, 查询时跳过
+        self._changed = None    #后台写文件期间修改过的文档, 换上新文件后要重新应用; None表示没有在写文件
+
+    def __len__(self):
+        return len(self.lengths)
+
+    #加入一篇文档, 已经存在的话替换掉; fields可以是Blog, 也可以是任何有get()的对象
+    def add(self, doc_id, fields):
+        tfs = dict()
+        length = 0.0
+        for name, weight in FIELDS:
+            for t in tokenize(fields.get(name) or ''):
+                tfs[t] = tfs.get(t, 0.0) + weight
+                length = length + weight
+        self._add(doc_id, tfs, length)
+
+    def _add(self, doc_id, tfs, length):
+        self.remove(doc_id)
+        if self._changed is not None:
+            self._changed.add(doc_id)
+        for t, tf in tfs.items():
+            self._postings.setdefault(t, dict())[doc_id] = tf
+        self._terms[doc_id] = tuple(tfs)
+        self.lengths[doc_id] = length
+        self.total = self.total + length
+        self.dirty = True
+
+    def remove(self, doc_id):
+        length = self.lengths.pop(doc_id, None)
+        if length is None:
+            return
+        if self._changed is not None:
+            self._changed.add(doc_id)
+        self.total = self.total - length
+        self._stale.add(doc_id)
+        for t in self._terms.pop(doc_id, ()):
+            postings = self._postings[t]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[t]
+        self.dirty = True
+
+    #一个词的倒排表: 文件中的(跳过已经失效的文档)加上内存中的
+    def postings(self, term):
+        entry = self._dictionary.get(term)
+        if entry is not None:
+            start, count = entry
+            docs, stale = self._docs, self._stale
+            for i, tf in _POSTING.iter_unpack(self._mmap[self._base + start * _POSTING.size:self._base + (start + count) * _POSTING.size]):
+                doc_id = docs[i]
+                if doc_id not in stale:
+                    yield doc_id, tf
+        memory = self._postings.get(term)
+        if memory:
+            yield from memory.items()
+
+    #BM25排序, 返回得分最高的limit篇文档[(文档id, 得分), ...]
+    def search(self, q, limit=10):
+        n = len(self.lengths)
+        if n == 0:
+            return []
+        avgdl = self.total / n
+        k1, b = self.k1, self.b
+        scores = dict()
+        for term in set(tokenize(q, query=True)):
+            postings = list(self.postings(term))
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                dl = self.lengths[doc_id]
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    #打开索引文件, 文件格式不对时抛出ValueError
+    def load(self):
+        f = open(self.file, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+        try:
+            magic, meta_size = _HEADER.unpack_from(mm, 0)
+            if magic != _MAGIC:
+                raise ValueError('Not a search index: %s' % self.file)
+            meta = json.loads(mm[_HEADER.size:_HEADER.size + meta_size].decode('utf-8'))
+        except Exception:
+            mm.close()
+            f.close()
+            raise
+        self._close()
+        self._file, self._mmap = f, mm
+        self._base = _HEADER.size + meta_size
+        self._dictionary = meta['terms']
+        self._docs = [doc_id for doc_id, length in meta['docs']]
+        self._stale = set()
+        self._postings = dict()
+        self._terms = dict()
+        self.lengths = dict((doc_id, length) for doc_id, length in meta['docs'])
+        self.total = sum(self.lengths.values())
+        self.dirty = False
+
+    @property
+    def saving(self):
+        return self._changed is not None
+
+    #把文件中的和内存中的合并写成新文件, 再重新打开
+    def save(self):
+        self._install(_write_index(self.file, self._snapshot()))
+
+    #在线程池中写文件, 不阻塞事件循环; 写文件期间的修改在换上新文件后重新应用
+    @asyncio.coroutine
+    def save_in_executor(self):
+        snapshot = self._snapshot()
+        try:
+            tmp = yield from asyncio.get_event_loop().run_in_executor(None, _write_index, self.file, snapshot)
+        except BaseException:
+            self._changed = None
+            raise
+        self._install(tmp)
+
+    #写文件需要的数据: 内存中的部分复制一份, 文件中的部分直接引用(写完之前不会关闭mmap)
+    def _snapshot(self):
+        if self._changed is not None:
+            raise RuntimeError('Search index is already being saved.')
+        self._changed = set()
+        return dict(
+            lengths=dict(self.lengths),
+            postings=dict((t, dict(p)) for t, p in self._postings.items()),
+            stale=set(self._stale),
+            mmap=self._mmap,
+            base=self._base,
+            dictionary=self._dictionary,
+            docs=self._docs)
+
+    def _install(self, tmp):
+        changed, self._changed = self._changed, None
+        #写文件期间修改过的文档现在的状态: (词频, 长度), 删除了的是None
+        redo = []
+        for doc_id in changed:
+            if doc_id in self.lengths:
+                redo.append((doc_id, (dict((t, self._postings[t][doc_id]) for t in self._terms[doc_id]), self.lengths[doc_id])))
+            else:
+                redo.append((doc_id, None))
+        self._close()
+        os.replace(tmp, self.file)
+        self.load()
+        for doc_id, state in redo:
+            if state is None:
+                self.remove(doc_id)
+            else:
+                self._add(doc_id, *state)
+        self.dirty = bool(redo)
+        logging.info('search index saved: %s docs, %s changed while saving' % (len(self), len(redo)))
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap, self._file = None, None
+            self._dictionary, self._docs = dict(), []
+
+#把snapshot(见SearchIndex._snapshot)写成临时文件, 返回文件名; 不访问SearchIndex对象, 可以在其他线程执行
+def _write_index(file, snapshot):
+    lengths, memory, stale = snapshot['lengths'], snapshot['postings'], snapshot['stale']
+    mm, base, dictionary, old_docs = snapshot['mmap'], snapshot['base'], snapshot['dictionary'], snapshot['docs']
+    docs = list(lengths)
+    index = dict((doc_id, i) for i, doc_id in enumerate(docs))
+    terms = dict()
+    postings = []
+    count = 0
+    for term in set(dictionary).union(memory):
+        entries = []
+        entry = dictionary.get(term)
+        if entry is not None:
+            start, n = entry
+            for i, tf in _POSTING.iter_unpack(mm[base + start * _POSTING.size:base + (start + n) * _POSTING.size]):
+                doc_id = old_docs[i]
+                if doc_id not in stale:
+                    entries.append((index[doc_id], tf))
+        entries.extend((index[doc_id], tf) for doc_id, tf in memory.get(term, dict()).items())
+        if not entries:
+            continue
+        terms[term] = (count, len(entries))
+        postings.extend(_POSTING.pack(i, tf) for i, tf in entries)
+        count = count + len(entries)
+    meta = json.dumps(dict(docs=[(doc_id, lengths[doc_id]) for doc_id in docs], terms=terms), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    #先写临时文件再改名, 写到一半出错不会破坏原来的索引
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(meta)))
+        f.write(meta)
+        f.write(b''.join(postings))
+    return tmp
+
+#截取text中第一次出现查询词附近的一段, 转义html后用<em>标出查询词
+def snippet(text, q, width=120):
+    text = text or ''
+    lower = text.lower()
+    spans = []
+    for term in set(tokenize(q, query=True)):
+        i = lower.find(term)
+        while i >= 0:
+            spans.append((i, i + len(term)))
+            i = lower.find(term, i + 1)
+    start = max(0, min(s for s, e in spans) - width // 4) if spans else 0
+    end = min(len(text), start + width)
+    L = ['...'] if start > 0 else []
+    pos = start
+    #重叠或相邻的区间(例如"数据"和"据库")合并后再标记
+    merged = []
+    for s, e in sorted((max(s, start), min(e, end)) for s, e in spans if s < end and e > start):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    for s, e in merged:
+        L.append(html.escape(text[pos:s]))
+        L.append('<em>%s</em>' % html.escape(text[s:e]))
+        pos = e
+    L.append(html.escape(text[pos:end]))
+    if end < len(text):
+        L.append('...')
+    return ''.join(L)
+
+_index = None
+_save_delay = 5
+_save_handle = None
+
+def search_index():
+    return _index
+
+#从数据库流式读取所有博客建立索引
+async def rebuild(index):
+    async for blog in Blog.iter_all(compact=True):
+        index.add(blog.id, blog)
+    logging.info('search index built: %s blogs' % len(index))
+
+#启动时调用: 有索引文件就直接打开, 文件损坏或者和数据库的博客数对不上就重新建立
+@asyncio.coroutine
+def init(file=None, save_delay=5):
+    global _index, _save_delay
+    index = SearchIndex(file)
+    loaded = False
+    if file and os.path.exists(file):
+        try:
+            index.load()
+            loaded = True
+        except (OSError, ValueError) as e:
+            logging.warning('failed to load search index %s: %s' % (file, e))
+    if loaded:
+        num = yield from Blog.findNumber('count(id)')
+        if num != len(index):
+            logging.info('search index out of date: %s blogs, %s indexed' % (num, len(index)))
+            index = SearchIndex(file)
+            loaded = False
+    if not loaded:
+        yield from rebuild(index)
+        if file:
+            index.save()
+    _index, _save_delay = index, save_delay
+
+#保存有延迟, 连续的修改只写一次文件
+def _schedule_save():
+    global _save_handle
+    if _index.file and _save_handle is None:
+        _save_handle = asyncio.get_event_loop().call_later(_save_delay, _save)
+
+def _save():
+    global _save_handle
+    _save_handle = None
+    if _index.dirty and not _index.saving:
+        asyncio.ensure_future(_save_in_background())
+
+#写文件在线程池中进行, 期间又有修改的话稍后再写一次
+@asyncio.coroutine
+def _save_in_background():
+    try:
+        yield from _index.save_in_executor()
+    except Exception as e:
+        logging.exception(e)
+    if _index.dirty:
+        _schedule_save()
+
+#博客创建或修改后调用, 没有启用搜索时什么也不做
+def index_blog(blog):
+    if _index is None:
+        return
+    _index.add(blog.id, blog)
+    _schedule_save()
+
+def remove_blog(blog_id):
+    if _index is None:
+        return
+    _index.remove(blog_id)
+    _schedule_save()
+
+#没有启用搜索时抛出RuntimeError
+def search(q, limit=10):
+    if _index is None:
+        raise RuntimeError('Search is not enabled.')
+    return _index.search(q, limit)
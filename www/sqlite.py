@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+SQLite backend for www.orm, for single-node sites and as a fast test target.
+
+    yield from orm.create_pool(loop, backend='sqlite', db='blog.db', schema='schema_sqlite.sql')
+
+The pool, connections and cursors expose the same methods as the aiomysql
+objects the orm uses, so Model.find/findAll/findNumber/save/update/remove work
+unchanged. Every connection owns a one-thread executor: sqlite3 calls never
+block the event loop, and each sqlite3 connection is only used by its own
+thread. Databases are opened in WAL mode, so readers do not block the writer.
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, logging, re, sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+Error = sqlite3.Error
+OperationalError = sqlite3.OperationalError
+
+#orm的Statement按aiomysql的格式把?换成了%s, 这里换回sqlite3的?, %%是转义的%
+_RE_FORMAT = re.compile(r'%s|%%')
+_operations = dict()
+
+def _translate(operation):
+    sql = _operations.get(operation)
+    if sql is None:
+        if len(_operations) >= 1024:
+            _operations.clear()
+        sql = _operations[operation] = _RE_FORMAT.sub(lambda m: '?' if m.group() == '%s' else '%', operation)
+    return sql
+
+#游标, 每行是tuple
+class Cursor(object):
+
+    _as_dict = False
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    @asyncio.coroutine
+    def execute(self, query, args=None):
+        self._cur = yield from self._conn._run(self._execute, 'execute', query, args or ())
+        return self.rowcount
+
+    @asyncio.coroutine
+    def executemany(self, query, args):
+        self._cur = yield from self._conn._run(self._execute, 'executemany', query, [tuple(a) for a in args])
+        return self.rowcount
+
+    #在连接的线程中执行
+    def _execute(self, method, query, args):
+        cur = self._conn._raw.cursor()
+        getattr(cur, method)(_translate(query), args)
+        self.rowcount, self.lastrowid, self.description = cur.rowcount, cur.lastrowid, cur.description
+        return cur
+
+    @asyncio.coroutine
+    def fetchone(self):
+        rs = yield from self.fetchmany(1)
+        return rs[0] if rs else None
+
+    @asyncio.coroutine
+    def fetchmany(self, size=None):
+        rs = yield from self._conn._run(self._cur.fetchmany, size or self._cur.arraysize)
+        return self._rows(rs)
+
+    @asyncio.coroutine
+    def fetchall(self):
+        rs = yield from self._conn._run(self._cur.fetchall)
+        return self._rows(rs)
+
+    def _rows(self, rs):
+        if not self._as_dict:
+            return rs
+        names = [d[0] for d in self.description]
+        return [dict(zip(names, r)) for r in rs]
+
+    @asyncio.coroutine
+    def close(self):
+        cur, self._cur = self._cur, None
+        if cur is not None and not self._conn.closed:
+            yield from self._conn._run(cur.close)
+
+#游标, 每行是dict
+class DictCursor(Cursor):
+
+    _as_dict = True
+
+#sqlite3的游标本来就是边读边取, 不会一次把结果全部读进内存
+SSCursor = Cursor
+SSDictCursor = DictCursor
+
+class Connection(object):
+
+    def __init__(self, loop, executor, raw):
+        self._loop = loop
+        self._executor = executor
+        self._raw = raw
+
+    @property
+    def closed(self):
+        return self._raw is None
+
+    #把sqlite3的调用交给这个连接的线程
+    @asyncio.coroutine
+    def _run(self, fn, *args):
+        if self._raw is None:
+            raise OperationalError('Connection is closed.')
+        return (yield from self._loop.run_in_executor(self._executor, fn, *args))
+
+    @asyncio.coroutine
+    def cursor(self, cursor=None):
+        if self._raw is None:
+            raise OperationalError('Connection is closed.')
+        return (cursor or Cursor)(self)
+
+    #immediate: 事务一开始就拿到写锁, 不会在事务中途因为别的连接在写而失败
+    @asyncio.coroutine
+    def begin(self):
+        yield from self._run(self._raw.execute, 'begin immediate')
+
+    @asyncio.coroutine
+    def commit(self):
+        yield from self._run(self._raw.commit)
+
+    @asyncio.coroutine
+    def rollback(self):
+        yield from self._run(self._raw.rollback)
+
+    @asyncio.coroutine
+    def ping(self, reconnect=True):
+        yield from self._run(self._raw.execute, 'select 1')
+
+    #打断正在执行的语句, 可以在任何线程调用
+    def interrupt(self):
+        if self._raw is not None:
+            self._raw.interrupt()
+
+    #在连接的线程中排队关闭, 正在执行的语句结束后才真正关掉
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._executor.submit(raw.close)
+            self._executor.shutdown(wait=False)
+
+#打开一个连接: WAL模式, 写锁被占用时最多等待timeout秒
+@asyncio.coroutine
+def connect(db, loop=None, timeout=5):
+    loop = loop or asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(1)
+    def open_db():
+        raw = sqlite3.connect(db, timeout=timeout, isolation_level=None, check_same_thread=False)
+        raw.execute('pragma journal_mode=wal')
+        raw.execute('pragma synchronous=normal')
+        return raw
+    try:
+        raw = yield from loop.run_in_executor(executor, open_db)
+    except BaseException:
+        executor.shutdown(wait=False)
+        raise
+    return Connection(loop, executor, raw)
+
+#with (yield from pool) as conn: 结束时把连接还回去
+class _ConnectionContext(object):
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *exc):
+        self._pool.release(self._conn)
+
+#pool.acquire()的返回值: 可以yield from/await得到连接, 也可以async with
+class _PoolAcquire(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    #__await__必须返回普通的迭代器, 不能直接返回协程
+    def __iter__(self):
+        return (yield from self._pool._acquire())
+
+    __await__ = __iter__
+
+    async def __aenter__(self):
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        self._pool.release(self._conn)
+
+class Pool(object):
+
+    def __init__(self, db, minsize=1, maxsize=10, timeout=5, loop=None):
+        if not 0 <= minsize <= maxsize or maxsize < 1:
+            raise ValueError('Invalid pool sizes: minsize=%s, maxsize=%s' % (minsize, maxsize))
+        self.db = db
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._free = deque()
+        self._used = set()
+        self._opening = 0   #正在打开的连接数
+        self._waiters = deque()
+        self.closed = False
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._opening
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def acquire(self):
+        return _PoolAcquire(self)
+
+    def __iter__(self):
+        conn = yield from self._acquire()
+        return _ConnectionContext(self, conn)
+
+    __await__ = __iter__
+
+    #优先用空闲连接, 不够时新开, 到了maxsize就等别人还回来
+    @asyncio.coroutine
+    def _acquire(self):
+        while True:
+            if self.closed:
+                raise OperationalError('Pool is closed.')
+            while self._free:
+                conn = self._free.popleft()
+                if not conn.closed:
+                    self._used.add(conn)
+                    return conn
+            if self.size < self.maxsize:
+                conn = yield from self._open()
+                self._used.add(conn)
+                return conn
+            fut = self._loop.create_future()
+            self._waiters.append(fut)
+            try:
+                yield from fut
+            except BaseException:
+                #已经被唤醒又被取消了, 把机会让给下一个
+                if fut.done() and not fut.cancelled():
+                    self._wakeup()
+                elif fut in self._waiters:
+                    self._waiters.remove(fut)
+                raise
+
+    @asyncio.coroutine
+    def _open(self):
+        self._opening = self._opening + 1
+        try:
+            return (yield from connect(self.db, self._loop, self.timeout))
+        finally:
+            self._opening = self._opening - 1
+
+    #打开连接直到有minsize个
+    @asyncio.coroutine
+    def _fill(self):
+        while self.size < self.minsize:
+            self._free.append((yield from self._open()))
+
+    #还回连接; 关闭的连接, 以及还在事务中的连接(状态不确定)直接丢掉
+    def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed:
+            if self.closed or conn._raw.in_transaction:
+                conn.close()
+            else:
+                self._free.append(conn)
+        self._wakeup()
+        fut = self._loop.create_future()
+        fut.set_result(None)
+        return fut
+
+    def _wakeup(self):
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                break
+
+    #关掉所有空闲连接, 使用中的连接还回来时关掉
+    def close(self):
+        self.closed = True
+        while self._free:
+            self._free.popleft().close()
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        while self._used:
+            yield from asyncio.sleep(0.05)
+
+#创建连接池, schema是建表的sql文件(用create table if not exists, 可以重复执行)
+@asyncio.coroutine
+def create_pool(db, minsize=1, maxsize=10, timeout=5, schema=None, loop=None):
+    pool = Pool(db, minsize, maxsize, timeout, loop)
+    if schema is not None:
+        with open(schema, encoding='utf-8') as f:
+            script = f.read()
+        with (yield from pool) as conn:
+            yield from conn._run(conn._raw.executescript, script)
+        logging.info('sqlite schema applied: %s' % schema)
+    yield from pool._fill()
+    return pool
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for the pagination helpers in www.apis.
+
+    python -m pytest www/test_apis.py
+'''
+
+__author__ = 'EveYoung'
+
+import base64, json, unittest
+
+from www.apis import Page, CursorPage, APIValueError, encode_cursor, decode_cursor
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+class PageTest(unittest.TestCase):
+
+    def test_offset(self):
+        p = Page(95, 3)
+        self.assertEqual((p.page_count, p.offset, p.limit), (10, 20, 10))
+        self.assertTrue(p.has_next and p.has_previous)
+
+    def test_out_of_range(self):
+        p = Page(5, 9)
+        self.assertEqual((p.page_index, p.offset, p.limit), (1, 0, 0))
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor('after', (1500000000.5, 123))
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), ('after', (1500000000.5, 123)))
+
+    def test_invalid(self):
+        for cursor in ['', 'not base64!', raw_cursor({'after': 1}), raw_cursor(['after', 1]), raw_cursor(['sideways', 1, 2])]:
+            with self.assertRaises(APIValueError):
+                decode_cursor(cursor)
+
+    def test_non_scalar_key(self):
+        #嵌套的list/dict会被当成sql参数, 必须在这里拒绝
+        for key in [[1, 2], {'a': 1}, None, True]:
+            with self.assertRaises(APIValueError):
+                decode_cursor(raw_cursor(['after', key, 1]))
+            with self.assertRaises(APIValueError):
+                decode_cursor(raw_cursor(['before', 1.0, key]))
+
+class CursorPageTest(unittest.TestCase):
+
+    #按(created_at, id)倒序排好的行
+    rows = [(float(t), t) for t in range(30, 0, -1)]
+
+    def page(self, cursor=None):
+        p = CursorPage(cursor, page_size=10)
+        if p.direction is None:
+            items = self.rows[:p.limit]
+        elif p.direction == 'after':
+            items = [r for r in self.rows if r < p.key][:p.limit]
+        else:
+            items = [r for r in self.rows if r > p.key][-p.limit:]
+        return p, p.paginate(items, lambda r: r)
+
+    def test_first_page(self):
+        p, items = self.page()
+        self.assertEqual(items, self.rows[:10])
+        self.assertTrue(p.has_next)
+        self.assertFalse(p.has_previous)
+        self.assertIsNone(p.prev_cursor)
+
+    def test_next_and_back(self):
+        p1, items1 = self.page()
+        p2, items2 = self.page(p1.next_cursor)
+        self.assertEqual(items2, self.rows[10:20])
+        p3, items3 = self.page(p2.prev_cursor)
+        self.assertEqual(items3, items1)
+        self.assertFalse(p3.has_previous)
+
+    def test_last_page(self):
+        p1, items = self.page()
+        p2, items = self.page(p1.next_cursor)
+        p3, items = self.page(p2.next_cursor)
+        self.assertEqual(items, self.rows[20:])
+        self.assertFalse(p3.has_next)
+        self.assertIsNone(p3.next_cursor)
+
+    def test_to_json(self):
+        p, items = self.page()
+        self.assertEqual(p.to_json(), dict(page_size=10, next_cursor=p.next_cursor, prev_cursor=None))
+
+if __name__ == '__main__':
+    unittest.main()
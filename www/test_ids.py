@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for www.ids and the id assignment of www.migrate.
+
+    python -m pytest www/test_ids.py
+'''
+
+__author__ = 'EveYoung'
+
+import calendar, unittest
+
+from www import ids, migrate
+
+#某一天0点(UTC)的毫秒数
+def millis(year, month, day):
+    return calendar.timegm((year, month, day, 0, 0, 0)) * 1000
+
+def legacy_id(ms, n=0):
+    return '%015d%032x000' % (ms, n)
+
+class SnowflakeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = ids.SnowflakeIdGenerator(worker_id=3)
+
+    def test_increasing(self):
+        L = [self.generator.next_id() for i in range(2000)]
+        self.assertEqual(L, sorted(set(L)))
+        #JavaScript能精确表示
+        self.assertLess(L[-1], 1 << 53)
+
+    def test_sequence_overflow(self):
+        g = self.generator
+        g._last = millis(2030, 1, 1)
+        first = g.next_id()
+        for i in range(300):
+            last = g.next_id()
+        #同一毫秒的序号用完了借用下一毫秒
+        self.assertGreater(last, first)
+        self.assertEqual(g.timestamp(last), millis(2030, 1, 1) / 1000.0 + 0.001)
+
+    def test_make(self):
+        g = self.generator
+        ms = millis(2018, 5, 1)
+        id = g.make(ms, 7)
+        self.assertGreater(id, 0)
+        self.assertEqual(g.timestamp(id), ms / 1000.0)
+        self.assertEqual(id & 0xff, 7)
+        self.assertEqual((id >> 8) & 0xf, 3)
+
+    def test_make_before_epoch(self):
+        with self.assertRaises(ValueError):
+            self.generator.make(ids.EPOCH - 1, 0)
+
+    def test_parse(self):
+        self.assertEqual(self.generator.parse('12345'), 12345)
+        with self.assertRaises(ValueError):
+            self.generator.parse('abc')
+
+    def test_invalid_worker(self):
+        with self.assertRaises(ValueError):
+            ids.SnowflakeIdGenerator(worker_id=16)
+
+    def test_create_generator(self):
+        self.assertIsInstance(ids.create_generator({'generator': 'legacy'}), ids.LegacyIdGenerator)
+        self.assertEqual(ids.create_generator({'worker_id': 2}).worker_id, 2)
+        with self.assertRaises(ValueError):
+            ids.create_generator({'generator': 'uuid'})
+
+class LegacyTest(unittest.TestCase):
+
+    def test_format(self):
+        id = ids.LegacyIdGenerator().next_id()
+        self.assertEqual(len(id), 50)
+        self.assertTrue(id[:15].isdigit())
+
+class NewIdsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = ids.SnowflakeIdGenerator()
+
+    def test_order_and_time(self):
+        old = [legacy_id(millis(2015, 3, 1)), legacy_id(millis(2016, 7, 9)), legacy_id(millis(2019, 12, 31))]
+        rows = migrate.new_ids(old, self.generator)
+        self.assertEqual([o for o, n in rows], old)
+        new = [n for o, n in rows]
+        self.assertEqual(new, sorted(new))
+        self.assertGreater(new[0], 0)
+        self.assertEqual(self.generator.timestamp(new[0]), millis(2015, 3, 1) / 1000.0)
+        #新id转成字符串后不含'-', 可以放进cookie和url
+        self.assertNotIn('-', ''.join(str(n) for n in new))
+
+    def test_same_millisecond(self):
+        ms = millis(2017, 1, 1)
+        rows = migrate.new_ids([legacy_id(ms, i) for i in range(300)], self.generator)
+        new = [n for o, n in rows]
+        self.assertEqual(len(set(new)), 300)
+        self.assertEqual(new, sorted(new))
+        self.assertEqual(self.generator.timestamp(new[-1]), (ms + 1) / 1000.0)
+
+    def test_before_epoch(self):
+        g = ids.SnowflakeIdGenerator(epoch=millis(2020, 1, 1))
+        with self.assertRaises(RuntimeError):
+            migrate.new_ids([legacy_id(millis(2018, 1, 1))], g)
+
+    def test_empty(self):
+        self.assertEqual(migrate.new_ids([], self.generator), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for www.metrics and the pool/query metrics recorded by www.orm.
+
+    python -m pytest www/test_metrics.py
+'''
+
+__author__ = 'EveYoung'
+
+import unittest
+
+from www import metrics, orm, test_orm
+
+class MetricTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registered = list(metrics._registry)
+
+    def tearDown(self):
+        #测试中创建的指标不留在全局的注册表里
+        metrics._registry[:] = self.registered
+
+    def test_counter(self):
+        c = metrics.Counter('test_total', 'A counter.', ('kind',))
+        c.inc('a')
+        c.inc('a', amount=2)
+        c.inc('b"\n')
+        self.assertEqual(c.render(), '\n'.join([
+            '# HELP test_total A counter.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3',
+            'test_total{kind="b\\"\\n"} 1']))
+        with self.assertRaises(ValueError):
+            c.inc()
+
+    def test_gauge_function(self):
+        g = metrics.Gauge('test_gauge', 'A gauge.', ('state',))
+        values = [(('free',), 2)]
+        g.set_function(lambda: values)
+        self.assertIn('test_gauge{state="free"} 2', g.render())
+        #输出时才计算
+        values = [(('free',), 0.5)]
+        self.assertIn('test_gauge{state="free"} 0.5', g.render())
+
+    def test_histogram(self):
+        h = metrics.Histogram('test_seconds', 'A histogram.', buckets=(0.1, 1))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        self.assertEqual(list(h.samples()), [
+            ('test_seconds_bucket', '{le="0.1"}', 1),
+            ('test_seconds_bucket', '{le="1"}', 2),
+            ('test_seconds_bucket', '{le="+Inf"}', 3),
+            ('test_seconds_sum', '', 5.55),
+            ('test_seconds_count', '', 3)])
+
+    def test_render(self):
+        metrics.Counter('test_render_total', 'Registered.').inc()
+        text = metrics.render()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('test_render_total 1\n', text)
+
+class OrmMetricsTest(test_orm.SQLiteTestCase):
+
+    sql = 'select name from blogs where created_at > ?'
+
+    def observed(self, metric, *labelvalues):
+        v = metric._values.get(labelvalues, 0)
+        return v[2] if isinstance(metric, metrics.Histogram) and v else v
+
+    def test_query(self):
+        self.run_async(test_orm.make_blog('a', 1.0).save())
+        seconds, rows = self.observed(orm._QUERY_SECONDS, self.sql), self.observed(orm._QUERY_ROWS, self.sql)
+        self.run_async(orm.select(self.sql, [0]))
+        self.assertEqual(self.observed(orm._QUERY_SECONDS, self.sql), seconds + 1)
+        self.assertEqual(self.observed(orm._QUERY_ROWS, self.sql), rows + 1)
+
+    def test_error(self):
+        sql = 'select nothing from blogs'
+        errors = self.observed(orm._QUERY_ERRORS, sql, 'OperationalError')
+        with self.assertRaises(orm._backend.Error):
+            self.run_async(orm.select(sql, []))
+        self.assertEqual(self.observed(orm._QUERY_ERRORS, sql, 'OperationalError'), errors + 1)
+
+    def test_pool(self):
+        waits = self.observed(orm._POOL_WAIT, 'primary')
+        self.run_async(orm.select(self.sql, [0]))
+        self.assertEqual(self.observed(orm._POOL_WAIT, 'primary'), waits + 1)
+        pool = orm._primary_pool()
+        text = metrics.render()
+        self.assertIn('db_pool_connections{pool="primary",state="max"} %s\n' % pool.maxsize, text)
+        self.assertIn('db_pool_connections{pool="primary",state="in_use"} 0\n', text)
+
+if __name__ == '__main__':
+    unittest.main()
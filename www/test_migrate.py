@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for the declared indexes on models and the index check of www.migrate.
+
+    python -m pytest www/test_migrate.py
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, unittest
+from unittest import mock
+
+from www import migrate, orm, test_orm
+from www.models import User, Blog, Comment
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+#假的live_indexes: 表名 ==> 实际的索引
+def fake_live(tables):
+    @asyncio.coroutine
+    def live_indexes(table):
+        return tables.get(table, {})
+    return live_indexes
+
+class IndexTest(unittest.TestCase):
+
+    def test_name(self):
+        self.assertEqual(orm.Index('blog_id', 'created_at').name, 'idx_blog_id_created_at')
+        self.assertEqual(orm.Index('email', unique=True).name, 'uniq_email')
+        with self.assertRaises(ValueError):
+            orm.Index()
+
+    def test_invalid_column(self):
+        with self.assertRaises(RuntimeError):
+            class Bad(orm.Model):
+                __table__ = 'bad'
+                __indexes__ = [orm.Index('nothing')]
+                id = orm.StringField(primary_key=True)
+
+    def test_ddl(self):
+        self.assertEqual(migrate.index_ddl(Comment, Comment.__indexes__[1]), 'alter table `comments` add index `idx_blog_id_created_at` (`blog_id`, `created_at`), algorithm=inplace, lock=none')
+        self.assertEqual(migrate.index_ddl(User, User.__indexes__[0]), 'alter table `users` add unique index `idx_email` (`email`), algorithm=inplace, lock=none')
+
+class DiffTest(unittest.TestCase):
+
+    def test_satisfied(self):
+        index = orm.Index('email', unique=True)
+        self.assertTrue(migrate._satisfied(index, {'other_name': (True, ('email',))}))
+        #声明了unique, 实际的索引不是unique
+        self.assertFalse(migrate._satisfied(index, {'idx_email': (False, ('email',))}))
+        #列的顺序不一样
+        self.assertFalse(migrate._satisfied(orm.Index('a', 'b'), {'idx': (False, ('b', 'a'))}))
+        #没有声明unique, 实际是unique也可以
+        self.assertTrue(migrate._satisfied(orm.Index('email'), {'idx': (True, ('email',))}))
+
+    def test_diff(self):
+        live = {'blogs': {'PRIMARY': (True, ('id',)), 'idx_created_at': (False, ('created_at',))}, 'comments': {'idx_created_at': (False, ('created_at',))}}
+        with mock.patch.object(migrate, 'live_indexes', fake_live(live)):
+            missing = run(migrate.diff([Blog, Comment]))
+        self.assertEqual([(m, i.name) for m, i, ddl in missing], [(Comment, 'idx_blog_id_created_at')])
+
+    def test_verify(self):
+        with mock.patch.object(migrate, 'live_indexes', fake_live({})):
+            with self.assertRaisesRegex(RuntimeError, 'idx_email'):
+                run(migrate.verify_indexes([User]))
+        live = {'blogs': {'idx_created_at': (False, ('created_at',))}}
+        with mock.patch.object(migrate, 'live_indexes', fake_live(live)):
+            run(migrate.verify_indexes([Blog]))
+
+class SQLiteSchemaTest(test_orm.SQLiteTestCase):
+
+    #SQLite的索引由schema_sqlite.sql创建, 和模型中声明的要一致
+    def live_indexes(self, table):
+        indexes = dict()
+        for r in self.run_async(orm.select('select name, "unique" u from pragma_index_list(?)', [table])):
+            columns = self.run_async(orm.select('select name from pragma_index_info(?) order by seqno', [r['name']]))
+            indexes[r['name']] = (bool(r['u']), tuple(c['name'] for c in columns))
+        return indexes
+
+    def test_declared_indexes(self):
+        for model in migrate.all_models():
+            live = self.live_indexes(model.__table__)
+            for index in model.__indexes__:
+                self.assertTrue(migrate._satisfied(index, live), '%s on %s' % (index, model.__table__))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1087 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for www.orm and www.writebehind against the SQLite backend.
+
+Every test gets its own database file in a temporary directory, created from
+schema_sqlite.sql, so no MySQL server is needed:
+
+    python -m pytest www/test_orm.py
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, logging, os, shutil, tempfile, unittest
+from unittest import mock
+
+from www import orm
+from www.models import Blog, Comment
+from www.writebehind import WriteBehind
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema_sqlite.sql')
+
+def make_blog(name, created_at):
+    return Blog(user_id=1, user_name='user', user_image='about:blank', name=name, summary='summary', content='content', created_at=created_at)
+
+def make_comment(blog_id, content='comment'):
+    return Comment(blog_id=blog_id, user_id=1, user_name='user', user_image='about:blank', content=content)
+
+#不经过Model, 直接用execute插入一条评论
+def insert_comment(id, blog_id):
+    return orm.execute('insert into comments (id, blog_id, user_id, user_name, user_image, content, created_at) values (?, ?, ?, ?, ?, ?, ?)', [id, blog_id, 1, 'user', 'about:blank', 'direct', 1.0])
+
+class SQLiteTestCase(unittest.TestCase):
+
+    #子类在这里加create_pool的参数
+    pool_options = {}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        kw = dict(backend='sqlite', db=os.path.join(self.dir, 'blog.db'), schema=SCHEMA, counter_reconcile=None)
+        kw.update(self.pool_options)
+        self.run_async(orm.create_pool(self.loop, **kw))
+
+    def tearDown(self):
+        pool = orm._primary_pool()
+        pool.close()
+        self.run_async(pool.wait_closed())
+        #create_pool和写后队列启动的后台任务
+        tasks = [t for t in asyncio.all_tasks(self.loop) if not t.done()]
+        for t in tasks:
+            t.cancel()
+        self.run_async(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        #连接在各自的线程里关闭, 关掉最后一个连接时sqlite会同时删除-wal/-shm文件
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def count(self, model, where=None, args=None):
+        return self.run_async(model.findNumber('count(*)', where, args))
+
+class TransactionTest(SQLiteTestCase):
+
+    def test_commit(self):
+        async def run():
+            async with orm.transaction():
+                await make_blog('a', 1.0).save()
+                await make_blog('b', 2.0).save()
+        self.run_async(run())
+        self.assertEqual(self.count(Blog), 2)
+
+    def test_rollback(self):
+        async def run():
+            async with orm.transaction():
+                await make_blog('a', 1.0).save()
+                #事务里的读操作能看到自己未提交的写
+                self.assertEqual(await Blog.findNumber('count(*)'), 1)
+                raise ValueError('abort')
+        with self.assertRaises(ValueError):
+            self.run_async(run())
+        self.assertEqual(self.count(Blog), 0)
+
+    def test_savepoint_rollback(self):
+        async def run():
+            async with orm.transaction():
+                await make_blog('outer', 1.0).save()
+                try:
+                    async with orm.transaction():
+                        await make_blog('inner', 2.0).save()
+                        raise ValueError('abort inner')
+                except ValueError:
+                    pass
+                await make_blog('after', 3.0).save()
+            return await Blog.findAll(orderBy='created_at', cache=False)
+        blogs = self.run_async(run())
+        self.assertEqual([b.name for b in blogs], ['outer', 'after'])
+
+    def test_savepoint_release(self):
+        async def run():
+            async with orm.transaction():
+                async with orm.transaction():
+                    await make_blog('inner', 1.0).save()
+                raise ValueError('abort outer')
+        with self.assertRaises(ValueError):
+            self.run_async(run())
+        #内层提交了也跟着外层回滚
+        self.assertEqual(self.count(Blog), 0)
+
+    def test_connection_released(self):
+        pool = orm._primary_pool()
+        async def run():
+            for i in range(pool.maxsize + 2):
+                try:
+                    async with orm.transaction():
+                        await make_blog('a%s' % i, float(i)).save()
+                        raise ValueError('abort')
+                except ValueError:
+                    pass
+        self.run_async(run())
+        self.assertEqual(pool.size, pool.freesize)
+
+class KeysetPaginationTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        #有几篇created_at相同, 翻页时要靠主键区分
+        times = [1.0, 2.0, 2.0, 2.0, 3.0, 4.0, 4.0, 5.0]
+        self.run_async(Blog.save_many([make_blog('b%s' % i, t) for i, t in enumerate(times)]))
+        self.expected = [b.id for b in self.run_async(Blog.findAll(orderBy='created_at desc, id desc'))]
+
+    def test_after(self):
+        async def run():
+            ids = []
+            page = await Blog.findAll(orderBy='created_at desc', limit=3, after=None)
+            while page:
+                ids.extend(b.id for b in page)
+                last = page[-1]
+                page = await Blog.findAll(orderBy='created_at desc', limit=3, after=(last.created_at, last.id))
+            return ids
+        self.assertEqual(self.run_async(run()), self.expected)
+
+    def test_before(self):
+        async def run():
+            first = await Blog.findAll(orderBy='created_at desc', limit=3, after=None)
+            last = first[-1]
+            second = await Blog.findAll(orderBy='created_at desc', limit=3, after=(last.created_at, last.id))
+            head = second[0]
+            back = await Blog.findAll(orderBy='created_at desc', limit=3, before=(head.created_at, head.id))
+            return first, back
+        first, back = self.run_async(run())
+        #往前翻得到的还是按orderBy排好的上一页
+        self.assertEqual([b.id for b in back], [b.id for b in first])
+
+    def test_where(self):
+        async def run():
+            return await Blog.findAll('created_at < ?', [4.0], orderBy='created_at desc', limit=2, after=(2.0, self.expected[3]))
+        blogs = self.run_async(run())
+        self.assertEqual([b.id for b in blogs], self.expected[4:6])
+
+    def test_invalid_order(self):
+        with self.assertRaises(ValueError):
+            self.run_async(Blog.findAll(orderBy='created_at desc, id desc', after=None))
+
+class QueryCacheTest(SQLiteTestCase):
+
+    pool_options = dict(query_cache=dict(maxsize=16, ttl=60))
+
+    def test_hit(self):
+        async def run():
+            return (await orm.select('select * from blogs', [], cache=True)), (await orm.select('select * from blogs', [], cache=True))
+        rs1, rs2 = self.run_async(run())
+        self.assertIs(rs1, rs2)
+
+    def test_invalidate_on_write(self):
+        async def run():
+            before = await Blog.findNumber('count(*)')
+            await make_blog('a', 1.0).save()
+            after = await Blog.findNumber('count(*)')
+            await orm.execute('delete from blogs', [])
+            return before, after, (await Blog.findNumber('count(*)'))
+        self.assertEqual(self.run_async(run()), (0, 1, 0))
+
+    def test_other_tables_kept(self):
+        cache = orm.query_cache()
+        async def run():
+            await orm.select('select * from blogs', [], cache=True)
+            await orm.select('select * from comments', [], cache=True)
+            await make_comment(1).save()
+        self.run_async(run())
+        self.assertEqual(len(cache), 1)
+
+    def test_invalidate_on_commit(self):
+        async def run():
+            await Blog.findNumber('count(*)')
+            async with orm.transaction():
+                await make_blog('a', 1.0).save()
+            return await Blog.findNumber('count(*)')
+        self.assertEqual(self.run_async(run()), 1)
+
+    def test_comma_join(self):
+        sql = 'select b.`name`, c.`content` from blogs b, comments c where c.`blog_id`=b.`id`'
+        self.assertEqual(orm.compile_sql(sql).tables, frozenset(['blogs', 'comments']))
+        async def run():
+            blog = make_blog('a', 1.0)
+            await blog.save()
+            before = await orm.select(sql, [], cache=True)
+            #写逗号后面的那张表, 缓存也要失效
+            await make_comment(blog.id).save()
+            return before, (await orm.select(sql, [], cache=True))
+        before, after = self.run_async(run())
+        self.assertEqual((len(before), len(after)), (0, 1))
+
+    def test_unknown_tables(self):
+        cache = orm.query_cache()
+        #indexed by是SQLite的语法, 认不出表名
+        sql = 'select * from blogs indexed by idx_blogs_created_at where created_at > ?'
+        self.assertFalse(orm.compile_sql(sql).complete)
+        async def run():
+            await orm.select('select * from blogs', [], cache=True)
+            #认不全表的语句不缓存
+            first = await orm.select(sql, [0], cache=True)
+            second = await orm.select(sql, [0], cache=True)
+            self.assertIsNot(first, second)
+            self.assertEqual(len(cache), 1)
+            #写的话整个缓存作废
+            await orm.execute('delete from blogs indexed by idx_blogs_created_at where created_at < ?', [0])
+        self.run_async(run())
+        self.assertEqual(len(cache), 0)
+
+class BatchFindTest(SQLiteTestCase):
+
+    pool_options = dict(batch_find=dict(window=0, max_size=2), query_cache=dict(maxsize=64, ttl=60))
+
+    def setUp(self):
+        super().setUp()
+        self.blogs = [make_blog('b%s' % i, float(i)) for i in range(3)]
+        self.run_async(Blog.save_many(self.blogs))
+
+    def test_batched(self):
+        pks = [b.id for b in self.blogs] + [-1]
+        async def run():
+            return await asyncio.gather(*[Blog.find(pk) for pk in pks])
+        with mock.patch.object(orm, 'select', wraps=orm.select) as select:
+            found = self.run_async(run())
+        self.assertEqual([b.name for b in found[:3]], ['b0', 'b1', 'b2'])
+        self.assertIsNone(found[3])
+        #两条in查询(max_size=2), 找不到的主键再单独查一次
+        self.assertEqual(select.call_count, 3)
+
+    def test_key_conversion(self):
+        #url中的主键是字符串, 数据库会转换类型, 合并后的结果要和不合并时一样
+        blog = self.run_async(Blog.find(str(self.blogs[1].id)))
+        self.assertIsNotNone(blog)
+        self.assertEqual(blog.id, self.blogs[1].id)
+
+    def test_shared_cache(self):
+        pk = self.blogs[0].id
+        self.run_async(Blog.find(pk))
+        cached = orm.query_cache().get(orm._cache_key(Blog.__find__, [pk], 1))
+        self.assertEqual(cached[0]['name'], 'b0')
+        self.assertIs(self.run_async(orm.select(Blog.__find__, [pk], 1, cache=True)), cached)
+
+    def test_transaction_not_batched(self):
+        async def run():
+            async with orm.transaction():
+                blog = make_blog('new', 9.0)
+                await blog.save()
+                return await Blog.find(blog.id)
+        self.assertEqual(self.run_async(run()).name, 'new')
+
+#在SQLite中执行很久的语句
+SLOW_SQL = 'with recursive c(x) as (select 1 union all select x + 1 from c where x < 1000000000) select count(*) n from c'
+
+class DeadlineTest(SQLiteTestCase):
+
+    pool_options = dict(maxsize=2, query_timeout=5)
+
+    def test_query_timeout(self):
+        pool = orm._primary_pool()
+        async def run():
+            with self.assertRaises(orm.QueryTimeout):
+                await orm.select(SLOW_SQL, [], timeout=0.1)
+            #超时的连接被关掉丢弃, 后面的语句用新的连接
+            return await orm.select('select 1 n', [])
+        self.assertEqual(self.run_async(run())[0]['n'], 1)
+        self.assertEqual(pool.size, pool.freesize)
+
+    def test_request_deadline(self):
+        async def run():
+            with orm.deadline(0.1):
+                with self.assertRaises(orm.QueryTimeout):
+                    await orm.select(SLOW_SQL, [])
+                await asyncio.sleep(0.1)
+                #请求已经超时, 不再去拿连接
+                with self.assertRaises(orm.QueryTimeout):
+                    await orm.select('select 1', [])
+            return await orm.select('select 1 n', [])
+        self.assertEqual(self.run_async(run())[0]['n'], 1)
+
+    def test_pool_wait_bounded(self):
+        pool = orm._primary_pool()
+        async def run():
+            conns = [await pool.acquire() for i in range(pool.maxsize)]
+            try:
+                with self.assertRaises(orm.QueryTimeout):
+                    await orm.select('select 1', [], timeout=0.1)
+            finally:
+                for conn in conns:
+                    pool.release(conn)
+            return await orm.select('select 1 n', [], timeout=1)
+        self.assertEqual(self.run_async(run())[0]['n'], 1)
+        self.assertEqual(pool.size, pool.freesize)
+
+    def test_fast_path(self):
+        async def run():
+            await orm.select('select 1', [])
+            #有空闲连接时不为拿连接和执行语句另建task
+            with mock.patch.object(asyncio, 'wait_for', wraps=asyncio.wait_for) as wait_for, mock.patch.object(asyncio, 'ensure_future', wraps=asyncio.ensure_future) as ensure_future:
+                await orm.select('select 1', [])
+                await orm.execute('delete from blogs', [])
+            return wait_for.call_count + ensure_future.call_count
+        self.assertEqual(self.run_async(run()), 0)
+
+class SlowQueryTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        #同一个进程里创建两次连接池, 日志文件换成后一个
+        self.file = os.path.join(self.dir, 'slow.log')
+        for file in (os.path.join(self.dir, 'old.log'), self.file):
+            orm._primary_pool().close()
+            self.run_async(orm.create_pool(self.loop, backend='sqlite', db=os.path.join(self.dir, 'blog.db'), counter_reconcile=None, slow_query=dict(threshold=0, file=file)))
+
+    def tearDown(self):
+        super().tearDown()
+        for handler in list(logging.getLogger('www.slow_query').handlers):
+            logging.getLogger('www.slow_query').removeHandler(handler)
+            handler.close()
+
+    def test_record(self):
+        async def run():
+            await orm.select('select * from blogs where `name`=?', ['secret'])
+            #EXPLAIN在后台执行
+            await asyncio.sleep(0.1)
+        self.run_async(run())
+        entry = orm.slow_query_log().entries[0]
+        self.assertEqual(entry['sql'], 'select * from blogs where `name`=?')
+        self.assertNotIn('secret', repr(entry))
+        self.assertIsNotNone(entry['explain'])
+
+    def test_one_handler(self):
+        self.assertEqual(len(logging.getLogger('www.slow_query').handlers), 1)
+        self.run_async(orm.select('select 1', []))
+        with open(self.file, encoding='utf-8') as f:
+            lines = [line for line in f if 'select 1' in line]
+        self.assertEqual(len(lines), 1)
+
+class CounterTest(SQLiteTestCase):
+
+    def number(self, blog_id):
+        return self.run_async(Comment.findNumber('count(id)', 'blog_id=?', [blog_id], counter=True))
+
+    def test_save_and_remove(self):
+        self.assertEqual(self.number(1), 0)
+        comments = [make_comment(1) for i in range(3)]
+        async def run():
+            for c in comments:
+                await c.save()
+            await make_comment(2).save()
+            await comments[0].remove()
+        self.run_async(run())
+        self.assertEqual(self.number(1), 2)
+        self.assertEqual(self.number(2), 1)
+        self.assertEqual(self.run_async(Comment.findNumber('count(*)', counter=True)), 3)
+
+    def test_counter_skips_query(self):
+        self.assertEqual(self.number(1), 0)
+        #绕过Model直接写入的行, 要等核对之后才计入
+        self.run_async(insert_comment(1, 1))
+        self.assertEqual(self.number(1), 0)
+        self.run_async(orm.reconcile_counters())
+        self.assertEqual(self.number(1), 1)
+
+    def test_rollback_resets(self):
+        self.assertEqual(self.number(1), 0)
+        async def run():
+            async with orm.transaction():
+                await make_comment(1).save()
+                await make_comment(1).save()
+                raise ValueError('abort')
+        with self.assertRaises(ValueError):
+            self.run_async(run())
+        self.assertEqual(self.number(1), 0)
+
+    def test_save_many(self):
+        self.assertEqual(self.number(1), 0)
+        self.run_async(Comment.save_many([make_comment(1) for i in range(4)]))
+        self.assertEqual(self.number(1), 4)
+
+class LanesTest(SQLiteTestCase):
+
+    pool_options = dict(maxsize=3, lanes={'auth': {'reserved': 1, 'weight': 4}, 'public': {'weight': 1}})
+
+    def setUp(self):
+        super().setUp()
+        self.lanes = orm._lanes[orm._primary_pool()]
+
+    def test_reserved(self):
+        async def run():
+            #public最多拿到3-1个许可, 剩下一个只给auth
+            await self.lanes.acquire('public')
+            await self.lanes.acquire('public')
+            try:
+                with self.assertRaises(orm.QueryTimeout):
+                    await orm.select('select 1', [], timeout=0.05)
+                with orm.lane('auth'):
+                    return await orm.select('select 1 n', [], timeout=1)
+            finally:
+                self.lanes.release('public')
+                self.lanes.release('public')
+        self.assertEqual(self.run_async(run())[0]['n'], 1)
+        self.assertEqual(self.lanes.used, 0)
+
+    def test_weighted_dispatch(self):
+        async def run():
+            await self.lanes.acquire('public')
+            await self.lanes.acquire('public')
+            await self.lanes.acquire('auth')
+            order = []
+            async def wait(name):
+                await self.lanes.acquire(name)
+                order.append(name)
+                await asyncio.sleep(0)
+                self.lanes.release(name)
+            tasks = [asyncio.ensure_future(wait(name)) for name in ['public'] * 4 + ['auth'] * 4]
+            await asyncio.sleep(0)
+            self.lanes.release('public')
+            self.lanes.release('public')
+            self.lanes.release('auth')
+            await asyncio.gather(*tasks)
+            return order
+        order = self.run_async(run())
+        #auth的权重是4, 前面几个许可基本都给auth
+        self.assertEqual(sorted(order), ['auth'] * 4 + ['public'] * 4)
+        self.assertGreaterEqual(order[:5].count('auth'), 3)
+
+    def test_unknown_lane(self):
+        self.assertEqual(self.lanes.lane('nope'), 'public')
+
+    def test_invalid_reserved(self):
+        with self.assertRaises(ValueError):
+            orm._Lanes(orm._primary_pool(), {'auth': {'reserved': 3}, 'public': {}}, 'public')
+
+class AutotuneTest(SQLiteTestCase):
+
+    #interval很长, 后台任务不会自己调节, 测试里直接调用tick()
+    pool_options = dict(maxsize=6, warmup=6, lanes={'auth': {'reserved': 1}, 'public': {}}, autotune=dict(min_size=2, interval=3600))
+
+    def setUp(self):
+        super().setUp()
+        self.lanes = orm._lanes[orm._primary_pool()]
+        self.tuner = orm._PoolTuner(self.lanes, min_size=2, interval=3600)
+
+    def test_shrink_when_idle(self):
+        pool = orm._primary_pool()
+        self.assertEqual(self.tuner.tick(), 5)
+        self.assertEqual(self.tuner.tick(), 4)
+        self.run_async(self.tuner.trim())
+        self.assertEqual(pool.size, 4)
+        for i in range(5):
+            self.tuner.tick()
+        #min_size=2被调成了保留的1个加上min_shared的2个
+        self.assertEqual(self.lanes.limit, 3)
+
+    def test_min_size_covers_reserved(self):
+        lanes = orm._Lanes(orm._primary_pool(), {'auth': {'reserved': 2}, 'admin': {'reserved': 2}, 'public': {}}, 'public')
+        self.assertEqual(orm._PoolTuner(lanes, min_size=5).min_size, 6)
+        self.assertEqual(orm._PoolTuner(lanes, min_size=5, min_shared=1).min_size, 5)
+
+    def test_grow_when_queued(self):
+        self.lanes.set_limit(3)
+        self.lanes.take_window()
+        async def run():
+            #auth保留了一个, public只能用两个, 第三个要排队
+            await self.lanes.acquire('public')
+            await self.lanes.acquire('public')
+            third = asyncio.ensure_future(self.lanes.acquire('public'))
+            await asyncio.sleep(0)
+            self.lanes.release('public', 0.001)
+            await third
+            self.lanes.release('public', 0.001)
+            self.lanes.release('public', 0.001)
+        self.run_async(run())
+        #排队时成倍增加, 不超过maxsize
+        self.assertEqual(self.tuner.tick(), 6)
+
+    def test_backoff_on_latency(self):
+        self.lanes.take_window()
+        self.lanes.window.update(count=10, hold=0.01)
+        limit = self.tuner.tick()
+        #基线是1ms, 平均占用时间变成10ms
+        self.lanes.window.update(count=10, hold=0.1, peak=limit)
+        self.assertEqual(self.tuner.tick(), int(limit * 0.75))
+
+    def test_backoff_on_errors(self):
+        self.lanes.take_window()
+        self.lanes.window.update(count=10, hold=0.01, errors=2, peak=6)
+        self.assertEqual(self.tuner.tick(), 4)
+
+    def test_transaction_not_measured(self):
+        self.lanes.take_window()
+        async def run():
+            async with orm.transaction():
+                await asyncio.sleep(0.05)
+            await orm.select('select 1', [])
+        self.run_async(run())
+        #只计入了select, 事务占用连接的时间不算延迟
+        self.assertEqual(self.lanes.window['count'], 1)
+        self.assertLess(self.lanes.window['hold'], 0.05)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            orm._PoolTuner(self.lanes, min_size=0)
+        with self.assertRaises(ValueError):
+            orm._PoolTuner(self.lanes, min_size=7)
+        with self.assertRaises(ValueError):
+            orm._PoolTuner(self.lanes, growth=1)
+
+class WriteBehindTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.spill_file = os.path.join(self.dir, 'comments.spill')
+
+    def queue(self):
+        return WriteBehind(Comment, key='blog_id', max_batch=2, max_pending=2, interval=3600, spill_file=self.spill_file)
+
+    def spilled_lines(self):
+        if not os.path.exists(self.spill_file):
+            return 0
+        with open(self.spill_file, 'rb') as f:
+            return len(f.readlines())
+
+    def test_spill(self):
+        q = self.queue()
+        comments = [q.add(make_comment(1, 'c%s' % i)) for i in range(5)]
+        #内存里只放max_pending个, 剩下的按顺序写进溢出文件
+        self.assertEqual(len(q), 5)
+        self.assertEqual(self.spilled_lines(), 3)
+        self.assertEqual([r.content for r in q.pending(1)], ['c0', 'c1', 'c2', 'c3', 'c4'])
+        self.assertEqual(q.pending(2), [])
+        self.assertTrue(self.run_async(q.flush()))
+        self.run_async(q.close())
+        self.assertEqual(self.count(Comment), 5)
+        self.assertEqual(self.spilled_lines(), 0)
+        rs = self.run_async(Comment.findAll(orderBy='created_at, id'))
+        self.assertEqual([c.id for c in rs], [c.id for c in comments])
+
+    def test_spill_kept_until_inserted(self):
+        q = self.queue()
+        comments = [q.add(make_comment(1, 'c%s' % i)) for i in range(4)]
+        #第三个的主键已经存在, 第二批插入失败
+        self.run_async(insert_comment(comments[2].id, 1))
+        self.assertFalse(self.run_async(q.flush()))
+        self.assertEqual(self.count(Comment), 3)
+        #读回内存但还没写入的行还在文件里
+        self.assertEqual(self.spilled_lines(), 2)
+        self.run_async(orm.execute('delete from comments where id=?', [comments[2].id]))
+        self.assertTrue(self.run_async(q.flush()))
+        self.assertEqual(self.count(Comment), 4)
+        self.assertEqual(self.spilled_lines(), 0)
+        self.run_async(q.close())
+
+    def test_recover(self):
+        q = self.queue()
+        comments = [q.add(make_comment(1, 'c%s' % i)) for i in range(5)]
+        #退出前已经有一行写进了数据库
+        self.run_async(comments[0].save())
+        #没有启动后台任务, close()把内存中的对象也追加到溢出文件
+        self.run_async(q.close(timeout=0))
+        self.assertEqual(self.spilled_lines(), 5)
+        self.assertEqual(self.count(Comment), 1)
+
+        q = self.queue()
+        self.run_async(q.start())
+        self.assertEqual(len(q), 4)
+        self.assertTrue(os.path.exists(self.spill_file + '.recover'))
+        self.assertTrue(self.run_async(q.flush()))
+        self.assertFalse(os.path.exists(self.spill_file + '.recover'))
+        self.run_async(q.close())
+        rs = self.run_async(Comment.findAll(orderBy='created_at, id'))
+        self.assertEqual([c.id for c in rs], [c.id for c in comments])
+
+    def test_closed(self):
+        q = self.queue()
+        self.run_async(q.close())
+        with self.assertRaises(RuntimeError):
+            q.add(make_comment(1))
+
+class DirtyTrackingTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog('a', 1.0)
+        self.run_async(self.blog.save())
+
+    #执行update, 返回写数据库的sql, 没有写则返回None
+    def update(self, obj):
+        with mock.patch.object(orm, 'execute', wraps=orm.execute) as execute:
+            self.run_async(obj.update())
+        if not execute.called:
+            return None
+        sql = execute.call_args[0][0]
+        return getattr(sql, 'sql', sql)
+
+    def test_partial_update(self):
+        blog = self.run_async(Blog.find(self.blog.id))
+        self.assertEqual(blog.changed_fields(), [])
+        blog.name = 'b'
+        self.assertEqual(blog.changed_fields(), ['name'])
+        self.assertEqual(self.update(blog), 'update `blogs` set `name`=? where `id`=?')
+        self.assertEqual(self.run_async(Blog.find(self.blog.id)).name, 'b')
+
+    def test_nothing_changed(self):
+        blog = self.run_async(Blog.find(self.blog.id))
+        blog.name = 'a'
+        self.assertIsNone(self.update(blog))
+
+    def test_repeated_update(self):
+        blog = self.run_async(Blog.find(self.blog.id))
+        blog.name = 'b'
+        self.update(blog)
+        #第二次只写上次之后改变的列
+        blog.summary = 'new summary'
+        self.assertEqual(self.update(blog), 'update `blogs` set `summary`=? where `id`=?')
+        self.assertIsNone(self.update(blog))
+
+    def test_projection(self):
+        blog = self.run_async(Blog.findAll(fields=['name']))[0]
+        with self.assertRaises(AttributeError):
+            blog.summary
+        blog.name = 'b'
+        self.assertEqual(self.update(blog), 'update `blogs` set `name`=? where `id`=?')
+        found = self.run_async(Blog.find(self.blog.id))
+        self.assertEqual((found.name, found.summary, found.content), ('b', 'summary', 'content'))
+
+    def test_constructed(self):
+        #自己构造的对象不知道数据库里的值, 写所有的列
+        blog = make_blog('c', 2.0)
+        blog.id = self.blog.id
+        self.assertEqual(self.update(blog), Blog.__update__)
+        self.assertEqual(self.run_async(Blog.find(self.blog.id)).name, 'c')
+
+    def test_saved(self):
+        self.assertEqual(self.blog.changed_fields(), [])
+        self.blog.name = 'b'
+        self.assertEqual(self.blog.changed_fields(), ['name'])
+
+class IdentityMapTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog('a', 1.0)
+        self.run_async(self.blog.save())
+
+    def test_same_object(self):
+        async def run():
+            token = orm.begin_identity_map()
+            try:
+                with mock.patch.object(orm, 'select', wraps=orm.select) as select:
+                    first = await Blog.find(self.blog.id)
+                    second = await Blog.find(self.blog.id)
+                self.assertEqual(select.call_count, 1)
+                return first, second
+            finally:
+                orm.end_identity_map(token)
+        first, second = self.run_async(run())
+        self.assertIs(first, second)
+
+    def test_disabled(self):
+        async def run():
+            return await Blog.find(self.blog.id), await Blog.find(self.blog.id)
+        first, second = self.run_async(run())
+        self.assertIsNot(first, second)
+
+    def test_end(self):
+        async def run():
+            token = orm.begin_identity_map()
+            first = await Blog.find(self.blog.id)
+            orm.end_identity_map(token)
+            self.assertIsNone(orm._identity_map.get())
+            return first, await Blog.find(self.blog.id)
+        first, second = self.run_async(run())
+        self.assertIsNot(first, second)
+
+    def test_missing_not_stored(self):
+        async def run():
+            token = orm.begin_identity_map()
+            try:
+                self.assertIsNone(await Blog.find(-1))
+                return dict(orm._identity_map.get())
+            finally:
+                orm.end_identity_map(token)
+        self.assertEqual(self.run_async(run()), {})
+
+    def test_forget_on_write(self):
+        async def run():
+            token = orm.begin_identity_map()
+            try:
+                blog = await Blog.find(self.blog.id)
+                blog.name = 'b'
+                await blog.update()
+                #写过之后重新从数据库加载
+                updated = await Blog.find(self.blog.id)
+                self.assertIsNot(updated, blog)
+                self.assertEqual(updated.name, 'b')
+                await updated.remove()
+                return await Blog.find(self.blog.id)
+            finally:
+                orm.end_identity_map(token)
+        self.assertIsNone(self.run_async(run()))
+
+    def test_requests_isolated(self):
+        #每个请求(task)有自己的identity map
+        async def request():
+            token = orm.begin_identity_map()
+            try:
+                return await Blog.find(self.blog.id)
+            finally:
+                orm.end_identity_map(token)
+        async def run():
+            return await asyncio.gather(request(), request())
+        first, second = self.run_async(run())
+        self.assertIsNot(first, second)
+
+class RecordTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog('a', 1.0)
+        self.run_async(self.blog.save())
+
+    def record(self, **kw):
+        return self.run_async(Blog.findAll(compact=True, **kw))[0]
+
+    def test_slots(self):
+        rec = self.record()
+        self.assertIsInstance(rec, orm.Record)
+        self.assertFalse(hasattr(rec, '__dict__'))
+        self.assertIsNone(rec._extra)
+        self.assertEqual((rec.id, rec.name, rec['summary']), (self.blog.id, 'a', 'summary'))
+
+    def test_extra(self):
+        rec = self.record()
+        #列以外的属性存在_extra里
+        rec.html_content = '<p>content</p>'
+        rec['tags'] = ['x']
+        self.assertEqual(rec._extra, dict(html_content='<p>content</p>', tags=['x']))
+        self.assertEqual(rec['html_content'], '<p>content</p>')
+        self.assertIn('tags', rec)
+        self.assertNotIn('other', rec)
+        self.assertEqual(rec.get('other', 1), 1)
+        with self.assertRaises(KeyError):
+            rec['other']
+        with self.assertRaises(AttributeError):
+            rec.other
+        self.assertEqual(rec.keys()[-2:], ['html_content', 'tags'])
+        self.assertEqual(rec.to_json()['tags'], ['x'])
+
+    def test_not_loaded(self):
+        #deferred的content默认不查询
+        rec = self.record()
+        self.assertNotIn('content', rec)
+        self.assertNotIn('content', rec.to_json())
+        with self.assertRaisesRegex(AttributeError, 'not loaded'):
+            rec.content
+        rec = self.record(fields=['name'])
+        self.assertEqual(sorted(rec.keys()), ['id', 'name'])
+
+    def test_model(self):
+        blog = self.record().model()
+        self.assertIsInstance(blog, Blog)
+        self.assertEqual(blog.changed_fields(), [])
+        blog.name = 'b'
+        self.run_async(blog.update())
+        found = self.run_async(Blog.find(self.blog.id))
+        self.assertEqual((found.name, found.content), ('b', 'content'))
+
+#create_pool建立的只读副本
+def replicas():
+    return orm.__replicas
+
+class ReplicaTestCase(SQLiteTestCase):
+
+    replica_lag = 0
+
+    #副本是另一个数据库文件, 和主库之间没有同步, 查到的数据可以说明读的是哪个库
+    @property
+    def pool_options(self):
+        return dict(replicas=[dict(db=os.path.join(self.dir, 'replica.db'))], replica_lag=self.replica_lag)
+
+    def setUp(self):
+        super().setUp()
+        self.run_async(make_blog('a', 1.0).save())
+        self.run_async(orm.execute('create table primary_only (x int)', []))
+
+    def tearDown(self):
+        for r in replicas():
+            r.pool.close()
+            self.run_async(r.pool.wait_closed())
+        super().tearDown()
+
+class ReplicaTest(ReplicaTestCase):
+
+    def test_read_replica(self):
+        self.assertEqual(self.count(Blog), 0)
+        #事务中的读走主库
+        async def run():
+            async with orm.transaction():
+                return await Blog.findNumber('count(*)')
+        self.assertEqual(self.run_async(run()), 1)
+
+    def test_error_raised(self):
+        #不是连接层面的错误, 不换主库
+        with self.assertRaises(orm._backend.OperationalError):
+            self.run_async(orm.select('select x from primary_only', []))
+        self.assertTrue(replicas()[0].available())
+
+    def test_fail_over(self):
+        with mock.patch.object(orm._backend, 'is_disconnect', return_value=True):
+            self.assertEqual(self.run_async(orm.select('select count(*) n from primary_only', []))[0]['n'], 0)
+        replica = replicas()[0]
+        self.assertFalse(replica.available())
+        #副本不可用期间读主库
+        self.assertEqual(self.count(Blog), 1)
+        replica.down_until = 0
+        self.assertEqual(self.count(Blog), 0)
+
+class ReplicaLagTest(ReplicaTestCase):
+
+    replica_lag = 60
+
+    def test_recently_written(self):
+        #刚写过的表读主库, 没写过的表读副本
+        self.assertEqual(self.count(Blog), 1)
+        self.assertEqual(self.count(Comment), 0)
+        self.run_async(insert_comment(1, 1))
+        self.assertEqual(self.count(Comment), 1)
+
+class StatementCacheTest(SQLiteTestCase):
+
+    def test_compile(self):
+        stmt = orm.compile_sql('select * from blogs where id=?')
+        self.assertIs(orm.compile_sql('select * from blogs where id=?'), stmt)
+        self.assertIs(orm.compile_sql(stmt), stmt)
+        self.assertEqual(stmt.operation, 'select * from blogs where id=%s')
+        self.assertEqual((stmt.tables, stmt.complete), (frozenset(['blogs']), True))
+
+    def test_limit(self):
+        #超过上限时整体清空
+        with mock.patch.object(orm, '_STATEMENT_CACHE_SIZE', 2), mock.patch.dict(orm._statements, clear=True):
+            first = orm.compile_sql('select 1')
+            orm.compile_sql('select 2')
+            orm.compile_sql('select 3')
+            self.assertEqual(list(orm._statements), ['select 3'])
+            self.assertIsNot(orm.compile_sql('select 1'), first)
+
+    def test_model_statements(self):
+        #同样形状的查询只拼接一次sql, 参数不同也共用一个Statement
+        with mock.patch.object(orm, 'select', wraps=orm.select) as select:
+            self.run_async(Blog.findAll('name=?', ['a'], limit=1))
+            self.run_async(Blog.findAll('name=?', ['b'], limit=2))
+            self.run_async(Blog.findAll('name=?', ['c'], limit=(0, 2)))
+        stmts = [c[0][0] for c in select.call_args_list]
+        self.assertIs(stmts[0], stmts[1])
+        self.assertIsNot(stmts[0], stmts[2])
+        self.assertEqual(stmts[0].sql, 'select `id`, `user_id`, `user_name`, `user_image`, `name`, `summary`, `created_at` from `blogs` where name=? limit ?')
+        self.assertEqual(stmts[0].columns, ('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'created_at'))
+
+    def test_execute_string(self):
+        self.run_async(orm.execute('insert into blogs (id, user_id, user_name, user_image, name, summary, content, created_at) values (?, ?, ?, ?, ?, ?, ?, ?)', [1, 1, 'user', 'about:blank', 'a', 'summary', 'content', 1.0]))
+        self.assertEqual(self.run_async(orm.select('select name from blogs where id=?', [1]))[0]['name'], 'a')
+
+class BulkTest(SQLiteTestCase):
+
+    def test_save_many(self):
+        blogs = [make_blog('b%s' % i, float(i)) for i in range(5)]
+        self.assertEqual(self.run_async(Blog.save_many(blogs, chunk_size=2)), [2, 2, 1])
+        self.assertEqual(self.count(Blog), 5)
+        self.assertEqual(blogs[0].changed_fields(), [])
+        self.assertEqual(self.run_async(Blog.save_many([])), [])
+
+    def test_rollback(self):
+        #所有块在一个事务里, 一块失败的话前面的块也不写入
+        blogs = [make_blog('b%s' % i, float(i)) for i in range(3)]
+        blogs[0].id = blogs[2].id = 1
+        with self.assertRaises(orm._backend.Error):
+            self.run_async(Blog.save_many(blogs, chunk_size=2))
+        self.assertEqual(self.count(Blog), 0)
+
+    def test_update_many(self):
+        self.run_async(Blog.save_many([make_blog('b%s' % i, float(i)) for i in range(3)]))
+        blogs = self.run_async(Blog.findAll(fields=list(Blog.__fields__), orderBy='created_at'))
+        for b in blogs:
+            b.name = b.name.upper()
+        self.assertEqual(self.run_async(Blog.update_many(blogs, chunk_size=2)), [2, 1])
+        self.assertEqual([b.name for b in self.run_async(Blog.findAll(orderBy='created_at'))], ['B0', 'B1', 'B2'])
+
+    def test_update_many_unloaded(self):
+        self.run_async(make_blog('a', 1.0).save())
+        #没有加载的列会被写成空值, 不允许
+        blogs = self.run_async(Blog.findAll())
+        with self.assertRaises(ValueError):
+            self.run_async(Blog.update_many(blogs))
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(ValueError):
+            self.run_async(Blog.save_many([make_blog('a', 1.0)], chunk_size=0))
+
+class IterAllTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.run_async(Blog.save_many([make_blog('b%s' % i, float(i)) for i in range(5)]))
+
+    def collect(self, *args, **kw):
+        async def run():
+            return [b async for b in Blog.iter_all(*args, **kw)]
+        return self.run_async(run())
+
+    def test_all_rows(self):
+        blogs = self.collect(batch=2, orderBy='created_at')
+        self.assertEqual([b.name for b in blogs], ['b0', 'b1', 'b2', 'b3', 'b4'])
+        self.assertIsInstance(blogs[0], Blog)
+        self.assertEqual(blogs[0].content, 'content')
+
+    def test_where_and_compact(self):
+        recs = self.collect('created_at >= ?', [3.0], orderBy='created_at desc', compact=True)
+        self.assertEqual([r.name for r in recs], ['b4', 'b3'])
+        self.assertIsInstance(recs[0], orm.Record)
+
+    def test_close_early(self):
+        pool = orm._primary_pool()
+        async def run():
+            rows = Blog.iter_all(batch=2)
+            first = await rows.__anext__()
+            #没读完就关闭, 连接也要还回连接池
+            await rows.aclose()
+            return first
+        self.assertIsInstance(self.run_async(run()), Blog)
+        self.assertEqual(pool.size, pool.freesize)
+        self.assertEqual(self.count(Blog), 5)
+
+    def test_in_transaction(self):
+        #事务中用事务的连接, 能读到未提交的写
+        async def run():
+            async with orm.transaction():
+                await make_blog('new', 9.0).save()
+                return [b.name async for b in Blog.iter_all(orderBy='created_at')]
+        self.assertEqual(self.run_async(run())[-1], 'new')
+
+class ProjectionTest(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog('a', 1.0)
+        self.run_async(self.blog.save())
+
+    def test_deferred(self):
+        blog = self.run_async(Blog.findAll())[0]
+        self.assertNotIn('content', blog)
+        self.assertNotIn('content', blog.to_json())
+        with self.assertRaisesRegex(AttributeError, 'load_deferred'):
+            blog.content
+        #find查询所有的列
+        self.assertEqual(self.run_async(Blog.find(self.blog.id)).content, 'content')
+
+    def test_fields(self):
+        blog = self.run_async(Blog.findAll(fields=['name']))[0]
+        self.assertEqual(dict(blog), dict(id=self.blog.id, name='a'))
+        with self.assertRaises(ValueError):
+            self.run_async(Blog.findAll(fields=['name', 'nothing']))
+
+    def test_load_deferred(self):
+        blog = self.run_async(Blog.findAll(fields=['name']))[0]
+        self.run_async(blog.load_deferred('summary'))
+        self.assertEqual(blog.summary, 'summary')
+        self.assertNotIn('content', blog)
+        self.assertIs(self.run_async(blog.load_deferred()), blog)
+        self.assertEqual(blog.content, 'content')
+        self.assertEqual(blog.changed_fields(), [])
+
+    def test_keep_assigned(self):
+        #已经赋了新值的列不被数据库中的值覆盖, 仍然算作改变了
+        blog = self.run_async(Blog.findAll())[0]
+        blog.content = 'new content'
+        self.run_async(blog.load_deferred())
+        self.assertEqual(blog.content, 'new content')
+        self.assertEqual(blog.changed_fields(), ['content'])
+
+    def test_removed(self):
+        blog = self.run_async(Blog.findAll())[0]
+        self.run_async(self.blog.remove())
+        with self.assertRaises(ValueError):
+            self.run_async(blog.load_deferred())
+
+class HealthTest(SQLiteTestCase):
+
+    pool_options = dict(warmup=3)
+
+    def test_warm_up(self):
+        pool = orm._primary_pool()
+        self.assertEqual((pool.size, pool.freesize), (3, 3))
+
+    def test_keep_alive(self):
+        pool = orm._primary_pool()
+        conns = list(pool._free)
+        #第一个连接ping不通
+        async def ping(reconnect=True):
+            raise orm._backend.OperationalError('gone away')
+        conns[0].ping = ping
+        async def run():
+            task = asyncio.ensure_future(orm._keep_alive([pool], 0.01))
+            await asyncio.sleep(0.1)
+            task.cancel()
+        self.run_async(run())
+        self.assertTrue(conns[0].closed)
+        self.assertFalse(conns[1].closed)
+        self.assertEqual((pool.size, pool.freesize), (2, 2))
+
+    def test_retry_select(self):
+        select = orm._select
+        calls = []
+        #第一次执行时连接断开
+        async def flaky(*args, **kw):
+            calls.append(args)
+            if len(calls) == 1:
+                raise orm._backend.OperationalError('gone away')
+            return await select(*args, **kw)
+        with mock.patch.object(orm, '_select', flaky):
+            with mock.patch.object(orm._backend, 'is_disconnect', return_value=True):
+                self.assertEqual(self.run_async(orm.select('select 1 n', []))[0]['n'], 1)
+            calls.clear()
+            #其他错误不重试
+            with self.assertRaises(orm._backend.OperationalError):
+                self.run_async(orm.select('select 1 n', []))
+        self.assertEqual(len(calls), 1)
+
+class RawRowsTest(SQLiteTestCase):
+
+    pool_options = dict(query_cache=dict(maxsize=64, ttl=60))
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog('a', 1.0)
+        self.run_async(self.blog.save())
+
+    def test_tuples(self):
+        sql = 'select name, id from blogs where id=?'
+        rows = self.run_async(orm.select(sql, [self.blog.id], raw=True))
+        self.assertEqual(list(rows), [('a', self.blog.id)])
+        #tuple和dict的结果分开缓存
+        rows = self.run_async(orm.select(sql, [self.blog.id], cache=True))
+        self.assertEqual(rows, [dict(name='a', id=self.blog.id)])
+        self.assertEqual(list(self.run_async(orm.select(sql, [self.blog.id], cache=True, raw=True))), [('a', self.blog.id)])
+
+    def test_find_all(self):
+        with mock.patch.object(orm, 'select', wraps=orm.select) as select:
+            blog = self.run_async(Blog.findAll(fields=['summary', 'name']))[0]
+        self.assertTrue(select.call_args[1]['raw'])
+        #列名按select的顺序对应
+        self.assertEqual(dict(blog), dict(id=self.blog.id, summary='summary', name='a'))
+
+    def test_from_values(self):
+        blog = Blog._from_values(('id', 'name'), (1, 'a'), frozenset(Blog.__fields__).difference(['name']))
+        self.assertEqual(dict(blog), dict(id=1, name='a'))
+        self.assertEqual(blog.changed_fields(), [])
+        with self.assertRaisesRegex(AttributeError, 'not loaded'):
+            blog.summary
+
+if __name__ == '__main__':
+    unittest.main()
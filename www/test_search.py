@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for www.search: tokenizing, BM25 ranking, the index file and startup.
+
+    python -m pytest www/test_search.py
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, os, shutil, tempfile, unittest
+
+from www import search, test_orm
+from www.models import Blog
+from www.search import SearchIndex, tokenize, snippet
+
+def doc(name, summary='', content=''):
+    return dict(name=name, summary=summary, content=content)
+
+DOCS = {
+    1: doc('Python asyncio', 'coroutines and event loops', 'asyncio runs coroutines on an event loop'),
+    2: doc('MySQL indexes', 'how to choose an index', 'a composite index on blog_id and created_at'),
+    3: doc('数据库优化', '索引和查询', '给评论表加上索引以后查询快了很多'),
+    4: doc('Cooking', 'pasta', 'boil water, add salt, cook pasta')
+}
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_ascii(self):
+        self.assertEqual(list(tokenize('Hello, World 42!')), ['hello', 'world', '42'])
+
+    def test_chinese(self):
+        self.assertEqual(list(tokenize('数据库')), ['数', '据', '库', '数据', '据库'])
+        #查询时只用bigram, 单个字才用单字
+        self.assertEqual(list(tokenize('数据库', query=True)), ['数据', '据库'])
+        self.assertEqual(list(tokenize('库', query=True)), ['库'])
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'search.idx')
+        self.index = SearchIndex(self.file)
+        for doc_id, fields in DOCS.items():
+            self.index.add(doc_id, fields)
+
+    def tearDown(self):
+        self.index._close()
+        shutil.rmtree(self.dir)
+
+    def ids(self, q, index=None):
+        return [doc_id for doc_id, score in (index or self.index).search(q)]
+
+    def test_search(self):
+        self.assertEqual(self.ids('asyncio'), [1])
+        self.assertEqual(self.ids('索引'), [3])
+        self.assertEqual(self.ids('nothing'), [])
+
+    def test_title_weight(self):
+        self.index.add(5, doc('other', content='index'))
+        #标题中出现的词得分更高
+        self.assertEqual(self.ids('index')[0], 2)
+
+    def test_replace_and_remove(self):
+        self.index.add(4, doc('Asyncio cooking'))
+        self.assertEqual(sorted(self.ids('asyncio')), [1, 4])
+        self.assertEqual(self.ids('pasta'), [])
+        self.index.remove(1)
+        self.index.remove(99)
+        self.assertEqual(self.ids('asyncio'), [4])
+        self.assertEqual(len(self.index), 3)
+
+    def test_save_and_load(self):
+        self.index.save()
+        self.assertFalse(self.index.dirty)
+        loaded = SearchIndex(self.file)
+        loaded.load()
+        try:
+            self.assertEqual(len(loaded), 4)
+            for q in ('asyncio', 'index', '索引', 'pasta'):
+                self.assertEqual(loaded.search(q), self.index.search(q))
+        finally:
+            loaded._close()
+
+    def test_edit_after_load(self):
+        self.index.save()
+        #文件中的文档被修改/删除后, 查询跳过文件中的旧版本
+        self.index.add(2, doc('Postgres'))
+        self.index.remove(1)
+        self.assertEqual(self.ids('mysql'), [])
+        self.assertEqual(self.ids('postgres'), [2])
+        self.assertEqual(self.ids('asyncio'), [])
+        self.index.save()
+        self.assertEqual(self.ids('postgres'), [2])
+        self.assertEqual(len(self.index), 3)
+
+    def test_save_in_executor(self):
+        loop = asyncio.new_event_loop()
+        async def run():
+            saving = asyncio.ensure_future(self.index.save_in_executor())
+            await asyncio.sleep(0)
+            self.assertTrue(self.index.saving)
+            #写文件期间的修改在换上新文件后重新应用
+            self.index.add(5, doc('asyncio again'))
+            self.index.remove(4)
+            await saving
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertFalse(self.index.saving)
+        self.assertTrue(self.index.dirty)
+        self.assertEqual(sorted(self.ids('asyncio')), [1, 5])
+        self.assertEqual(self.ids('pasta'), [])
+        self.index.save()
+        loaded = SearchIndex(self.file)
+        loaded.load()
+        try:
+            self.assertEqual(sorted(self.ids('asyncio', loaded)), [1, 5])
+            self.assertEqual(len(loaded), 4)
+        finally:
+            loaded._close()
+
+    def test_save_twice(self):
+        self.index._snapshot()
+        with self.assertRaises(RuntimeError):
+            self.index.save()
+
+    def test_bad_file(self):
+        with open(self.file, 'wb') as f:
+            f.write(b'not an index file')
+        with self.assertRaises(ValueError):
+            SearchIndex(self.file).load()
+
+class SnippetTest(unittest.TestCase):
+
+    def test_highlight(self):
+        self.assertEqual(snippet('Use <b>asyncio</b> today', 'asyncio'), 'Use &lt;b&gt;<em>asyncio</em>&lt;/b&gt; today')
+
+    def test_merge_overlapping(self):
+        self.assertEqual(snippet('优化数据库', '数据库'), '优化<em>数据库</em>')
+
+    def test_window(self):
+        text = 'x' * 200 + ' asyncio ' + 'y' * 200
+        s = snippet(text, 'asyncio', width=40)
+        self.assertTrue(s.startswith('...') and s.endswith('...'))
+        self.assertIn('<em>asyncio</em>', s)
+
+class InitTest(test_orm.SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.file = os.path.join(self.dir, 'search.idx')
+        blogs = [test_orm.make_blog(name, float(i)) for i, name in enumerate(['asyncio tips', 'mysql tips', 'pasta'])]
+        self.run_async(Blog.save_many(blogs))
+        self.blogs = blogs
+
+    def tearDown(self):
+        if search.search_index() is not None:
+            search.search_index()._close()
+        search._index = None
+        super().tearDown()
+
+    def test_build_and_reload(self):
+        self.run_async(search.init(self.file))
+        self.assertEqual(sorted(doc_id for doc_id, score in search.search('tips')), sorted(b.id for b in self.blogs[:2]))
+        self.assertEqual(len(search.search_index()), 3)
+        self.assertTrue(os.path.exists(self.file))
+        search.search_index()._close()
+        #再次启动时直接打开文件
+        self.run_async(search.init(self.file))
+        self.assertIsNotNone(search.search_index()._mmap)
+        self.assertEqual(search.search('pasta')[0][0], self.blogs[2].id)
+
+    def test_out_of_date(self):
+        self.run_async(search.init(self.file))
+        search.search_index()._close()
+        self.run_async(test_orm.make_blog('asyncio more', 9.0).save())
+        #文件中的博客数和数据库对不上, 重新建立
+        self.run_async(search.init(self.file))
+        self.assertEqual(len(search.search_index()), 4)
+
+    def test_disabled(self):
+        search.index_blog(self.blogs[0])
+        with self.assertRaises(RuntimeError):
+            search.search('asyncio')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Write-behind queue for inserts.
+
+Accepted objects are acknowledged right away and inserted later in batches with
+Model.save_many(). A batch is written when max_batch objects are waiting, or
+every interval seconds. At most max_pending objects are kept in memory; when
+the database falls behind, newer objects are appended to a local spill file
+and read back in order. Spilled rows left over from a crash are inserted on
+the next start, skipping the ones that already reached the database.
+'''
+
+__author__ = 'EveYoung'
+
+import asyncio, json, logging, os
+from collections import deque
+
+from www import metrics
+
+_PENDING = metrics.Gauge('write_behind_pending', 'Objects waiting to be inserted.', ('table', 'where'))
+
+#所有的队列, Model ==> WriteBehind
+_queues = dict()
+
+class WriteBehind(object):
+
+    def __init__(self, model, key=None, max_batch=200, interval=0.5, max_pending=10000, spill_file=None):
+        if max_batch < 1 or max_pending < max_batch:
+            raise ValueError('Invalid write behind sizes: max_batch=%s, max_pending=%s' % (max_batch, max_pending))
+        self.model = model
+        self.key = key      #按这一列查询等待中的对象, 例如Comment的blog_id
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self.spill_file = spill_file
+        self._memory = deque()      #内存中等待写入的对象, 最早的在左边
+        self._by_key = dict()   #key的值 ==> 内存中的对象
+        self._spill = None      #溢出文件, 每行是一个json对象
+        self._spilled = 0   #溢出文件中还没有读回内存的行数
+        self._spill_offsets = dict()    #key的值 ==> 溢出文件中的位置
+        self._read_pos = 0      #溢出文件中下一个要读回内存的位置
+        self._from_spill = set()    #从溢出文件读回内存, 还没有写入数据库的对象(id), 写入之前文件中的记录不能删
+        self._unsynced = False   #溢出文件有没有fsync之后的写入
+        self._recover_file = None
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def __len__(self):
+        return len(self._memory) + self._spilled
+
+    #接受一个对象, 主键和默认值(如created_at)此时就确定下来
+    def add(self, obj):
+        if self._closing:
+            raise RuntimeError('Write behind queue for %s is closed.' % self.model.__name__)
+        obj.getValueOrDefault(self.model.__primary_key__)
+        for f in self.model.__fields__:
+            obj.getValueOrDefault(f)
+        self._enqueue(obj)
+        if len(self._memory) >= self.max_batch:
+            self._wakeup.set()
+        return obj
+
+    def _enqueue(self, obj):
+        #溢出文件中还有数据时, 新的对象也写进去, 保持先进先出
+        if self._spilled or len(self._memory) >= self.max_pending:
+            if self.spill_file is None:
+                raise RuntimeError('Too many pending %s: %s' % (self.model.__name__, len(self)))
+            self._write_spill(obj)
+        else:
+            self._remember(obj)
+
+    def _remember(self, obj):
+        self._memory.append(obj)
+        if self.key is not None:
+            self._by_key.setdefault(obj[self.key], []).append(obj)
+
+    def _forget(self, obj):
+        if self.key is not None:
+            objs = self._by_key[obj[self.key]]
+            objs.remove(obj)
+            if not objs:
+                del self._by_key[obj[self.key]]
+
+    def _open_spill(self):
+        if self._spill is None:
+            self._spill = open(self.spill_file, 'a+b')
+        return self._spill
+
+    def _write_spill(self, obj):
+        f = self._open_spill()
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        f.write(json.dumps(dict(obj), ensure_ascii=False).encode('utf-8') + b'\n')
+        f.flush()
+        self._unsynced = True
+        self._spilled = self._spilled + 1
+        if self.key is not None:
+            self._spill_offsets.setdefault(obj[self.key], []).append(pos)
+
+    def _read_spill(self, pos):
+        f = self._spill
+        f.seek(pos)
+        line = f.readline()
+        return self.model(**json.loads(line.decode('utf-8'))), f.tell()
+
+    #把溢出文件中的对象按顺序读回内存, 全部读回并且都写入数据库后清空文件
+    def _refill(self):
+        while self._spilled and len(self._memory) < self.max_pending:
+            pos = self._read_pos
+            obj, self._read_pos = self._read_spill(pos)
+            self._spilled = self._spilled - 1
+            if self.key is not None:
+                offsets = self._spill_offsets[obj[self.key]]
+                offsets.remove(pos)
+                if not offsets:
+                    del self._spill_offsets[obj[self.key]]
+            self._remember(obj)
+            self._from_spill.add(id(obj))
+        if self._spill is not None and not self._spilled and not self._from_spill and self._read_pos:
+            self._spill.truncate(0)
+            self._read_pos = 0
+
+    #还没有写入数据库的对象中, key列等于value的, 返回只读的紧凑记录(见orm.Record)
+    def pending(self, value):
+        if self.key is None:
+            raise ValueError('No key configured for %s write behind queue.' % self.model.__name__)
+        objs = list(self._by_key.get(value, ()))
+        for pos in self._spill_offsets.get(value, ()):
+            objs.append(self._read_spill(pos)[0])
+        record = self.model.__record__
+        columns = record.__columns__
+        return [record._from_values(columns, [obj.get(c) for c in columns]) for obj in objs]
+
+    #把等待中的对象分批写入数据库, 全部写完返回True, 出错返回False(对象保留, 稍后重试)
+    @asyncio.coroutine
+    def flush(self):
+        self._refill()
+        while self._memory:
+            batch = [self._memory[i] for i in range(min(self.max_batch, len(self._memory)))]
+            try:
+                yield from self.model.save_many(batch, self.max_batch)
+            except Exception as e:
+                logging.warning('write behind %s: failed to insert %s rows, will retry: %s' % (self.model.__table__, len(batch), e))
+                return False
+            for obj in batch:
+                self._forget(self._memory.popleft())
+                self._from_spill.discard(id(obj))
+            self._refill()
+        if self._recover_file is not None:
+            os.remove(self._recover_file)
+            self._recover_file = None
+        return True
+
+    #后台任务: 攒够max_batch个或者每隔interval秒写一次, 出错时间隔加倍(最多30秒)
+    @asyncio.coroutine
+    def _run(self):
+        delay = self.interval
+        while True:
+            try:
+                yield from asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._unsynced:
+                os.fsync(self._spill.fileno())
+                self._unsynced = False
+            ok = yield from self.flush()
+            if self._closing and ok:
+                return
+            delay = self.interval if ok else min(delay * 2, 30)
+
+    #启动时先处理上次没写完的溢出文件, 再开始后台任务
+    @asyncio.coroutine
+    def start(self):
+        if self.spill_file and (os.path.exists(self.spill_file) or os.path.exists(self.spill_file + '.recover')):
+            yield from self._recover()
+        self._task = asyncio.ensure_future(self._run())
+
+    #溢出文件中可能有一部分已经写入了数据库(写入后还没来得及清空文件就退出了), 跳过已经存在的主键
+    @asyncio.coroutine
+    def _recover(self):
+        self._recover_file = self.spill_file + '.recover'
+        if not os.path.exists(self._recover_file):
+            os.replace(self.spill_file, self._recover_file)
+        elif os.path.exists(self.spill_file):
+            #上次恢复到一半又退出了, 两个文件合在一起处理
+            with open(self._recover_file, 'ab') as dst, open(self.spill_file, 'rb') as src:
+                dst.write(src.read())
+            os.remove(self.spill_file)
+        with open(self._recover_file, 'rb') as f:
+            objs = [self.model(**json.loads(line.decode('utf-8'))) for line in f if line.strip()]
+        pk = self.model.__primary_key__
+        for i in range(0, len(objs), self.max_batch):
+            chunk = objs[i:i + self.max_batch]
+            found = yield from self.model.findAll('`%s` in (%s)' % (pk, ', '.join(['?'] * len(chunk))), [obj[pk] for obj in chunk], fields=[], cache=False)
+            exists = set(obj[pk] for obj in found)
+            for obj in chunk:
+                #关闭时内存中的对象会再追加一次, 同一个主键只保留一个
+                if obj[pk] not in exists:
+                    exists.add(obj[pk])
+                    self._enqueue(obj)
+        logging.info('write behind %s: recovered %s of %s spilled rows' % (self.model.__table__, len(self), len(objs)))
+
+    #停止接受新对象, 最多等待timeout秒把剩下的写完; 写不完的追加到溢出文件, 下次启动时写入
+    @asyncio.coroutine
+    def close(self, timeout=10):
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                yield from asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._memory and self.spill_file:
+            logging.warning('write behind %s: spilling %s unsaved rows to %s' % (self.model.__table__, len(self._memory), self.spill_file))
+            while self._memory:
+                obj = self._memory.popleft()
+                #从溢出文件读回来的还在文件里
+                if id(obj) not in self._from_spill:
+                    self._write_spill(obj)
+        if self._spill is not None:
+            os.fsync(self._spill.fileno())
+            self._spill.close()
+            self._spill = None
+
+#为一个Model启用写后队列
+@asyncio.coroutine
+def start(model, **kw):
+    q = WriteBehind(model, **kw)
+    yield from q.start()
+    _queues[model] = q
+    return q
+
+#Model的写后队列, 没有启用时返回None
+def queue(model):
+    return _queues.get(model)
+
+#关闭所有的队列, 退出前调用
+@asyncio.coroutine
+def close_all(timeout=10):
+    for model in list(_queues):
+        yield from _queues.pop(model).close(timeout)
+
+def _pending_samples():
+    for model, q in _queues.items():
+        yield (model.__table__, 'memory'), len(q._memory)
+        yield (model.__table__, 'spill'), q._spilled
+
+_PENDING.set_function(_pending_samples)